@@ -1,35 +1,261 @@
 # موقع الأستاذ بن أحمد — ثانوية الشهيد طيبي محمد
 # نسخة ملف واحد (Flask) — تعمل محليًا أو على Render
 
+import csv
+import functools
+import gzip
+import hashlib
+import hmac
+import html
+import io
+import itertools
+import json
+import mimetypes
 import os
+import queue
+import re
 import sqlite3
-from datetime import datetime
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zipfile
+import zlib
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import click
 from flask import (
-    Flask, request, redirect, url_for, send_from_directory, session,
-    abort, flash, render_template_string
+    Flask, request, redirect, url_for, send_file, session,
+    abort, flash, render_template, make_response, Response, g, has_request_context,
+    stream_with_context, before_render_template, template_rendered
 )
+from flask.sessions import SecureCookieSessionInterface
+from jinja2 import DictLoader, FileSystemBytecodeCache
+from markupsafe import Markup, escape
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import is_resource_modified
+from werkzeug.local import LocalProxy
+from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.utils import secure_filename
 
+try:
+    import brotli  # اختياري: ضغط أفضل من gzip إن كان مثبتًا
+except ImportError:
+    brotli = None
+
+try:
+    import fcntl  # غير متوفر على ويندوز
+except ImportError:
+    fcntl = None
+
 # --------------------- إعدادات ---------------------
-APP_TITLE = "موقع الأستاذ بن أحمد"
-SCHOOL_NAME = "ثانوية الشهيد طيبي محمد"
+# الاسمان وكود الأستاذ والأفواج قيم افتراضية: كل مدرسة تحفظ قيمها في قاعدتها (انظر school_settings)
+APP_TITLE = os.environ.get("APP_TITLE", "موقع الأستاذ بن أحمد")
+SCHOOL_NAME = os.environ.get("SCHOOL_NAME", "ثانوية الشهيد طيبي محمد")
 
-UPLOAD_FOLDER = os.path.join(os.getcwd(), "uploads")
+# المسارات تُحدَّد لكل مدرسة (Tenant): DATA_DIR (افتراضيًا مجلد التشغيل) يحوي school.db و uploads/،
+# أو DATA_DIR/tenants/<المدرسة>/ في وضع تعدد المدارس. الملفات في uploads/blobs حسب بصمة SHA-256
+# لمحتواها: نفس الملف لفوجين = نسخة واحدة على القرص
 ALLOWED_EXTENSIONS = {"pdf", "doc", "docx"}
+# مخزن الملفات: "local" (قرص الخادم)، "cloudinary" (يتطلب CLOUDINARY_URL) أو "fake" (مخزن بعيد وهمي للتجربة)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "local").lower()
+SIGNED_URL_TTL = int(os.environ.get("SIGNED_URL_TTL", "300"))  # صلاحية رابط التنزيل بالثواني
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_MB", "20")) * 1024 * 1024
+UPLOAD_CHUNK = 64 * 1024
 
-ADMIN_CODE = os.environ.get("ADMIN_CODE", "ostad123")  # كود الأستاذ
+ADMIN_CODE = os.environ.get("ADMIN_CODE", "ostad123")  # كود الأستاذ (وضع المدرسة الواحدة، ما لم يُغيَّر من الإعدادات)
 SECRET_KEY = os.environ.get("SECRET_KEY", "change-this-secret")
 
-# الأفواج/الأقسام
-CLASS_CHOICES = ["2 ع 1", "3 ع"]
+# مجلد اختياري لحفظ القوالب مترجمة (bytecode) بين تشغيل وآخر
+TEMPLATE_CACHE_DIR = os.environ.get("TEMPLATE_CACHE_DIR")
+
+# تفويض إرسال الملفات للبروكسي الأمامي: "" (Flask يرسلها)، "x-accel" (nginx) أو "x-sendfile" (Apache/lighttpd)
+FILE_OFFLOAD = os.environ.get("FILE_OFFLOAD", "").lower()
+# مسار location الداخلي في nginx المقابل لمجلد uploads/
+ACCEL_REDIRECT_PREFIX = os.environ.get("ACCEL_REDIRECT_PREFIX", "/protected-uploads/")
+
+# القياسات: رمز اختياري لقراءة /metrics من Prometheus، وحدّ تسجيل الطلبات البطيئة (0 = معطّل)
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+SLOW_REQUEST_MS = int(os.environ.get("SLOW_REQUEST_MS", "0"))
+
+# الأفواج/الأقسام: تُحفظ في جدول class_groups لكل مدرسة؛ هذه أفواج القاعدة الجديدة
+DEFAULT_CLASS_GROUPS = ["2 ع 1", "3 ع"]
 
 app = Flask(__name__)
-app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+# Werkzeug يرفض الطلب (413) أثناء القراءة إذا تجاوز الحد، قبل تخزينه كاملًا
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES + 64 * 1024
 app.secret_key = SECRET_KEY
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+
+# أول دالة before_request: التطبيق يُجهَّز (create_app) قبل أي شيء آخر إن لم يُجهَّز بعد،
+# ثم تُحدَّد مدرسة الطلب التي تعمل عليها كل الدوال بعدها
+@app.before_request
+def prepare_app():
+    ensure_app()
+    load_tenant()
+
+# --------------------- القياسات (metrics) ---------------------
+# عدّادات ومدرّجات (histograms) داخل العملية، تُعرض بصيغة Prometheus النصية على /metrics.
+# كل عامل gunicorn له قياساته الخاصة.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+METRICS = {
+    "school_http_request_duration_seconds": ("histogram", "زمن معالجة الطلب حسب المسار"),
+    "school_http_requests_total": ("counter", "عدد الطلبات حسب المسار والحالة"),
+    "school_sql_statements_total": ("counter", "عدد استعلامات SQL حسب المسار"),
+    "school_sql_seconds_total": ("counter", "الزمن المستغرق في SQL حسب المسار"),
+    "school_template_render_seconds": ("histogram", "زمن عرض القوالب"),
+    "school_upload_bytes_total": ("counter", "حجم الملفات المرفوعة"),
+    "school_download_bytes_total": ("counter", "حجم التنزيلات حسب طريقة الإرسال"),
+    "school_group_cache_total": ("counter", "إصابات/إخفاقات ذاكرة ملفات الأفواج"),
+    "school_jobs_total": ("counter", "المهام في الخلفية حسب النوع والنتيجة"),
+    "school_job_duration_seconds": ("histogram", "زمن تنفيذ المهام في الخلفية"),
+    "school_write_batches_total": ("counter", "عدد معاملات الكاتب الواحد (group commit)"),
+    "school_write_ops_total": ("counter", "عدد الكتابات المجمّعة في تلك المعاملات"),
+    "school_tenants_total": ("counter", "المدارس: مفتوحة مسبقًا (hit)، فُتحت (open)، أُغلقت (evict)"),
+}
+_metrics_lock = threading.Lock()
+_counters = defaultdict(float)   # (الاسم، الوسوم) -> القيمة
+_histograms = {}                 # (الاسم، الوسوم) -> [عدّ كل حد..., المجموع، العدد]
+
+def metric_inc(name, labels=(), value=1):
+    with _metrics_lock:
+        _counters[(name, labels)] += value
+
+def metric_observe(name, labels, value):
+    with _metrics_lock:
+        h = _histograms.get((name, labels))
+        if h is None:
+            h = _histograms[(name, labels)] = [0] * (len(LATENCY_BUCKETS) + 2)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                h[i] += 1
+        h[-2] += value
+        h[-1] += 1
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+def render_metrics():
+    lines = []
+    with _metrics_lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((k, list(v)) for k, v in _histograms.items())
+    for name, (kind, help_text) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for (n, labels), value in counters:
+            if n == name:
+                lines.append(f"{name}{_format_labels(labels)} {value:g}")
+        for (n, labels), h in histograms:
+            if n != name:
+                continue
+            for bound, count in zip(LATENCY_BUCKETS, h):
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', f'{bound:g}'),))} {count}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {h[-1]}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {h[-2]:g}")
+            lines.append(f"{name}_count{_format_labels(labels)} {h[-1]}")
+    return "\n".join(lines) + "\n"
+
+class InstrumentedConnection(sqlite3.Connection):
+    """اتصال SQLite يسجّل كل استعلام وزمنه في قائمة الطلب الحالي (g.sql_queries)."""
+
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_params):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+
+    def batches(self, sql, params, size):
+        """الأسطر دفعات من size سطر دون تحميل النتيجة كاملة."""
+        cur = self.execute(sql, params)
+        try:
+            while batch := cur.fetchmany(size):
+                yield batch
+        finally:
+            cur.close()
+
+def record_query(sql, seconds):
+    if has_request_context():
+        queries = g.get("sql_queries")
+        if queries is not None:
+            queries.append((sql, seconds))
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.sql_queries = []
+
+@app.after_request
+def record_request_metrics(resp):
+    start = g.get("request_start")
+    if start is None:
+        return resp
+    elapsed = time.perf_counter() - start
+    route = request.url_rule.rule if request.url_rule else "<unmatched>"
+    labels = (("route", route), ("method", request.method))
+    queries = g.get("sql_queries") or []
+    metric_observe("school_http_request_duration_seconds", labels, elapsed)
+    metric_inc("school_http_requests_total", labels + (("status", str(resp.status_code)),))
+    metric_inc("school_sql_statements_total", (("route", route),), len(queries))
+    metric_inc("school_sql_seconds_total", (("route", route),), sum(t for _, t in queries))
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        app.logger.warning(
+            "slow request %s %s %.1fms, %d queries:\n%s", request.method, request.path,
+            elapsed * 1000, len(queries),
+            "\n".join(f"  {t * 1000:7.2f}ms  {' '.join(sql.split())}" for sql, t in queries)
+        )
+    return resp
+
+def _template_started(sender, template, context, **extra):
+    g.template_start = time.perf_counter()
+
+def _template_finished(sender, template, context, **extra):
+    start = g.pop("template_start", None)
+    if start is not None:
+        metric_observe("school_template_render_seconds", (("template", template.name),),
+                       time.perf_counter() - start)
+
+before_render_template.connect(_template_started, app)
+template_rendered.connect(_template_finished, app)
+
+@app.get("/metrics")
+def metrics():
+    # القياسات للعملية كلها: مع تعدد المدارس لا يكفي أن يكون الزائر أستاذ إحداها
+    authorized = (session.get("is_admin") and not TENANT_MODE) or (
+        METRICS_TOKEN and hmac.compare_digest(request.headers.get("Authorization", ""),
+                                              f"Bearer {METRICS_TOKEN}"))
+    if not authorized:
+        abort(403)
+    return Response(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
 
 # --------------------- قاعدة البيانات ---------------------
-DB_PATH = os.path.join(os.getcwd(), "school.db")
+# DATABASE_URL يختار المحرّك: فارغ أو sqlite:///مسار ← SQLite (الافتراضي: DATA_DIR/school.db)،
+# postgresql://... ← PostgreSQL، فتعمل عدة نسخ من التطبيق على قاعدة واحدة.
+# الاستعلامات نفسها للمحرّكين (معاملات بعلامة ?)، وما يختلف فعلًا (فتح الاتصال، قفل الكتابة،
+# الترحيلات) في SqliteDatabase و PostgresDatabase؛ كائن المدرسة الحالية هو database.
+DATABASE_URL = os.environ.get("DATABASE_URL", "")
+
+# إعدادات SQLite تُطبَّق على كل اتصال جديد
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_KB = int(os.environ.get("DB_CACHE_KB", "20000"))           # ~20MB لكل اتصال
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_STATEMENT_CACHE = 256                                             # عدد الاستعلامات المُحضّرة المحفوظة
+# PostgreSQL: أقصى عدد اتصالات الطلبات المتزامنة في كل عامل (للكاتب وخيوط المهام اتصالاتها الخاصة)
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "10"))
+PG_WRITE_LOCK = 0x5C4001    # مفتاح pg_advisory_xact_lock للكتابة (بديل BEGIN IMMEDIATE)
+PG_MIGRATE_LOCK = 0x5C4002  # ومفتاح الترحيلات
 
 SCHEMA = """
 CREATE TABLE IF NOT EXISTS students (
@@ -61,43 +287,768 @@ CREATE TABLE IF NOT EXISTS assessments (
 );
 """
 
+# تطبيع النص قبل فهرسته في FTS5 وقبل البحث: حذف الحركات، توحيد الألف والياء والتاء المربوطة،
+# ونزع "ال" التعريف وما يسبقها (الدوال/والدوال/بالدوال ← دوال).
+# كل تعديل يبقى داخل الكلمة ولا يحذفها كاملة، فتبقى الكلمات في نفس مواضعها
+# ويُظلِّل highlight() الكلمات في النص الأصلي المحفوظ (انظر tokenchars في الترحيل 8).
+# PostgreSQL: نفس القواعد كدالة SQL في PG_MIGRATIONS.
+ARABIC_MARKS = "".join(map(chr, [*range(0x064B, 0x0660), 0x0670]))
+_ARABIC_MARKS_RE = re.compile(f"(?<=\\w)[{ARABIC_MARKS}]+")
+_ARABIC_LETTERS = str.maketrans("أإآٱىة", "اااايه")
+_ARABIC_ARTICLE_RE = re.compile(r"\b(?:[وفبك]?ال|لل)(?=\w{2})")
+
+def search_normalize(text):
+    text = _ARABIC_MARKS_RE.sub("", text or "").translate(_ARABIC_LETTERS)
+    return _ARABIC_ARTICLE_RE.sub("", text)
+
+class SqliteDatabase:
+    """ملف SQLite واحد؛ اتصال دائم لكل خيط (انظر get_db)."""
+
+    engine = "sqlite"
+    Error = sqlite3.Error
+    IntegrityError = sqlite3.IntegrityError
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                               cached_statements=DB_STATEMENT_CACHE, factory=InstrumentedConnection)
+        conn.row_factory = sqlite3.Row
+        # تستعمله triggers فهرس البحث
+        conn.create_function("search_normalize", 1, search_normalize, deterministic=True)
+        # WAL: القرّاء لا يُوقفون الكاتب (حفظ النقاط أثناء تصفح التلاميذ)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def release(self, conn):
+        # الاتصال يبقى مفتوحًا للطلب التالي، فلا نترك معاملة معلّقة عليه
+        if conn.in_transaction:
+            conn.rollback()
+
+    def close(self, conn):
+        conn.close()
+
+    def begin_write(self, conn):
+        # قفل الكتابة من بداية المعاملة بدل ترقيته في وسطها (database is locked)
+        conn.execute("BEGIN IMMEDIATE")
+
+    def dispose(self):
+        # اتصال كل خيط يُغلق مع المدرسة التي تحمله (Tenant.local) أو مع خيطه
+        pass
+
+    def migrate(self, conn):
+        conn.executescript(SCHEMA)
+        # BEGIN IMMEDIATE يمنع عاملين من تطبيق نفس الترحيل في الوقت نفسه
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            current = conn.execute("PRAGMA user_version").fetchone()[0]
+            for version, statements in enumerate(MIGRATIONS, start=1):
+                if version <= current:
+                    continue
+                for stmt in statements:
+                    conn.execute(stmt)
+                conn.execute(f"PRAGMA user_version={version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+_SQL_LITERAL_RE = re.compile(r"('(?:[^']|'')*')")
+
+@functools.lru_cache(maxsize=1024)
+def pg_sql(sql):
+    """? ← %s خارج النصوص الحرفية، و % ← %% (psycopg2 يستعمل % لمعاملاته)."""
+    parts = _SQL_LITERAL_RE.split(sql)
+    return "".join(part.replace("%", "%%") if i % 2 else part.replace("%", "%%").replace("?", "%s")
+                   for i, part in enumerate(parts))
+
+_cursor_names = itertools.count()
+
+class PgConnection:
+    """اتصال psycopg2 بواجهة sqlite3 التي يستعملها التطبيق: execute/executemany بعلامة ?،
+    أسطر تُقرأ بالاسم وبالرقم، in_transaction، و with conn: للـ commit/rollback."""
+
+    def __init__(self, raw, pool, psycopg2):
+        self.raw = raw
+        self.pool = pool
+        self.psycopg2 = psycopg2
+
+    def cursor(self, name=None):
+        return self.raw.cursor(name=name, cursor_factory=self.psycopg2.extras.DictCursor)
+
+    def execute(self, sql, params=()):
+        cur = self.cursor()
+        start = time.perf_counter()
+        try:
+            if params:
+                cur.execute(pg_sql(sql), tuple(params))
+            else:
+                # بدون معاملات يُرسل النص كما هو (أجسام الدوال في الترحيلات فيها ? و %)
+                cur.execute(sql)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+        return cur
+
+    def executemany(self, sql, seq_of_params):
+        cur = self.cursor()
+        start = time.perf_counter()
+        try:
+            self.psycopg2.extras.execute_batch(cur, pg_sql(sql), seq_of_params, page_size=100)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+        return cur
+
+    def batches(self, sql, params, size):
+        # مؤشر على الخادم (named cursor): الأسطر تصل دفعة دفعة بدل تحميل النتيجة كاملة
+        cur = self.cursor(name=f"batches_{next(_cursor_names)}")
+        cur.itersize = size
+        start = time.perf_counter()
+        try:
+            cur.execute(pg_sql(sql), tuple(params))
+        finally:
+            record_query(sql, time.perf_counter() - start)
+        try:
+            while batch := cur.fetchmany(size):
+                yield batch
+        finally:
+            cur.close()
+
+    @property
+    def in_transaction(self):
+        return self.raw.info.transaction_status != self.psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.raw.commit()
+        else:
+            self.raw.rollback()
+        return False
+
+class PostgresDatabase:
+    """PostgreSQL عبر مجمع اتصالات لكل عامل؛ خيط الطلب يستعير اتصالًا ويعيده في نهاية الطلب."""
+
+    engine = "postgres"
+
+    def __init__(self, url, size, schema=None):
+        # استيراد متأخر: الحزمة لا تُحمَّل إلا إذا اخترنا PostgreSQL
+        import psycopg2
+        import psycopg2.extensions
+        import psycopg2.extras
+        import psycopg2.pool
+        self.psycopg2 = psycopg2
+        self.Error = psycopg2.Error
+        self.IntegrityError = psycopg2.IntegrityError
+        self.url = url
+        self.size = size
+        # مدرسة في وضع تعدد المدارس: مخطط (schema) خاص بها، فتعمل نفس الاستعلامات بلا بادئة،
+        # ومفاتيح أقفال خاصة بها فلا تنتظر كتابات مدرسة أخرى
+        self.schema = schema
+        self.connect_args = {"options": f"-c search_path={schema}"} if schema else {}
+        key = (zlib.crc32(schema.encode()) & 0x7FFFFFFF) << 32 if schema else 0
+        self.write_lock = PG_WRITE_LOCK | key
+        self.migrate_lock = PG_MIGRATE_LOCK | key
+        self.pool = None
+        self.slots = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def ensure_pool(self):
+        # بعد fork (عمّال gunicorn) لا نستعمل اتصالات العملية الأم: مجمع جديد لكل عملية
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pool = self.psycopg2.pool.ThreadedConnectionPool(0, self.size, self.url, **self.connect_args)
+            # ThreadedConnectionPool يرفض الطلب فورًا حين يمتلئ؛ الإشارة تجعل الخيط ينتظر اتصالًا يتحرر
+            self.slots = threading.BoundedSemaphore(self.size)
+            self.pid = os.getpid()
+
+    def connect(self):
+        # خيوط الخلفية (الكاتب، المهام) تحتفظ باتصالها طوال عمرها، فلها اتصال خاص خارج المجمع
+        # ويبقى DB_POOL_SIZE لطلبات HTTP المتزامنة وحدها
+        if not has_request_context():
+            return PgConnection(self.psycopg2.connect(self.url, **self.connect_args), None, self.psycopg2)
+        self.ensure_pool()
+        if not self.slots.acquire(timeout=DB_BUSY_TIMEOUT_MS / 1000):
+            raise self.psycopg2.pool.PoolError(f"no free connection after {DB_BUSY_TIMEOUT_MS} ms")
+        try:
+            return PgConnection(self.pool.getconn(), self.pool, self.psycopg2)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def release(self, conn, close=False):
+        """يعيد اتصال المجمع (True)؛ الاتصال الخاص يبقى لخيطه بلا معاملة معلّقة."""
+        if conn.pool is None:
+            if close:
+                conn.raw.close()
+            elif conn.in_transaction:
+                conn.rollback()
+            return False
+        if conn.pool is self.pool:
+            # المجمع يلغي المعاملة المفتوحة قبل إعطاء الاتصال لخيط آخر
+            self.pool.putconn(conn.raw, close=close)
+            self.slots.release()
+        return True
+
+    def close(self, conn):
+        self.release(conn, close=True)
+
+    def begin_write(self, conn):
+        # كاتب واحد في كل لحظة كما في SQLite، لكن بين كل النسخ التي تشترك في القاعدة
+        conn.execute("SELECT pg_advisory_xact_lock(?)", (self.write_lock,))
+
+    def dispose(self):
+        # مدرسة أُغلقت بلا طلبات جارية: اتصالات المجمع كلها عائدة إليه
+        with self.lock:
+            if self.pid == os.getpid():
+                self.pool.closeall()
+            self.pid = None
+
+    def migrate(self, conn):
+        with conn:
+            conn.execute("SELECT pg_advisory_xact_lock(?)", (self.migrate_lock,))
+            if self.schema:
+                conn.execute(f"CREATE SCHEMA IF NOT EXISTS {self.schema}")
+            conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+            current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+            for version, statements in enumerate(PG_MIGRATIONS, start=1):
+                if version <= current:
+                    continue
+                for stmt in statements:
+                    conn.execute(stmt)
+                conn.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
+
+def make_database(url, data_dir, schema=None):
+    if url.startswith(("postgres://", "postgresql://")):
+        return PostgresDatabase(url, DB_POOL_SIZE, schema)
+    if url and not url.startswith("sqlite:///"):
+        raise ValueError(f"unsupported DATABASE_URL scheme: {url.split(':', 1)[0]}")
+    return SqliteDatabase(url[len("sqlite:///"):] if url else os.path.join(data_dir, "school.db"))
+
+# قاعدة المدرسة الحالية (current_tenant): المدرسة الوحيدة، أو مدرسة الطلب في وضع تعدد المدارس
+database = LocalProxy(lambda: current_tenant().database)
+
+def open_db():
+    return database.connect()
+
+# SQLite: اتصال واحد لكل خيط (thread) ولكل مدرسة يُعاد استعماله بين الطلبات، فتبقى الإعدادات
+# وذاكرة الاستعلامات المُحضّرة حيّة. PostgreSQL: الاتصال يُستعار من المجمع حتى نهاية الطلب.
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    local = current_tenant().local
+    conn = getattr(local, "conn", None)
+    # بعد fork (عمّال gunicorn) لا نستعمل اتصال العملية الأم
+    if conn is None or local.pid != os.getpid():
+        conn = open_db()
+        local.conn = conn
+        local.pid = os.getpid()
     return conn
 
-with get_db() as conn:
-    conn.executescript(SCHEMA)
-    conn.commit()
+def close_db():
+    local = current_tenant().local
+    conn = getattr(local, "conn", None)
+    if conn is not None and local.pid == os.getpid():
+        database.close(conn)
+    local.conn = None
+
+@app.teardown_request
+def release_db(exc):
+    tenant = g.pop("tenant", None)
+    if tenant is None:
+        return
+    local = tenant.local
+    conn = getattr(local, "conn", None)
+    # True: الاتصال عاد إلى مجمع PostgreSQL ولم يعد لهذا الخيط
+    if conn is not None and local.pid == os.getpid() and tenant.database.release(conn):
+        local.conn = None
+    release_tenant(tenant)
+
+# --------------------- المعدلات والترتيب ---------------------
+# المعدل النهائي = (التقويم + معدل الفرضين + 2×الإختبار) / 4، ويُحسب فقط عند اكتمال القيم الأربع
+FINAL_AVG_SQL = """CASE WHEN ca IS NOT NULL AND t1 IS NOT NULL AND t2 IS NOT NULL AND exam IS NOT NULL
+    THEN ROUND((ca + (t1 + t2) / 2.0 + exam * 2) / 4.0, 2) END"""
+
+def class_stats_refresh_sql(group=None, subject=None):
+    """يعيد حساب إحصاءات وترتيب فوج/مادة واحدة، أو كل الأفواج إن لم يُحدَّدا."""
+    if group is None:
+        clear, where = "1", "1"
+    else:
+        clear = f"class_group={group} AND subject={subject}"
+        where = f"s.class_group={group} AND a.subject={subject}"
+    return f"""
+    DELETE FROM class_stats WHERE {clear};
+    INSERT INTO class_stats (class_group, subject, n, mean, min, max)
+        SELECT s.class_group, a.subject, COUNT(*), ROUND(AVG(a.final), 2), MIN(a.final), MAX(a.final)
+        FROM students s JOIN assessments a ON a.student_id=s.id
+        WHERE a.final IS NOT NULL AND {where}
+        GROUP BY s.class_group, a.subject;
+    DELETE FROM class_ranks WHERE {clear};
+    INSERT INTO class_ranks (student_id, class_group, subject, rank)
+        SELECT a.student_id, s.class_group, a.subject,
+               RANK() OVER (PARTITION BY s.class_group, a.subject ORDER BY a.final DESC)
+        FROM students s JOIN assessments a ON a.student_id=s.id
+        WHERE a.final IS NOT NULL AND {where};"""
+
+def class_stats_trigger(name, event, ref):
+    # ref = NEW أو OLD: نعيد حساب فوج ومادة السطر المتغيّر فقط (بضع عشرات من الأسطر)
+    group = f"(SELECT class_group FROM students WHERE id={ref}.student_id)"
+    return (f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON assessments BEGIN"
+            f"{class_stats_refresh_sql(group, f'{ref}.subject')}\nEND")
+
+# --------------------- الترحيلات (migrations) ---------------------
+# إعدادات المدرسة (اسمها، كود الأستاذ...) وأفواجها، بنفس الجمل في المحرّكين. القاعدة القائمة
+# تحتفظ بأفواجها: الافتراضية ثم كل فوج مستعمل (WHERE true: لا يلتبس ON CONFLICT بشرط ربط في SQLite)
+SETTINGS_MIGRATION = [
+    "CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS class_groups (name TEXT PRIMARY KEY, position INTEGER NOT NULL)",
+    "INSERT INTO class_groups (name, position) VALUES " + ", ".join(
+        "('{}', {})".format(name.replace("'", "''"), i) for i, name in enumerate(DEFAULT_CLASS_GROUPS)
+    ) + " ON CONFLICT DO NOTHING",
+    """INSERT INTO class_groups (name, position)
+       SELECT class_group, 1000 FROM (SELECT class_group FROM students UNION SELECT class_group FROM files) AS used
+       WHERE true ON CONFLICT DO NOTHING""",
+]
+
+# كل ترحيل يُنفَّذ مرة واحدة، ورقم آخر ترحيل مُطبَّق يُحفظ في PRAGMA user_version.
+# لا تعدّل ترحيلًا قديمًا؛ أضف ترحيلًا جديدًا في آخر القائمة.
+MIGRATIONS = [
+    # 1: فهارس الاستعلامات الساخنة + تقييم واحد لكل (تلميذ، مادة)
+    [
+        # تنظيف أي تكرار قديم قبل فرض القيد (نُبقي أحدث سطر)
+        """DELETE FROM assessments WHERE id NOT IN (
+               SELECT MAX(id) FROM assessments GROUP BY student_id, subject)""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_assessments_student_subject ON assessments(student_id, subject)",
+        "CREATE INDEX IF NOT EXISTS ix_files_group_id ON files(class_group, id)",
+    ],
+    # 2: تصفية التلاميذ حسب الفوج في لوحة الأستاذ مع الترقيم بالمؤشر
+    [
+        "CREATE INDEX IF NOT EXISTS ix_students_group_id ON students(class_group, id)",
+    ],
+    # 3: المعدل النهائي كعمود مولَّد + إحصاءات وترتيب كل فوج/مادة تُحدَّث بالـ triggers
+    [
+        f"ALTER TABLE assessments ADD COLUMN final REAL GENERATED ALWAYS AS ({FINAL_AVG_SQL}) VIRTUAL",
+        """CREATE TABLE IF NOT EXISTS class_stats (
+               class_group TEXT NOT NULL,
+               subject TEXT NOT NULL,
+               n INTEGER NOT NULL,
+               mean REAL,
+               min REAL,
+               max REAL,
+               PRIMARY KEY (class_group, subject)
+           )""",
+        """CREATE TABLE IF NOT EXISTS class_ranks (
+               student_id INTEGER NOT NULL,
+               class_group TEXT NOT NULL,
+               subject TEXT NOT NULL,
+               rank INTEGER NOT NULL,
+               PRIMARY KEY (student_id, subject)
+           )""",
+        "CREATE INDEX IF NOT EXISTS ix_class_ranks_group_subject ON class_ranks(class_group, subject)",
+        class_stats_trigger("tr_assessments_stats_ins", "INSERT", "NEW"),
+        class_stats_trigger("tr_assessments_stats_upd", "UPDATE OF ca, t1, t2, exam", "NEW"),
+        class_stats_trigger("tr_assessments_stats_del", "DELETE", "OLD"),
+    ] + [stmt for stmt in class_stats_refresh_sql().split(";") if stmt.strip()],
+    # 4: بيانات الملف (الحجم، وقت التعديل، ETag) تُحفظ عند الرفع فلا نحتاج os.stat لكل تنزيل
+    [
+        "ALTER TABLE files ADD COLUMN size INTEGER",
+        "ALTER TABLE files ADD COLUMN mtime REAL",
+        "ALTER TABLE files ADD COLUMN etag TEXT",
+    ],
+    # 5: تخزين حسب المحتوى؛ عدد الأسطر التي تشير إلى نفس البصمة هو عدّاد المراجع
+    [
+        "ALTER TABLE files ADD COLUMN sha256 TEXT",
+        "CREATE INDEX IF NOT EXISTS ix_files_sha256 ON files(sha256)",
+    ],
+    # 6: رقم إصدار لكل فوج يزيد مع كل تغيير في ملفاته (لإبطال الذاكرة في كل العمّال)
+    [
+        """CREATE TABLE IF NOT EXISTS group_versions (
+               class_group TEXT PRIMARY KEY,
+               version INTEGER NOT NULL
+           )""",
+        """CREATE TRIGGER IF NOT EXISTS tr_files_version_ins AFTER INSERT ON files BEGIN
+               INSERT INTO group_versions (class_group, version) VALUES (NEW.class_group, 1)
+               ON CONFLICT(class_group) DO UPDATE SET version = version + 1;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS tr_files_version_del AFTER DELETE ON files BEGIN
+               INSERT INTO group_versions (class_group, version) VALUES (OLD.class_group, 1)
+               ON CONFLICT(class_group) DO UPDATE SET version = version + 1;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS tr_files_version_upd AFTER UPDATE OF title, class_group ON files BEGIN
+               INSERT INTO group_versions (class_group, version) VALUES (OLD.class_group, 1)
+               ON CONFLICT(class_group) DO UPDATE SET version = version + 1;
+               INSERT INTO group_versions (class_group, version) VALUES (NEW.class_group, 1)
+               ON CONFLICT(class_group) DO UPDATE SET version = version + 1;
+           END""",
+    ],
+    # 7: إصدار لنقاط كل فوج (أي تغيير يغيّر المعدلات والترتيب لكل تلاميذ الفوج) لـ ETag لوحة التلميذ
+    [
+        "ALTER TABLE group_versions ADD COLUMN grades_version INTEGER NOT NULL DEFAULT 0",
+        """CREATE TRIGGER IF NOT EXISTS tr_assessments_version_ins AFTER INSERT ON assessments BEGIN
+               INSERT INTO group_versions (class_group, version, grades_version)
+                   SELECT class_group, 0, 1 FROM students WHERE id=NEW.student_id
+               ON CONFLICT(class_group) DO UPDATE SET grades_version = grades_version + 1;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS tr_assessments_version_upd AFTER UPDATE ON assessments BEGIN
+               INSERT INTO group_versions (class_group, version, grades_version)
+                   SELECT class_group, 0, 1 FROM students WHERE id=NEW.student_id
+               ON CONFLICT(class_group) DO UPDATE SET grades_version = grades_version + 1;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS tr_assessments_version_del AFTER DELETE ON assessments BEGIN
+               INSERT INTO group_versions (class_group, version, grades_version)
+                   SELECT class_group, 0, 1 FROM students WHERE id=OLD.student_id
+               ON CONFLICT(class_group) DO UPDATE SET grades_version = grades_version + 1;
+           END""",
+    ],
+    # 8: البحث في عناوين الملفات ونصوصها (FTS5 بمحتوى خارجي في file_texts)
+    [
+        """CREATE TABLE IF NOT EXISTS file_texts (
+               file_id INTEGER PRIMARY KEY,
+               title TEXT NOT NULL,
+               body TEXT NOT NULL DEFAULT ''
+           )""",
+        # الحركات حروف داخل الكلمة (tokenchars) حتى تتطابق مواضع الكلمات بين النص الأصلي والمُطبَّع
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(
+               title, body, content='file_texts', content_rowid='file_id',
+               tokenize="unicode61 remove_diacritics 2 tokenchars '{ARABIC_MARKS}'"
+           )""",
+        """CREATE TRIGGER IF NOT EXISTS tr_file_texts_ins AFTER INSERT ON file_texts BEGIN
+               INSERT INTO files_fts (rowid, title, body)
+               VALUES (NEW.file_id, search_normalize(NEW.title), search_normalize(NEW.body));
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS tr_file_texts_del AFTER DELETE ON file_texts BEGIN
+               INSERT INTO files_fts (files_fts, rowid, title, body)
+               VALUES ('delete', OLD.file_id, search_normalize(OLD.title), search_normalize(OLD.body));
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS tr_files_text_del AFTER DELETE ON files BEGIN
+               DELETE FROM file_texts WHERE file_id=OLD.id;
+           END""",
+        # الملفات الموجودة تُفهرس بعناوينها فقط
+        "INSERT INTO file_texts (file_id, title) SELECT id, title FROM files",
+    ],
+    # 9: طابور المهام في الخلفية (استخراج النص بعد الرفع...)
+    [
+        """CREATE TABLE IF NOT EXISTS jobs (
+               id INTEGER PRIMARY KEY,
+               kind TEXT NOT NULL,
+               payload TEXT NOT NULL,
+               status TEXT NOT NULL DEFAULT 'queued',
+               attempts INTEGER NOT NULL DEFAULT 0,
+               max_attempts INTEGER NOT NULL DEFAULT 3,
+               run_after REAL NOT NULL,
+               locked_at REAL,
+               last_error TEXT,
+               created_at TEXT NOT NULL,
+               finished_at TEXT
+           )""",
+        "CREATE INDEX IF NOT EXISTS ix_jobs_status_run_after ON jobs(status, run_after)",
+        # النص المستخرج يصل بعد إضافة السطر: نحدّث الفهرس بحذف القيم القديمة وإضافة الجديدة
+        """CREATE TRIGGER IF NOT EXISTS tr_file_texts_upd AFTER UPDATE ON file_texts BEGIN
+               INSERT INTO files_fts (files_fts, rowid, title, body)
+               VALUES ('delete', OLD.file_id, search_normalize(OLD.title), search_normalize(OLD.body));
+               INSERT INTO files_fts (rowid, title, body)
+               VALUES (NEW.file_id, search_normalize(NEW.title), search_normalize(NEW.body));
+           END""",
+        # الملفات التي فُهرست بعناوينها فقط في الترحيل 8
+        """INSERT INTO jobs (kind, payload, run_after, created_at)
+           SELECT 'extract_text', json_object('file_id', id), 0, strftime('%Y-%m-%d %H:%M', 'now', 'localtime')
+           FROM files""",
+    ],
+    # 10: سجل التغييرات الذي تقرؤه كل العمّال لدفع الأحداث (SSE) إلى لوحات التلاميذ
+    [
+        """CREATE TABLE IF NOT EXISTS changes (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               channel TEXT NOT NULL,
+               kind TEXT NOT NULL,
+               created_at REAL NOT NULL
+           )""",
+    ],
+    # 11: السنوات المؤرشفة وحدود كل منها (أرشفة قابلة للاستئناف)
+    [
+        """CREATE TABLE IF NOT EXISTS rollovers (
+               school_year TEXT PRIMARY KEY,
+               max_student_id INTEGER NOT NULL,
+               max_file_id INTEGER NOT NULL,
+               started_at TEXT NOT NULL,
+               finished_at TEXT
+           )""",
+    ],
+    # 12: إعدادات المدرسة وأفواجها في القاعدة بدل الثوابت
+    SETTINGS_MIGRATION,
+    # 13: محتوى يُحذف من المخزن خارج معاملة الكتابة (collect_blob)
+    [
+        """CREATE TABLE IF NOT EXISTS blob_gc (
+               sha256 TEXT PRIMARY KEY,
+               state TEXT NOT NULL,
+               since REAL NOT NULL
+           )""",
+    ],
+]
+
+# نفس المخطط في PostgreSQL، بترقيم مستقل يُحفظ في جدول schema_version. يبدأ من حالة SQLite بعد
+# الترحيل 9 دفعة واحدة؛ كل ترحيل جديد في MIGRATIONS يحتاج ما يقابله هنا.
+# الفروق: العمود المولَّد STORED، الـ triggers دوال plpgsql، والبحث عمود tsvector بدل FTS5.
+PG_WORD_CHARS = "0-9A-Za-z_\u0621-\u064a\u0660-\u0669\u066e-\u06d3"  # ما يقابل \w في search_normalize
+
+PG_MIGRATIONS = [
+    # 1: المخطط الكامل
+    [
+        # ROUND(x, 2) على double precision كما في SQLite، فتعمل FINAL_AVG_SQL و class_stats_refresh_sql كما هي
+        """CREATE OR REPLACE FUNCTION round(v DOUBLE PRECISION, digits INTEGER) RETURNS DOUBLE PRECISION
+           LANGUAGE sql IMMUTABLE AS 'SELECT round(v::numeric, digits)::double precision'""",
+        f"""CREATE OR REPLACE FUNCTION search_normalize(t TEXT) RETURNS TEXT LANGUAGE sql IMMUTABLE AS $$
+               SELECT regexp_replace(
+                   translate(regexp_replace(coalesce(t, ''), '([^[:space:]{ARABIC_MARKS}])[{ARABIC_MARKS}]+',
+                                            '\\1', 'g'), 'أإآٱىة', 'اااايه'),
+                   '(^|[^{PG_WORD_CHARS}])(?:[وفبك]?ال|لل)(?=[{PG_WORD_CHARS}]{{2}})', '\\1', 'g')
+           $$""",
+        """CREATE TABLE IF NOT EXISTS students (
+               id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+               name TEXT NOT NULL,
+               code TEXT NOT NULL UNIQUE,
+               class_group TEXT NOT NULL
+           )""",
+        "CREATE INDEX IF NOT EXISTS ix_students_group_id ON students(class_group, id)",
+        """CREATE TABLE IF NOT EXISTS files (
+               id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+               title TEXT NOT NULL,
+               filename TEXT NOT NULL,
+               class_group TEXT NOT NULL,
+               uploaded_at TEXT NOT NULL,
+               size BIGINT,
+               mtime DOUBLE PRECISION,
+               etag TEXT,
+               sha256 TEXT
+           )""",
+        "CREATE INDEX IF NOT EXISTS ix_files_group_id ON files(class_group, id)",
+        "CREATE INDEX IF NOT EXISTS ix_files_sha256 ON files(sha256)",
+        f"""CREATE TABLE IF NOT EXISTS assessments (
+               id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+               student_id INTEGER NOT NULL REFERENCES students(id),
+               subject TEXT NOT NULL,
+               ca DOUBLE PRECISION,
+               t1 DOUBLE PRECISION,
+               t2 DOUBLE PRECISION,
+               exam DOUBLE PRECISION,
+               created_at TEXT NOT NULL,
+               final DOUBLE PRECISION GENERATED ALWAYS AS ({FINAL_AVG_SQL}) STORED
+           )""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_assessments_student_subject ON assessments(student_id, subject)",
+        """CREATE TABLE IF NOT EXISTS class_stats (
+               class_group TEXT NOT NULL,
+               subject TEXT NOT NULL,
+               n INTEGER NOT NULL,
+               mean DOUBLE PRECISION,
+               min DOUBLE PRECISION,
+               max DOUBLE PRECISION,
+               PRIMARY KEY (class_group, subject)
+           )""",
+        """CREATE TABLE IF NOT EXISTS class_ranks (
+               student_id INTEGER NOT NULL,
+               class_group TEXT NOT NULL,
+               subject TEXT NOT NULL,
+               rank INTEGER NOT NULL,
+               PRIMARY KEY (student_id, subject)
+           )""",
+        "CREATE INDEX IF NOT EXISTS ix_class_ranks_group_subject ON class_ranks(class_group, subject)",
+        # كل سطر يسجّل فوجه/مادته في class_stats_pending، والحساب مرة واحدة لكل فوج/مادة عند commit
+        # (قيد مؤجَّل). إعادة الحساب لكل سطر كما في SQLite تتباطأ هنا تربيعيًا مع الاستيراد الكبير:
+        # كل حذف من class_ranks يترك نسخًا ميتة (MVCC) تمر عليها الحسابات التالية في نفس المعاملة.
+        """CREATE TABLE IF NOT EXISTS class_stats_pending (
+               class_group TEXT NOT NULL,
+               subject TEXT NOT NULL,
+               PRIMARY KEY (class_group, subject)
+           )""",
+        """CREATE OR REPLACE FUNCTION assessments_stats() RETURNS trigger LANGUAGE plpgsql AS $$
+           DECLARE r assessments;
+           BEGIN
+               IF TG_OP = 'DELETE' THEN r := OLD; ELSE r := NEW; END IF;
+               INSERT INTO class_stats_pending (class_group, subject)
+                   SELECT class_group, r.subject FROM students WHERE id=r.student_id
+               ON CONFLICT DO NOTHING;
+               RETURN NULL;
+           END $$""",
+        """CREATE TRIGGER tr_assessments_stats AFTER INSERT OR UPDATE OF ca, t1, t2, exam OR DELETE
+           ON assessments FOR EACH ROW EXECUTE FUNCTION assessments_stats()""",
+        f"""CREATE OR REPLACE FUNCTION class_stats_refresh() RETURNS trigger LANGUAGE plpgsql AS $$
+           BEGIN
+               {class_stats_refresh_sql("NEW.class_group", "NEW.subject")}
+               DELETE FROM class_stats_pending WHERE class_group=NEW.class_group AND subject=NEW.subject;
+               RETURN NULL;
+           END $$""",
+        """CREATE CONSTRAINT TRIGGER tr_class_stats_pending AFTER INSERT ON class_stats_pending
+           DEFERRABLE INITIALLY DEFERRED FOR EACH ROW EXECUTE FUNCTION class_stats_refresh()""",
+        """CREATE TABLE IF NOT EXISTS group_versions (
+               class_group TEXT PRIMARY KEY,
+               version INTEGER NOT NULL,
+               grades_version INTEGER NOT NULL DEFAULT 0
+           )""",
+        """CREATE OR REPLACE FUNCTION bump_group_version(g TEXT) RETURNS void LANGUAGE sql AS $$
+               INSERT INTO group_versions (class_group, version) VALUES (g, 1)
+               ON CONFLICT(class_group) DO UPDATE SET version = group_versions.version + 1
+           $$""",
+        """CREATE OR REPLACE FUNCTION files_version() RETURNS trigger LANGUAGE plpgsql AS $$
+           BEGIN
+               IF TG_OP <> 'INSERT' THEN PERFORM bump_group_version(OLD.class_group); END IF;
+               IF TG_OP <> 'DELETE' THEN PERFORM bump_group_version(NEW.class_group); END IF;
+               RETURN NULL;
+           END $$""",
+        """CREATE TRIGGER tr_files_version AFTER INSERT OR UPDATE OF title, class_group OR DELETE
+           ON files FOR EACH ROW EXECUTE FUNCTION files_version()""",
+        """CREATE OR REPLACE FUNCTION assessments_version() RETURNS trigger LANGUAGE plpgsql AS $$
+           DECLARE sid INTEGER;
+           BEGIN
+               IF TG_OP = 'DELETE' THEN sid := OLD.student_id; ELSE sid := NEW.student_id; END IF;
+               INSERT INTO group_versions (class_group, version, grades_version)
+                   SELECT class_group, 0, 1 FROM students WHERE id=sid
+               ON CONFLICT(class_group) DO UPDATE SET grades_version = group_versions.grades_version + 1;
+               RETURN NULL;
+           END $$""",
+        """CREATE TRIGGER tr_assessments_version AFTER INSERT OR UPDATE OR DELETE
+           ON assessments FOR EACH ROW EXECUTE FUNCTION assessments_version()""",
+        # العنوان أثقل من النص في الترتيب (الوزنان A و B في ts_rank)، وحذف الملف يحذف نصه
+        """CREATE TABLE IF NOT EXISTS file_texts (
+               file_id INTEGER PRIMARY KEY REFERENCES files(id) ON DELETE CASCADE,
+               title TEXT NOT NULL,
+               body TEXT NOT NULL DEFAULT '',
+               tsv tsvector GENERATED ALWAYS AS (
+                   setweight(to_tsvector('simple', search_normalize(title)), 'A') ||
+                   setweight(to_tsvector('simple', search_normalize(body)), 'B')) STORED
+           )""",
+        "CREATE INDEX IF NOT EXISTS ix_file_texts_tsv ON file_texts USING gin(tsv)",
+        """CREATE TABLE IF NOT EXISTS jobs (
+               id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+               kind TEXT NOT NULL,
+               payload TEXT NOT NULL,
+               status TEXT NOT NULL DEFAULT 'queued',
+               attempts INTEGER NOT NULL DEFAULT 0,
+               max_attempts INTEGER NOT NULL DEFAULT 3,
+               run_after DOUBLE PRECISION NOT NULL,
+               locked_at DOUBLE PRECISION,
+               last_error TEXT,
+               created_at TEXT NOT NULL,
+               finished_at TEXT
+           )""",
+        "CREATE INDEX IF NOT EXISTS ix_jobs_status_run_after ON jobs(status, run_after)",
+    ],
+    # 2: سجل التغييرات (الترحيل 10 في SQLite)
+    [
+        """CREATE TABLE IF NOT EXISTS changes (
+               id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+               channel TEXT NOT NULL,
+               kind TEXT NOT NULL,
+               created_at DOUBLE PRECISION NOT NULL
+           )""",
+    ],
+    # 3: السنوات المؤرشفة (الترحيل 11 في SQLite)
+    [
+        """CREATE TABLE IF NOT EXISTS rollovers (
+               school_year TEXT PRIMARY KEY,
+               max_student_id INTEGER NOT NULL,
+               max_file_id INTEGER NOT NULL,
+               started_at TEXT NOT NULL,
+               finished_at TEXT
+           )""",
+    ],
+    # 4: إعدادات المدرسة وأفواجها (الترحيل 12 في SQLite)
+    SETTINGS_MIGRATION,
+    # 5: المحتوى المحذوف خارج المعاملة (الترحيل 13 في SQLite)
+    [
+        """CREATE TABLE IF NOT EXISTS blob_gc (
+               sha256 TEXT PRIMARY KEY,
+               state TEXT NOT NULL,
+               since DOUBLE PRECISION NOT NULL
+           )""",
+    ],
+]
+
+# --------------------- القوالب ---------------------
+# كل القوالب تُسجَّل هنا وتُترجم مرة واحدة عند الإقلاع بدل render_template_string في كل طلب
+TEMPLATES = {}
+
+app.jinja_loader = DictLoader(TEMPLATES)
+
+@app.context_processor
+def inject_site_names():
+    settings = school_settings()
+    return {"app_title": settings["app_title"], "school_name": settings["school_name"],
+            "css_fingerprint": CSS_FINGERPRINT}
+
+# بصمة كل القوالب: تتغيّر مع كل نشر جديد، فتدخل في ETag الصفحات حتى لا تبقى بالتصميم القديم
+TEMPLATES_VERSION = ""
+
+def precompile_templates():
+    global TEMPLATES_VERSION
+    # get_template يترجم القالب ويحفظه في ذاكرة Jinja، فلا يُعاد تحليله لاحقًا
+    for name in TEMPLATES:
+        app.jinja_env.get_template(name)
+    TEMPLATES_VERSION = hashlib.sha256(repr(sorted(TEMPLATES.items())).encode()).hexdigest()[:12]
+
+# --------------------- ملف التنسيق (CSS) ---------------------
+# يُخدم كملف مستقل باسم يحوي بصمة محتواه، فيُخزَّن في المتصفح سنة كاملة (immutable)
+# ولا يُعاد إرساله داخل كل صفحة HTML. أي تعديل هنا يغيّر البصمة والرابط تلقائيًا.
+SITE_CSS = """body {font-family: system-ui, Tahoma, Arial; background:#f5f7fb; margin:0}
+header {background:#16a34a; color:white; padding:16px}
+header .wrap, main .wrap {max-width: 1000px; margin: 0 auto}
+a {color:#1f2937; text-decoration:none}
+.card {background:white; border-radius:18px; padding:18px; margin:16px 0; box-shadow:0 6px 18px rgba(0,0,0,.06)}
+.btn {display:inline-block; padding:10px 16px; border-radius:12px; border:1px solid #cbd5e1; background:#111827; color:white; cursor:pointer}
+.btn.secondary{ background:#f1f5f9; color:#111827 }
+.btn.danger{ background:#b91c1c; border-color:#fca5a5 }
+.grid {display:grid; gap:12px}
+.grid.two {grid-template-columns: repeat(auto-fit, minmax(260px, 1fr));}
+input, select, textarea {width:100%; padding:10px; border-radius:10px; border:1px solid #cbd5e1}
+table {width:100%; border-collapse:collapse}
+th, td {padding:10px; border-bottom:1px solid #e5e7eb; text-align:right}
+.muted {color:#6b7280}
+.topbar {display:flex; gap:12px; align-items:center; justify-content:space-between}
+.tag {background:#dcfce7; color:#065f46; padding:4px 8px; border-radius:999px; font-size:12px}
+.flash {background:#fff7ed; border:1px solid #fed7aa; padding:10px; border-radius:10px; margin:10px 0; color:#7c2d12}
+.subtitle {font-size:13px; opacity:.95}
+"""
+SITE_CSS_BYTES = SITE_CSS.encode()
+CSS_FINGERPRINT = hashlib.sha256(SITE_CSS_BYTES).hexdigest()[:12]
+
+def asset_response(body, mimetype, fingerprint, requested):
+    resp = Response(body, mimetype=mimetype)
+    resp.set_etag(fingerprint)
+    if requested == fingerprint:
+        resp.cache_control.public = True
+        resp.cache_control.max_age = 365 * 24 * 3600
+        resp.cache_control.immutable = True
+    else:
+        # صفحة قديمة تطلب بصمة سابقة: نرسل الحالي دون تخزين طويل
+        resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
+
+@app.get("/assets/site.<fingerprint>.css")
+def site_css(fingerprint):
+    return asset_response(SITE_CSS_BYTES, "text/css", CSS_FINGERPRINT, fingerprint)
 
 # --------------------- القالب العام ---------------------
-BASE_HTML = """
+TEMPLATES["base.html"] = """
 <!doctype html>
 <html lang="ar" dir="rtl">
 <head>
 <meta charset="utf-8">
 <meta name="viewport" content="width=device-width, initial-scale=1">
 <title>{{ title or app_title }}</title>
-<style>
-  body {font-family: system-ui, Tahoma, Arial; background:#f5f7fb; margin:0}
-  header {background:#16a34a; color:white; padding:16px}
-  header .wrap, main .wrap {max-width: 1000px; margin: 0 auto}
-  a {color:#1f2937; text-decoration:none}
-  .card {background:white; border-radius:18px; padding:18px; margin:16px 0; box-shadow:0 6px 18px rgba(0,0,0,.06)}
-  .btn {display:inline-block; padding:10px 16px; border-radius:12px; border:1px solid #cbd5e1; background:#111827; color:white; cursor:pointer}
-  .btn.secondary{ background:#f1f5f9; color:#111827 }
-  .btn.danger{ background:#b91c1c; border-color:#fca5a5 }
-  .grid {display:grid; gap:12px}
-  .grid.two {grid-template-columns: repeat(auto-fit, minmax(260px, 1fr));}
-  input, select {width:100%; padding:10px; border-radius:10px; border:1px solid #cbd5e1}
-  table {width:100%; border-collapse:collapse}
-  th, td {padding:10px; border-bottom:1px solid #e5e7eb; text-align:right}
-  .muted {color:#6b7280}
-  .topbar {display:flex; gap:12px; align-items:center; justify-content:space-between}
-  .tag {background:#dcfce7; color:#065f46; padding:4px 8px; border-radius:999px; font-size:12px}
-  .flash {background:#fff7ed; border:1px solid #fed7aa; padding:10px; border-radius:10px; margin:10px 0; color:#7c2d12}
-  .subtitle {font-size:13px; opacity:.95}
-</style>
+<link rel="stylesheet" href="{{ url_for('site_css', fingerprint=css_fingerprint) }}">
 </head>
 <body>
 <header>
@@ -127,7 +1078,7 @@ BASE_HTML = """
         {% for m in messages %}<div class="flash">{{ m }}</div>{% endfor %}
       {% endif %}
     {% endwith %}
-    {{ content|safe }}
+    {% block content %}{% endblock %}
   </div>
 </main>
 </body>
@@ -138,9 +1089,8 @@ def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 # --------------------- الصفحة الرئيسية ---------------------
-@app.route("/")
-def index():
-    content = """
+TEMPLATES["index.html"] = """{% extends "base.html" %}
+{% block content %}
     <div class="card">
       <h2>تسجيل دخول التلميذ</h2>
       <form method="post" action="{{ url_for('student_login') }}" class="grid two">
@@ -162,11 +1112,16 @@ def index():
         </div>
       </form>
     </div>
-    """
-    return render_template_string(
-        BASE_HTML, app_title=APP_TITLE, school_name=SCHOOL_NAME, title=APP_TITLE,
-        content=render_template_string(content, class_choices=CLASS_CHOICES)
-    )
+{% endblock %}
+"""
+
+@app.route("/")
+def index():
+    settings = school_settings()
+    return render_template("index.html", title=settings["app_title"], class_choices=settings["class_groups"])
+
+# الاستعلامات الساخنة ثوابت على مستوى الوحدة: benchmarks/check_query_plans.py يفحص خططها كما تُنفَّذ
+STUDENT_LOGIN_SQL = "SELECT * FROM students WHERE code=? AND class_group=?"
 
 @app.post("/login")
 def student_login():
@@ -176,14 +1131,12 @@ def student_login():
         flash("فضلاً اختر الفوج.")
         return redirect(url_for("index"))
     with get_db() as conn:
-        st = conn.execute(
-            "SELECT * FROM students WHERE code=? AND class_group=?",
-            (code, class_group)
-        ).fetchone()
+        st = conn.execute(STUDENT_LOGIN_SQL, (code, class_group)).fetchone()
     if not st:
         flash("الكود أو الفوج غير صحيح.")
         return redirect(url_for("index"))
     session.clear()
+    session["tenant"] = current_tenant().name
     session["student_id"] = st["id"]
     session["student_name"] = st["name"]
     session["class_group"] = st["class_group"]
@@ -196,41 +1149,9 @@ def logout():
     return redirect(url_for("index"))
 
 # --------------------- لوحة التلميذ ---------------------
-@app.get("/dashboard")
-def student_dashboard():
-    if not session.get("student_id"):
-        return redirect(url_for("index"))
-    sid = session["student_id"]
-    sgroup = session.get("class_group")
-    with get_db() as conn:
-        assessments = conn.execute(
-            "SELECT subject, ca, t1, t2, exam, created_at FROM assessments WHERE student_id=? ORDER BY id DESC",
-            (sid,)
-        ).fetchall()
-        files = conn.execute(
-            "SELECT * FROM files WHERE class_group=? ORDER BY id DESC",
-            (sgroup,)
-        ).fetchall()
-        student = conn.execute("SELECT name FROM students WHERE id=?", (sid,)).fetchone()
-
-    rows = []
-    for a in assessments:
-        ca = a["ca"] if a["ca"] is not None else None
-        t1 = a["t1"] if a["t1"] is not None else None
-        t2 = a["t2"] if a["t2"] is not None else None
-        exam = a["exam"] if a["exam"] is not None else None
-        final_avg = None
-        if ca is not None and t1 is not None and t2 is not None and exam is not None:
-            avg_tests = (float(t1) + float(t2)) / 2.0
-            final_avg = round((float(ca) + avg_tests + (float(exam) * 2)) / 4.0, 2)
-        rows.append({
-            "subject": a["subject"],
-            "ca": ca, "t1": t1, "t2": t2, "exam": exam,
-            "final": final_avg, "created_at": a["created_at"]
-        })
-
-    content = """
-    <div class="card">
+TEMPLATES["student_dashboard.html"] = """{% extends "base.html" %}
+{% block content %}
+    <div class="card" id="grades" data-live>
       <h2>البيانات الدراسية</h2>
       <table>
         <thead>
@@ -242,6 +1163,8 @@ def student_dashboard():
             <th>الفرض الثاني</th>
             <th>الإختبار</th>
             <th>المعدل</th>
+            <th>الترتيب</th>
+            <th>معدل القسم</th>
           </tr>
         </thead>
         <tbody>
@@ -254,16 +1177,33 @@ def student_dashboard():
               <td>{{ r.t2 if r.t2 is not none else '—' }}</td>
               <td>{{ r.exam if r.exam is not none else '—' }}</td>
               <td><strong>{{ r.final if r.final is not none else '—' }}</strong></td>
+              <td>{{ '%d / %d'|format(r.rank, r.n) if r.rank is not none else '—' }}</td>
+              <td>
+                {% if r.mean is not none %}{{ r.mean }} <span class="muted">({{ r.min }} – {{ r.max }})</span>{% else %}—{% endif %}
+              </td>
             </tr>
           {% else %}
-            <tr><td colspan="7" class="muted">لا توجد بيانات لحد الآن.</td></tr>
+            <tr><td colspan="9" class="muted">لا توجد بيانات لحد الآن.</td></tr>
           {% endfor %}
         </tbody>
       </table>
     </div>
 
-    <div class="card">
+    {{ files_html }}
+    {% if live_url %}
+      <div id="live" data-url="{{ live_url }}" hidden></div>
+      <script src="{{ url_for('live_js', fingerprint=live_js_fingerprint) }}" defer></script>
+    {% endif %}
+{% endblock %}
+"""
+
+# قائمة ملفات الفوج جزء مستقل يُخزَّن جاهزًا لكل فوج (انظر group_files)
+TEMPLATES["student_files.html"] = """    <div class="card" id="files" data-live>
       <h3>واجباتي / ملفاتي ({{ class_group }})</h3>
+      <form method="get" action="{{ url_for('search_files') }}" class="grid two">
+        <input type="search" name="q" placeholder="بحث في عناوين الملفات ومحتواها" required />
+        <div><button class="btn secondary" type="submit">بحث</button></div>
+      </form>
       <table>
         <thead><tr><th>العنوان</th><th>التاريخ</th><th>تحميل</th></tr></thead>
         <tbody>
@@ -278,44 +1218,601 @@ def student_dashboard():
         {% endfor %}
         </tbody>
       </table>
+      {% if files %}
+        <p style="text-align:left"><a class="btn" href="{{ url_for('download_group_zip') }}">تنزيل الكل (ZIP)</a></p>
+      {% endif %}
     </div>
-    """
-    return render_template_string(
-        BASE_HTML, app_title=APP_TITLE, school_name=SCHOOL_NAME, title="لوحتي",
-        content=render_template_string(content, rows=rows, files=files,
-                                       class_group=sgroup, student_name=student["name"])
-    )
+"""
+
+# --------------------- ذاكرة الأفواج (cache) ---------------------
+# كل تلاميذ الفوج يرون نفس قائمة الملفات، فنحفظ نتيجة الاستعلام والـ HTML الجاهز لكل فوج.
+# رقم إصدار الفوج (group_versions) يزيده trigger عند كل إضافة/حذف ملف، وهو مشترك بين
+# كل عمّال gunicorn عبر SQLite، فيكفي مقارنته بقراءة واحدة بالمفتاح الأساسي.
+# الذاكرة لكل مدرسة (Tenant.group_cache: class_group -> (version, files, html)).
+GROUP_CACHE_SIZE = int(os.environ.get("GROUP_CACHE_SIZE", "64"))
+
+GROUP_FILES_SQL = "SELECT * FROM files WHERE class_group=? ORDER BY id DESC"
+
+# سطر التلميذ نفسه في الاستعلام: حذفه لا يغيّر إصدار الفوج، فلا يبقى 304 لتلميذ غير موجود
+STUDENT_ETAG_SQL = """SELECT v.version, v.grades_version FROM students s
+                      LEFT JOIN group_versions v ON v.class_group=?
+                      WHERE s.id=?"""
+
+# المعدل والترتيب وإحصاءات القسم محسوبة مسبقًا، فتكفي قراءة بالفهارس
+STUDENT_ROWS_SQL = """SELECT a.subject, a.ca, a.t1, a.t2, a.exam, a.final, a.created_at,
+                             r.rank, cs.n, cs.mean, cs.min, cs.max
+                      FROM assessments a
+                      LEFT JOIN class_ranks r ON r.student_id=a.student_id AND r.subject=a.subject
+                      LEFT JOIN class_stats cs ON cs.class_group=? AND cs.subject=a.subject
+                      WHERE a.student_id=? ORDER BY a.id DESC"""
+
+STUDENT_NAME_SQL = "SELECT name FROM students WHERE id=?"
+
+def group_version(conn, class_group):
+    row = conn.execute("SELECT version FROM group_versions WHERE class_group=?", (class_group,)).fetchone()
+    return row[0] if row else 0
+
+def group_files(conn, class_group):
+    """يُرجع (ملفات الفوج، HTML القائمة)، من الذاكرة ما دام إصدار الفوج لم يتغيّر."""
+    # نقرأ الإصدار قبل الملفات: أي تغيير بينهما يُكتشف في الطلب التالي
+    version = group_version(conn, class_group)
+    tenant = current_tenant()
+    with tenant.group_cache_lock:
+        hit = tenant.group_cache.get(class_group)
+        if hit and hit[0] == version:
+            tenant.group_cache.move_to_end(class_group)
+            metric_inc("school_group_cache_total", (("result", "hit"),))
+            return hit[1], hit[2]
+    metric_inc("school_group_cache_total", (("result", "miss"),))
+    files = [dict(r) for r in conn.execute(GROUP_FILES_SQL, (class_group,))]
+    html = Markup(render_template("student_files.html", files=files, class_group=class_group))
+    with tenant.group_cache_lock:
+        tenant.group_cache[class_group] = (version, files, html)
+        tenant.group_cache.move_to_end(class_group)
+        while len(tenant.group_cache) > GROUP_CACHE_SIZE:
+            tenant.group_cache.popitem(last=False)
+    return files, html
+
+def student_dashboard_etag(conn, sid, class_group):
+    """نسخة بيانات التلميذ: ملفات فوجه + نقاط فوجه (تؤثر في ترتيبه ومعدل القسم) + القوالب واسم الموقع.
+    None إذا لم يعد التلميذ موجودًا (حُذف أو أُرشفت سنته بعد دخوله)."""
+    row = conn.execute(STUDENT_ETAG_SQL, (class_group, sid)).fetchone()
+    if row is None:
+        return None
+    files_v, grades_v = row[0] or 0, row[1] or 0
+    live = "-live" if live_updates_enabled() else ""
+    return f"s{sid}-f{files_v}-g{grades_v}-{TEMPLATES_VERSION}-{school_settings()['fingerprint']}{live}"
+
+@app.get("/dashboard")
+def student_dashboard():
+    if not session.get("student_id"):
+        return redirect(url_for("index"))
+    sid = session["student_id"]
+    sgroup = session.get("class_group")
+    with get_db() as conn:
+        etag = student_dashboard_etag(conn, sid, sgroup)
+    if etag is None:
+        session.clear()
+        return redirect(url_for("index"))
+    # لا 304 إذا كانت هناك رسائل flash تنتظر العرض
+    if request.if_none_match.contains_weak(etag) and not session.get("_flashes"):
+        resp = Response(status=304)
+    else:
+        resp = make_response(render_student_dashboard(sid, sgroup))
+    resp.set_etag(etag)
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    return resp
+
+def render_student_dashboard(sid, sgroup):
+    with get_db() as conn:
+        rows = conn.execute(STUDENT_ROWS_SQL, (sgroup, sid)).fetchall()
+        student = conn.execute(STUDENT_NAME_SQL, (sid,)).fetchone()
+        if student is None:
+            # حُذف التلميذ أو أُرشفت سنته بعد دخوله
+            session.clear()
+            return redirect(url_for("index"))
+        files, files_html = group_files(conn, sgroup)
+
+    live_url = url_for("student_events") if live_updates_enabled() else None
+    return render_template("student_dashboard.html", title="لوحتي", rows=rows, files_html=files_html,
+                           class_group=sgroup, student_name=student["name"],
+                           live_url=live_url, live_js_fingerprint=LIVE_JS_FINGERPRINT)
+
+# --------------------- التحديث المباشر (SSE) ---------------------
+# بدل أن يعيد التلميذ تحميل لوحته لمعرفة الجديد، تفتح اللوحة اتصال EventSource على /events
+# وتُحدّث جدوليها في مكانهما عند وصول حدث. كتابات الأستاذ تضيف سطرًا في جدول changes داخل
+# نفس المعاملة (publish)، على قناة الفوج group:<الفوج> أو قناة التلميذ student:<id>.
+# في كل عامل خيط واحد لكل مدرسة (ChangeHub) يقرأ الأسطر الجديدة من قاعدتها ويوزّعها على
+# الاتصالات المفتوحة عنده، فيصل الحدث مهما كان العامل الذي كتب. ترتيب id هو ترتيب الالتزام
+# لأن الكتابات متسلسلة (قفل SQLite أو pg_advisory_xact_lock في begin_write).
+# كل اتصال SSE مفتوح يحجز خيطًا طوال مدته، لذا LIVE_UPDATES=auto يفعّلها فقط تحت gevent
+# (GUNICORN_WORKER_CLASS=gevent)؛ 1 أو 0 لفرض التفعيل أو التعطيل.
+LIVE_UPDATES = os.environ.get("LIVE_UPDATES", "auto").lower()
+SSE_POLL_SECONDS = float(os.environ.get("SSE_POLL_MS", "1000")) / 1000
+SSE_KEEPALIVE_SECONDS = 15       # تعليق فارغ يُبقي الاتصال حيًّا عبر البروكسي
+SSE_STREAM_SECONDS = 600         # يُغلق الاتصال بعدها ويعيد المتصفح فتحه (لا اتصالات أبدية في العامل)
+SSE_RETRY_MS = 5000
+CHANGES_KEEP = 1000              # عدد الأسطر المحفوظة في changes؛ المتصل الجديد لا يحتاج ما قبله
+
+def live_updates_enabled():
+    if LIVE_UPDATES != "auto":
+        return LIVE_UPDATES == "1"
+    monkey = sys.modules.get("gevent.monkey")
+    return bool(monkey and monkey.is_module_patched("socket"))
+
+def publish(conn, channel, kind):
+    """يُستدعى داخل معاملة الكتابة: الحدث يُرى فقط إذا التزمت المعاملة."""
+    change_id = conn.execute("INSERT INTO changes (channel, kind, created_at) VALUES (?, ?, ?) RETURNING id",
+                             (channel, kind, time.time())).fetchone()[0]
+    if change_id % 100 == 0:
+        conn.execute("DELETE FROM changes WHERE id <= ?", (change_id - CHANGES_KEEP,))
+
+class ChangeHub:
+    """يوزّع أسطر changes الجديدة على طوابير المشتركين في هذه العملية، مرة لكل نوع في كل دورة."""
+
+    def __init__(self, tenant):
+        self.tenant = tenant
+        self.pid = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.subscribers = defaultdict(set)    # channel -> {SimpleQueue}
+
+    def ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.subscribers = defaultdict(set)
+            threading.Thread(target=self.loop, name="change-hub", daemon=True).start()
+            self.pid = os.getpid()
+
+    def stop(self):
+        self.stopped.set()
+
+    def subscribe(self, channels):
+        self.ensure_started()
+        q = queue.SimpleQueue()
+        with self.lock:
+            for channel in channels:
+                self.subscribers[channel].add(q)
+        return q
+
+    def unsubscribe(self, q, channels):
+        with self.lock:
+            for channel in channels:
+                self.subscribers[channel].discard(q)
+                if not self.subscribers[channel]:
+                    del self.subscribers[channel]
+
+    def poll(self, conn, last_id):
+        """يوصل الأحداث الأحدث من last_id ويُرجع آخر id مقروء."""
+        rows = conn.execute("SELECT id, channel, kind FROM changes WHERE id > ? ORDER BY id",
+                            (last_id,)).fetchall()
+        if conn.in_transaction:
+            conn.rollback()  # PostgreSQL: لقطة جديدة في الدورة التالية
+        pending = defaultdict(set)
+        for change_id, channel, kind in rows:
+            pending[channel].add(kind)
+            last_id = change_id
+        with self.lock:
+            deliveries = [(q, kinds) for channel, kinds in pending.items()
+                          for q in self.subscribers.get(channel, ())]
+        for q, kinds in deliveries:
+            for kind in kinds:
+                q.put(kind)
+        return last_id
+
+    def loop(self):
+        with use_tenant(self.tenant):
+            conn = open_db()
+            last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM changes").fetchone()[0]
+            if conn.in_transaction:
+                conn.rollback()
+            while not self.stopped.wait(SSE_POLL_SECONDS):
+                try:
+                    last_id = self.poll(conn, last_id)
+                except database.Error:
+                    app.logger.exception("change hub")
+                    if conn.in_transaction:
+                        conn.rollback()
+            database.close(conn)
+
+change_hub = LocalProxy(lambda: current_tenant().change_hub)
+
+@app.get("/events")
+def student_events():
+    if not session.get("student_id"):
+        abort(403)
+    if not live_updates_enabled():
+        return Response(status=204)  # 204 يوقف EventSource عن إعادة الاتصال
+    channels = (f"group:{session['class_group']}", f"student:{session['student_id']}")
+    q = change_hub.subscribe(channels)
+
+    def stream():
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            deadline = time.monotonic() + SSE_STREAM_SECONDS
+            while time.monotonic() < deadline:
+                try:
+                    kind = q.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {kind}\ndata: {kind}\n\n"
+        finally:
+            change_hub.unsubscribe(q, channels)
+
+    # سياق الطلب يبقى حتى يُغلق الاتصال: المدرسة محجوزة فلا تُغلق ذاكرتها والاتصال مفتوح عليها
+    resp = Response(stream_with_context(stream()), mimetype="text/event-stream")
+    resp.cache_control.no_cache = True
+    resp.headers["X-Accel-Buffering"] = "no"  # nginx: لا تخزين مؤقت للأحداث
+    return resp
+
+# يطلب اللوحة نفسها (ETag: 304 إن لم يتغيّر شيء) ويستبدل العناصر [data-live] بنظيراتها الجديدة.
+# الأحداث المتقاربة تُجمع في طلب واحد، مع تأخير عشوائي حتى لا يطلب كل الفوج في نفس اللحظة.
+LIVE_JS = """(function () {
+  var live = document.getElementById("live");
+  if (!live || !window.EventSource || !window.fetch) return;
+  var timer = null;
+  function refresh() {
+    timer = null;
+    fetch(location.href, {credentials: "same-origin", cache: "no-cache"})
+      .then(function (r) { return r.ok ? r.text() : null; })
+      .then(function (html) {
+        if (!html) return;
+        var doc = new DOMParser().parseFromString(html, "text/html");
+        document.querySelectorAll("[data-live]").forEach(function (el) {
+          var fresh = doc.getElementById(el.id);
+          if (fresh) el.replaceWith(fresh);
+        });
+      });
+  }
+  function schedule(spread) {
+    if (!timer) timer = setTimeout(refresh, Math.random() * spread);
+  }
+  var source = new EventSource(live.dataset.url);
+  var connected = false;
+  source.onopen = function () {
+    // بعد انقطاع قد تكون فاتتنا أحداث: نتحقق مرة (غالبًا 304)
+    if (connected) schedule(1000);
+    connected = true;
+  };
+  source.addEventListener("grades", function () { schedule(300); });
+  source.addEventListener("class_grades", function () { schedule(2000); });
+  source.addEventListener("files", function () { schedule(2000); });
+})();
+"""
+LIVE_JS_BYTES = LIVE_JS.encode()
+LIVE_JS_FINGERPRINT = hashlib.sha256(LIVE_JS_BYTES).hexdigest()[:12]
+
+@app.get("/assets/live.<fingerprint>.js")
+def live_js(fingerprint):
+    return asset_response(LIVE_JS_BYTES, "text/javascript", LIVE_JS_FINGERPRINT, fingerprint)
+
+# --------------------- التخزين ---------------------
+# كل الملفات الجديدة تمر عبر واجهة واحدة: save / open / delete / signed_url.
+# المفتاح (key) هو بصمة SHA-256 للمحتوى. save و delete قد تكونان بطيئتين (مخزن بعيد)، فلا تُستدعيان
+# داخل معاملة كتابة: الرفع قبلها، والحذف بعد commit عبر collect_blob.
+class LocalStorage:
+    """قرص الخادم (uploads/blobs). لا روابط موقّعة: Flask أو البروكسي يرسل الملف بنفسه."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def save(self, key, tmp):
+        # الملف المؤقت يبقى لمن استدعى (رابط صلب لا نسخة)؛ المحتوى الموجود مسبقًا لا يُعاد كتابته
+        path = self.path(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                os.link(tmp, path)
+            except FileExistsError:
+                pass
+
+    def open(self, key):
+        return open(self.path(key), "rb")
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def local_path(self, key):
+        return self.path(key)
+
+    def signed_url(self, key, filename, expires_in):
+        return None
+
+class FakeRemoteStorage(LocalStorage):
+    """بديل محلي لمخزن بعيد للتجربة: لا مسار محلي، والتنزيل عبر رابط موقّع مؤقت يخدمه /storage/."""
+
+    def local_path(self, key):
+        return None
+
+    def signed_url(self, key, filename, expires_in):
+        expires = int(time.time()) + expires_in
+        return url_for("fake_storage_download", key=key, filename=filename, expires=expires,
+                       sig=storage_signature(key, filename, expires))
+
+class CloudinaryStorage:
+    """ملفات raw خاصة على Cloudinary (الإعداد من CLOUDINARY_URL). التنزيل برابط موقّع مؤقت."""
+
+    def __init__(self, folder="school-app"):
+        # استيراد متأخر: الحزمة لا تُحمَّل إلا إذا اخترنا هذا المخزن
+        import cloudinary.api
+        import cloudinary.uploader
+        import cloudinary.utils
+        self.cloudinary = cloudinary
+        self.folder = folder
+
+    def public_id(self, key):
+        return f"{self.folder}/{key}"
+
+    def exists(self, key):
+        try:
+            self.cloudinary.api.resource(self.public_id(key), resource_type="raw", type="private")
+            return True
+        except self.cloudinary.exceptions.NotFound:
+            return False
+
+    def save(self, key, tmp):
+        self.cloudinary.uploader.upload(tmp, public_id=self.public_id(key), resource_type="raw",
+                                        type="private", overwrite=False)
+
+    def open(self, key):
+        import urllib.request  # يجلب ssl و http.client: لا يُحمَّل إلا مع هذا المخزن
+        return urllib.request.urlopen(self.signed_url(key, key, 60))
+
+    def delete(self, key):
+        self.cloudinary.uploader.destroy(self.public_id(key), resource_type="raw", type="private",
+                                         invalidate=True)
+
+    def local_path(self, key):
+        return None
+
+    def signed_url(self, key, filename, expires_in):
+        return self.cloudinary.utils.private_download_url(
+            self.public_id(key), "", resource_type="raw", type="private",
+            expires_at=int(time.time()) + expires_in, attachment=True)
+
+def make_storage(backend, tenant):
+    if backend == "cloudinary":
+        return CloudinaryStorage(f"school-app/{tenant.name}" if tenant.name else "school-app")
+    if backend == "fake":
+        return FakeRemoteStorage(os.path.join(tenant.upload_folder, "fake-remote"))
+    return LocalStorage(tenant.blob_folder)
+
+def storage_signature(key, filename, expires):
+    msg = f"{key}:{filename}:{expires}".encode()
+    return hmac.new(SECRET_KEY.encode(), msg, hashlib.sha256).hexdigest()
+
+storage = LocalProxy(lambda: current_tenant().storage)  # مخزن المدرسة الحالية
+
+@app.get("/storage/<key>")
+def fake_storage_download(key):
+    # يحاكي المخزن البعيد: لا جلسة، فقط توقيع صالح وغير منتهٍ
+    if not isinstance(storage, FakeRemoteStorage):
+        abort(404)
+    filename = request.args.get("filename", "")
+    expires = request.args.get("expires", 0, type=int)
+    sig = request.args.get("sig", "")
+    if expires < time.time() or not hmac.compare_digest(sig, storage_signature(key, filename, expires)):
+        abort(403)
+    try:
+        return send_file(storage.path(key), as_attachment=True, download_name=filename, conditional=True)
+    except FileNotFoundError:
+        abort(404)
 
 # --------------------- تنزيل ملف ---------------------
+def legacy_path(f):
+    # الملفات القديمة (قبل التخزين حسب المحتوى) محفوظة باسمها مباشرة في uploads/
+    return os.path.join(current_tenant().upload_folder, f["filename"])
+
+def file_metadata(path):
+    st = os.stat(path)
+    # ETag قوي من الحجم ووقت التعديل (بالنانوثانية) مثل خوادم الملفات
+    return st.st_size, st.st_mtime, f"{st.st_size:x}-{st.st_mtime_ns:x}"
+
+FILE_SQL = "SELECT * FROM files WHERE id=?"
+
 @app.get("/download/<int:file_id>")
 def download_file(file_id):
     if not session.get("student_id") and not session.get("is_admin"):
         flash("فضلاً سجّل الدخول أولاً.")
         return redirect(url_for("index"))
     with get_db() as conn:
-        f = conn.execute("SELECT * FROM files WHERE id=?", (file_id,)).fetchone()
+        f = conn.execute(FILE_SQL, (file_id,)).fetchone()
     if not f:
         abort(404)
     if session.get("student_id") and f["class_group"] != session.get("class_group"):
         abort(403)
-    filepath = os.path.join(UPLOAD_FOLDER, f["filename"])
-    if not os.path.exists(filepath):
-        abort(404)
-    return send_from_directory(app.config['UPLOAD_FOLDER'], f['filename'], as_attachment=True)
+    if f["etag"] is None:
+        # ملف رُفع قبل حفظ البيانات الوصفية: نحسبها مرة واحدة ونحفظها
+        try:
+            size, mtime, etag = file_metadata(legacy_path(f))
+        except FileNotFoundError:
+            abort(404)
+        db_write(lambda conn: conn.execute("UPDATE files SET size=?, mtime=?, etag=? WHERE id=?",
+                                           (size, mtime, etag, file_id)))
+    else:
+        size, mtime, etag = f["size"], f["mtime"], f["etag"]
+    return send_stored_file(f, size, mtime, etag)
 
-# --------------------- دخول الأستاذ ---------------------
-@app.route("/admin", methods=["GET", "POST"])
-def admin_login():
-    if request.method == "POST":
-        code = request.form.get("code", "").strip()
-        if code == ADMIN_CODE:
-            session.clear()
-            session["is_admin"] = True
-            return redirect(url_for("admin_dashboard"))
-        flash("كود الأستاذ غير صحيح.")
-        return redirect(url_for("admin_login"))
+def send_stored_file(f, size, mtime, etag):
+    """يرسل محتوى سطر ملف (من files أو من أرشيف سنة) بعد التحقق من صلاحية الزائر."""
+    path = storage.local_path(f["sha256"]) if f["sha256"] else legacy_path(f)
+    last_modified = datetime.fromtimestamp(mtime, timezone.utc)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        resp = Response(status=304)
+    elif path is None:
+        # مخزن بعيد: تحويل إلى رابط موقّع مؤقت، فلا تمر البايتات عبر عمّال Flask
+        resp = redirect(storage.signed_url(f["sha256"], f["filename"], SIGNED_URL_TTL))
+        metric_inc("school_download_bytes_total", (("mode", "redirect"),), size or 0)
+        resp.cache_control.private = True
+        resp.cache_control.no_store = True
+        return resp
+    elif FILE_OFFLOAD in ("x-accel", "x-sendfile"):
+        # التطبيق يتحقق من الصلاحية فقط، والبروكسي يرسل البايتات (مع Range و 304)
+        resp = Response(mimetype=mimetypes.guess_type(f["filename"])[0] or "application/octet-stream")
+        if FILE_OFFLOAD == "x-accel":
+            # location في nginx يقابل uploads/ للمدرسة الوحيدة، أو tenants/ مع تعدد المدارس
+            root = TENANTS_DIR if TENANT_MODE else current_tenant().upload_folder
+            rel = os.path.relpath(path, root).replace(os.sep, "/")
+            resp.headers["X-Accel-Redirect"] = ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + rel
+        else:
+            resp.headers["X-Sendfile"] = path
+        resp.headers["Content-Disposition"] = f'attachment; filename="{f["filename"]}"'
+        metric_inc("school_download_bytes_total", (("mode", "proxy"),), size or 0)
+    else:
+        # conditional=True: يعالج Range (206) و If-Range
+        try:
+            resp = send_file(path, as_attachment=True, download_name=f["filename"],
+                             etag=etag, last_modified=last_modified, conditional=True, max_age=0)
+        except FileNotFoundError:
+            abort(404)
+        metric_inc("school_download_bytes_total", (("mode", "app"),), resp.content_length or 0)
+    resp.set_etag(etag)
+    resp.last_modified = last_modified
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    return resp
+
+# --------------------- تنزيل كل ملفات الفوج (ZIP) ---------------------
+# أرشيف ZIP يُبنى أثناء الإرسال: كل ملف يُقرأ على دفعات ويُكتب مباشرة في الرد، فلا يُحمَّل
+# الأرشيف كاملًا في الذاكرة ولا على القرص. PDF و DOCX مضغوطة أصلًا فتُخزَّن كما هي (ZIP_STORED).
+# مع ZIP_CACHE=1 تُحفظ نسخة من الأرشيف المكتمل لكل إصدار فوج وتُرسل كملف عادي (Range و 304).
+ZIP_CACHE = os.environ.get("ZIP_CACHE", "") == "1"   # في uploads/bundles لكل مدرسة
+ZIP_STORED_EXTENSIONS = {"pdf", "docx"}
+
+class ChunkSink(io.RawIOBase):
+    """ملف كتابة فقط يجمع البايتات حتى تُسحب بـ drain()؛ يسمح لـ zipfile و csv بالكتابة داخل generator."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
 
-    content = """
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def zip_entry_names(files):
+    """اسم كل ملف داخل الأرشيف من عنوانه (اسم الملف المحفوظ قد لا يبقى منه إلا الامتداد)."""
+    seen = set()
+    for f in files:
+        ext = f["filename"].rsplit(".", 1)[-1].lower()
+        base = "".join(ch if ch.isprintable() and ch not in '/\\:*?"<>|' else "_" for ch in f["title"]).strip()
+        base = base or f"file-{f['id']}"
+        name, n = f"{base}.{ext}", 2
+        while name in seen:
+            name, n = f"{base} ({n}).{ext}", n + 1
+        seen.add(name)
+        yield f, name, ext
+
+def iter_group_zip(files):
+    sink = ChunkSink()
+    with zipfile.ZipFile(sink, "w") as zf:
+        for f, name, ext in zip_entry_names(files):
+            try:
+                src = storage.open(f["sha256"]) if f["sha256"] else open(legacy_path(f), "rb")
+            except OSError:
+                app.logger.warning("zip bundle: file %s missing from storage, skipped", f["id"])
+                continue
+            info = zipfile.ZipInfo(name, time.localtime(max(f["mtime"] or time.time(), 315532800))[:6])
+            info.compress_type = zipfile.ZIP_STORED if ext in ZIP_STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+            with src, zf.open(info, "w") as out:
+                while chunk := src.read(UPLOAD_CHUNK):
+                    out.write(chunk)
+                    yield sink.drain()
+    yield sink.drain()
+
+def bundle_path(class_group, version):
+    return os.path.join(current_tenant().bundle_folder, f"{hashlib.sha256(class_group.encode()).hexdigest()[:16]}-v{version}.zip")
+
+def tee_to_bundle(chunks, path):
+    """ينسخ الأرشيف المتدفق إلى ملف مؤقت، ولا يعتمده إلا إذا اكتمل الإرسال."""
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in chunks:
+                out.write(chunk)
+                yield chunk
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    # إصدارات الفوج القديمة لم تعد تُطلب
+    prefix = os.path.basename(path).rsplit("-v", 1)[0] + "-v"
+    for name in os.listdir(folder):
+        if name.startswith(prefix) and name != os.path.basename(path):
+            try:
+                os.remove(os.path.join(folder, name))
+            except FileNotFoundError:
+                pass
+
+def count_download_bytes(chunks, mode):
+    for chunk in chunks:
+        metric_inc("school_download_bytes_total", (("mode", mode),), len(chunk))
+        yield chunk
+
+@app.get("/download/all")
+def download_group_zip():
+    if session.get("student_id"):
+        class_group = session.get("class_group")
+    elif session.get("is_admin"):
+        class_group = request.args.get("class_group", "").strip()
+    else:
+        flash("فضلاً سجّل الدخول أولاً.")
+        return redirect(url_for("index"))
+    with get_db() as conn:
+        # الإصدار قبل القائمة كما في group_files
+        version = group_version(conn, class_group)
+        files, _ = group_files(conn, class_group)
+    if not files:
+        flash("لا توجد ملفات لهذا الفوج.")
+        return redirect(url_for("student_dashboard" if session.get("student_id") else "admin_dashboard"))
+
+    etag = f"zip-{hashlib.sha256(class_group.encode()).hexdigest()[:16]}-v{version}"
+    download_name = f"{class_group}.zip"
+    path = bundle_path(class_group, version) if ZIP_CACHE else None
+    if path and os.path.exists(path):
+        resp = send_file(path, mimetype="application/zip", as_attachment=True, download_name=download_name,
+                         etag=etag, conditional=True, max_age=0)
+        metric_inc("school_download_bytes_total", (("mode", "zip-cache"),), resp.content_length or 0)
+    elif not is_resource_modified(request.environ, etag=etag):
+        resp = Response(status=304)
+    else:
+        chunks = iter_group_zip(files)
+        if path:
+            chunks = tee_to_bundle(chunks, path)
+        resp = Response(tenant_stream(count_download_bytes(chunks, "zip")), mimetype="application/zip")
+        resp.headers["Content-Disposition"] = (
+            f"attachment; filename=files.zip; filename*=UTF-8''{urllib.parse.quote(download_name)}")
+    resp.set_etag(etag)
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    return resp
+
+# --------------------- دخول الأستاذ ---------------------
+TEMPLATES["admin_login.html"] = """{% extends "base.html" %}
+{% block content %}
     <div class="card">
       <h2>دخول الأستاذ</h2>
       <form method="post" class="grid two">
@@ -328,27 +1825,38 @@ def admin_login():
         </div>
       </form>
     </div>
-    """
-    return render_template_string(BASE_HTML, app_title=APP_TITLE, school_name=SCHOOL_NAME,
-                                  title="دخول الأستاذ", content=content)
+{% endblock %}
+"""
 
-# --------------------- لوحة الأستاذ ---------------------
-@app.get("/admin/dashboard")
-def admin_dashboard():
-    if not session.get("is_admin"):
+@app.route("/admin", methods=["GET", "POST"])
+def admin_login():
+    if request.method == "POST":
+        code = request.form.get("code", "").strip()
+        if check_admin_code(code):
+            session.clear()
+            session["tenant"] = current_tenant().name
+            session["is_admin"] = True
+            return redirect(url_for("admin_dashboard"))
+        flash("كود الأستاذ غير صحيح.")
         return redirect(url_for("admin_login"))
-    with get_db() as conn:
-        students = conn.execute("SELECT * FROM students ORDER BY id DESC").fetchall()
-        files = conn.execute("SELECT * FROM files ORDER BY id DESC").fetchall()
-        last_assess = conn.execute(
-            """SELECT assessments.*, students.name AS sname
-               FROM assessments JOIN students ON students.id=assessments.student_id
-               ORDER BY assessments.id DESC LIMIT 10"""
-        ).fetchall()
+    return render_template("admin_login.html", title="دخول الأستاذ")
 
-    content = """
+# --------------------- لوحة الأستاذ ---------------------
+TEMPLATES["admin_dashboard.html"] = """{% extends "base.html" %}
+{% block content %}
     <div class="card">
-      <h2>لوحة التحكم</h2>
+      <div class="topbar">
+        <h2>لوحة التحكم</h2>
+        <div>
+          <a class="btn secondary" href="{{ url_for('admin_grades') }}">إدخال النقاط جماعيًا / استيراد</a>
+          <a class="btn secondary" href="{{ url_for('admin_archive') }}">الأرشيف</a>
+          <a class="btn secondary" href="{{ url_for('admin_settings') }}">الإعدادات</a>
+        </div>
+      </div>
+      <form method="get" action="{{ url_for('search_files') }}" class="grid two">
+        <input type="search" name="q" placeholder="بحث في عناوين الملفات ومحتواها" required />
+        <div><button class="btn secondary" type="submit">بحث في الملفات</button></div>
+      </form>
       <div class="grid two">
         <div>
           <h3>إضافة / إدارة التلاميذ</h3>
@@ -375,11 +1883,23 @@ def admin_dashboard():
           </form>
 
           <h4>التلاميذ</h4>
+          <form method="get" class="grid two">
+            <select name="class_group">
+              <option value="">كل الأفواج</option>
+              {% for c in class_choices %}
+                <option value="{{ c }}" {% if c == class_group %}selected{% endif %}>{{ c }}</option>
+              {% endfor %}
+            </select>
+            <input type="search" name="q" value="{{ q }}" placeholder="بحث بالاسم أو الكود" />
+            <div style="grid-column:1 / -1; text-align:left">
+              <button class="btn secondary" type="submit">تصفية</button>
+            </div>
+          </form>
           <table>
             <thead>
               <tr>
                 <th>الإسم و اللقب</th><th>الكود</th><th>الفوج</th>
-                <th>إضافة تقييم/اختبار</th><th>حذف</th>
+                <th>تقييم/اختبار</th><th>حذف</th>
               </tr>
             </thead>
             <tbody>
@@ -388,16 +1908,7 @@ def admin_dashboard():
                 <td>{{ s['name'] }}</td>
                 <td><code>{{ s['code'] }}</code></td>
                 <td>{{ s['class_group'] }}</td>
-                <td>
-                  <form method="post" action="{{ url_for('admin_add_assessment', student_id=s['id']) }}" class="grid two">
-                    <input type="text" name="subject" placeholder="المادة" required />
-                    <input type="number" step="0.01" name="ca"   placeholder="التقويم (اختياري)" />
-                    <input type="number" step="0.01" name="t1"   placeholder="الفرض 1 (اختياري)" />
-                    <input type="number" step="0.01" name="t2"   placeholder="الفرض 2 (اختياري)" />
-                    <input type="number" step="0.01" name="exam" placeholder="الإختبار (اختياري)" />
-                    <button class="btn" type="submit">حفظ / تحديث</button>
-                  </form>
-                </td>
+                <td><a class="btn secondary" href="{{ url_for('admin_student', student_id=s['id']) }}">القيّمات</a></td>
                 <td>
                   <form method="post"
                         action="{{ url_for('admin_delete_student', student_id=s['id']) }}"
@@ -411,6 +1922,11 @@ def admin_dashboard():
             {% endfor %}
             </tbody>
           </table>
+          <p>
+            {% if before %}<a class="btn secondary" href="{{ page_url(before=None) }}">الأولى</a>{% endif %}
+            {% if students_prev %}<a class="btn secondary" href="{{ page_url(before=students_prev) }}">السابق</a>{% endif %}
+            {% if students_next %}<a class="btn secondary" href="{{ page_url(before=students_next) }}">التالي</a>{% endif %}
+          </p>
         </div>
 
         <div>
@@ -458,6 +1974,11 @@ def admin_dashboard():
             {% endfor %}
             </tbody>
           </table>
+          <p>
+            {% if files_before %}<a class="btn secondary" href="{{ page_url(files_before=None) }}">الأولى</a>{% endif %}
+            {% if files_prev %}<a class="btn secondary" href="{{ page_url(files_before=files_prev) }}">السابق</a>{% endif %}
+            {% if files_next %}<a class="btn secondary" href="{{ page_url(files_before=files_next) }}">التالي</a>{% endif %}
+          </p>
 
           <h4>آخر القيّمات المُضافة</h4>
           <table>
@@ -481,12 +2002,345 @@ def admin_dashboard():
         </div>
       </div>
     </div>
-    """
-    return render_template_string(
-        BASE_HTML, app_title=APP_TITLE, school_name=SCHOOL_NAME, title="لوحة التحكم",
-        content=render_template_string(content, students=students, files=files,
-                                      last_assess=last_assess, class_choices=CLASS_CHOICES)
-    )
+
+    <div class="card">
+      <h3>المهام في الخلفية</h3>
+      <p class="muted">
+        في الانتظار: {{ job_counts.get('queued', 0) }} — قيد التنفيذ: {{ job_counts.get('running', 0) }}
+        — منجزة: {{ job_counts.get('done', 0) }} — فاشلة: <strong>{{ job_counts.get('failed', 0) }}</strong>
+      </p>
+      <table>
+        <thead><tr><th>#</th><th>النوع</th><th>الحالة</th><th>المحاولات</th><th>الخطأ</th><th>التاريخ</th><th></th></tr></thead>
+        <tbody>
+        {% for j in recent_jobs %}
+          <tr>
+            <td>{{ j['id'] }}</td>
+            <td><code>{{ j['kind'] }}</code> <span class="muted">{{ j['payload'] }}</span></td>
+            <td>{% if j['status'] == 'failed' %}<strong>{{ j['status'] }}</strong>{% else %}<span class="tag">{{ j['status'] }}</span>{% endif %}</td>
+            <td>{{ j['attempts'] }} / {{ j['max_attempts'] }}</td>
+            <td class="muted">{{ j['last_error'] or '' }}</td>
+            <td class="muted">{{ j['created_at'] }}</td>
+            <td>
+              {% if j['status'] == 'failed' %}
+                <form method="post" action="{{ url_for('admin_retry_job', job_id=j['id']) }}">
+                  <button class="btn secondary" type="submit">إعادة</button>
+                </form>
+              {% endif %}
+            </td>
+          </tr>
+        {% else %}
+          <tr><td colspan="7" class="muted">لا توجد مهام.</td></tr>
+        {% endfor %}
+        </tbody>
+      </table>
+    </div>
+{% endblock %}
+"""
+
+# ترقيم الصفحات بالمؤشر (keyset) على id: حجم الصفحة ثابت مهما كبر عدد التلاميذ
+PAGE_SIZE = 50
+
+def keyset_sql(sql, where, before):
+    """صفحة ORDER BY id DESC؛ المعاملات: معاملات where، ثم المؤشر إن وُجد، ثم الحد."""
+    where = [*where, "id < ?"] if before else list(where)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return sql + " ORDER BY id DESC LIMIT ?"
+
+def keyset_prev_sql(table, where):
+    """مؤشر الصفحة السابقة: أول id بعد الـ PAGE_SIZE سطرًا التي تعلو الصفحة الحالية؛ المعاملات: where، ثم id، ثم الإزاحة."""
+    return (f"SELECT id FROM {table} WHERE " + " AND ".join([*where, "id > ?"])
+            + " ORDER BY id LIMIT 1 OFFSET ?")
+
+def keyset_page(conn, table, where, params, before):
+    """يُرجع (الأسطر، مؤشر التالية أو None، مؤشر السابقة أو None) لـ ORDER BY id DESC.
+    مؤشر السابقة None مع before: الصفحة السابقة هي الأولى."""
+    rows = conn.execute(keyset_sql(f"SELECT * FROM {table}", where, before),
+                        (*params, *([before] if before else []), PAGE_SIZE + 1)).fetchall()
+    next_before = rows[PAGE_SIZE - 1]["id"] if len(rows) > PAGE_SIZE else None
+    prev_before = None
+    if before:
+        # صفحة فارغة (مؤشر بعد آخر سطر): السابقة تنتهي عند المؤشر نفسه
+        top = rows[0]["id"] if rows else before - 1
+        prev = conn.execute(keyset_prev_sql(table, where), (*params, top, PAGE_SIZE)).fetchone()
+        prev_before = prev[0] if prev else None
+    return rows[:PAGE_SIZE], next_before, prev_before
+
+@app.get("/admin/dashboard")
+def admin_dashboard():
+    if not session.get("is_admin"):
+        return redirect(url_for("admin_login"))
+    class_group = request.args.get("class_group", "").strip()
+    q = request.args.get("q", "").strip()
+    before = request.args.get("before", type=int)
+    files_before = request.args.get("files_before", type=int)
+
+    where, params = [], []
+    if class_group:
+        where.append("class_group=?")
+        params.append(class_group)
+    student_where, student_params = list(where), list(params)
+    if q:
+        student_where.append("(name LIKE ? OR code=?)")
+        student_params += [f"%{q}%", q]
+
+    def page_url(**changes):
+        # كل رابط صفحة يحمل حالة القائمتين معًا: التنقل في إحداهما لا يُرجع الأخرى إلى أولها
+        state = {"class_group": class_group or None, "q": q or None,
+                 "before": before, "files_before": files_before}
+        return url_for("admin_dashboard", **{**state, **changes})
+
+    with get_db() as conn:
+        students, students_next, students_prev = keyset_page(conn, "students", student_where, student_params,
+                                                             before)
+        files, files_next, files_prev = keyset_page(conn, "files", where, params, files_before)
+        last_assess = conn.execute(
+            """SELECT assessments.*, students.name AS sname
+               FROM assessments JOIN students ON students.id=assessments.student_id
+               ORDER BY assessments.id DESC LIMIT 10"""
+        ).fetchall()
+        job_counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        # الفاشلة أولًا حتى لا تختفي تحت المهام المنجزة
+        recent_jobs = conn.execute(
+            """SELECT * FROM (SELECT * FROM jobs WHERE status='failed' ORDER BY id DESC LIMIT 10) AS failed
+               UNION ALL
+               SELECT * FROM (SELECT * FROM jobs WHERE status!='failed' ORDER BY id DESC LIMIT 10) AS other"""
+        ).fetchall()
+
+    return render_template("admin_dashboard.html", title="لوحة التحكم", students=students,
+                           files=files, last_assess=last_assess, class_choices=class_choices(),
+                           job_counts=job_counts, recent_jobs=recent_jobs,
+                           class_group=class_group, q=q, before=before, students_next=students_next,
+                           students_prev=students_prev, files_before=files_before, files_next=files_next,
+                           files_prev=files_prev, page_url=page_url)
+
+# محرر القيّمات لتلميذ واحد: يُحمَّل عند الطلب بدل نموذج لكل سطر في اللوحة
+TEMPLATES["admin_student.html"] = """{% extends "base.html" %}
+{% block content %}
+    <div class="card">
+      <div class="topbar">
+        <h2>{{ student['name'] }} <span class="tag">{{ student['class_group'] }}</span></h2>
+        <a class="btn secondary" href="{{ url_for('admin_dashboard', class_group=student['class_group']) }}">رجوع</a>
+      </div>
+      <p class="muted">الكود: <code>{{ student['code'] }}</code></p>
+      <form method="post" action="{{ url_for('admin_add_assessment', student_id=student['id']) }}" class="grid two">
+        <input type="text" name="subject" placeholder="المادة" required />
+        <input type="number" step="0.01" name="ca"   placeholder="التقويم (اختياري)" />
+        <input type="number" step="0.01" name="t1"   placeholder="الفرض 1 (اختياري)" />
+        <input type="number" step="0.01" name="t2"   placeholder="الفرض 2 (اختياري)" />
+        <input type="number" step="0.01" name="exam" placeholder="الإختبار (اختياري)" />
+        <button class="btn" type="submit">حفظ / تحديث</button>
+      </form>
+    </div>
+
+    <div class="card">
+      <h3>القيّمات</h3>
+      <table>
+        <thead><tr><th>المادة</th><th>تقويم</th><th>فرض1</th><th>فرض2</th><th>اختبار</th><th>تاريخ</th></tr></thead>
+        <tbody>
+        {% for a in assessments %}
+          <tr>
+            <td>{{ a['subject'] }}</td>
+            <td>{{ a['ca'] if a['ca'] is not none else '—' }}</td>
+            <td>{{ a['t1'] if a['t1'] is not none else '—' }}</td>
+            <td>{{ a['t2'] if a['t2'] is not none else '—' }}</td>
+            <td>{{ a['exam'] if a['exam'] is not none else '—' }}</td>
+            <td class="muted">{{ a['created_at'] }}</td>
+          </tr>
+        {% else %}
+          <tr><td colspan="6" class="muted">لا شيء بعد.</td></tr>
+        {% endfor %}
+        </tbody>
+      </table>
+    </div>
+{% endblock %}
+"""
+
+@app.get("/admin/student/<int:student_id>")
+def admin_student(student_id):
+    if not session.get("is_admin"):
+        return redirect(url_for("admin_login"))
+    with get_db() as conn:
+        student = conn.execute("SELECT * FROM students WHERE id=?", (student_id,)).fetchone()
+        if not student:
+            abort(404)
+        assessments = conn.execute(
+            "SELECT subject, ca, t1, t2, exam, created_at FROM assessments WHERE student_id=? ORDER BY subject",
+            (student_id,)
+        ).fetchall()
+    return render_template("admin_student.html", title=student["name"], student=student,
+                           assessments=assessments)
+
+# --------------------- الكتابة (group commit) ---------------------
+# SQLite يقبل كاتبًا واحدًا في كل لحظة. بدل أن تتسابق خيوط العامل على القفل (database is locked)،
+# تمر كتابات الأستاذ عبر خيط كاتب واحد في كل عملية (لكل مدرسة) يجمع ما يصل خلال WRITE_BATCH_MS في معاملة واحدة.
+# لكل عملية داخل الدفعة SAVEPOINT خاص بها: فشلها لا يُلغي الباقي، والمستدعي يتلقى نتيجتها
+# أو استثناءها كما لو كتب بنفسه. الدالة المُمرَّرة تكتب فقط ولا تستدعي commit.
+# بين العمليات (عدة عمّال gunicorn) يتناوب الكُتّاب على قفل ملف (flock): الانتظار في النواة
+# يوقظ الكاتب التالي فور التحرير، بدل محاولات busy_timeout المتباعدة، وتكبر الدفعة أثناء الانتظار.
+WRITE_QUEUE = os.environ.get("WRITE_QUEUE", "1") == "1"
+WRITE_BATCH_MS = float(os.environ.get("WRITE_BATCH_MS", "1"))
+WRITE_BATCH_MAX = 64
+WRITE_TIMEOUT_SECONDS = 60   # أقصى انتظار لكتابة لم تبدأ بعد (قفل تحجزه عملية أخرى طويلًا)
+
+@contextmanager
+def process_write_lock(fd):
+    if fd is None or fcntl is None:  # PostgreSQL: القفل في begin_write؛ ويندوز: busy_timeout وحده
+        yield
+        return
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+def write_lock_fd():
+    # ملف القفل بجوار القاعدة؛ كل open له قفل flock مستقل، حتى بين خيوط العملية نفسها
+    if database.engine != "sqlite":
+        return None
+    return os.open(database.path + ".write-lock", os.O_RDWR | os.O_CREAT, 0o600)
+
+@contextmanager
+def direct_write(conn):
+    """معاملة كتابة على conn خارج db_write (الأرشفة: اتصال الأرشيف لا يُستعمل من خيط آخر).
+    تأخذ قفل الملف نفسه الذي يأخذه الكاتب، فلا يبقى للكاتب كاتب آخر ينتظره على busy_timeout."""
+    lock_fd = write_lock_fd()
+    try:
+        with process_write_lock(lock_fd), conn:
+            database.begin_write(conn)
+            yield conn
+    finally:
+        if lock_fd is not None:
+            os.close(lock_fd)
+
+def commit_batch(conn, batch, lock_fd):
+    results = []
+    try:
+        with process_write_lock(lock_fd):
+            database.begin_write(conn)
+            for fn, args, fut in batch:
+                if not fut.set_running_or_notify_cancel():
+                    continue  # انتهت مهلة صاحبها (submit) قبل أن تبدأ: لا تُنفَّذ
+                conn.execute("SAVEPOINT write_op")
+                try:
+                    results.append((fut, fn(conn, *args), None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write_op")
+                    results.append((fut, None, e))
+                conn.execute("RELEASE write_op")
+            conn.commit()
+    except Exception as e:
+        # القفل لم يُؤخذ أو فشل commit: لم يُحفظ شيء من الدفعة
+        if conn.in_transaction:
+            conn.rollback()
+        fail_writes(batch, e)
+        return
+    metric_inc("school_write_batches_total")
+    metric_inc("school_write_ops_total", value=len(results))
+    for fut, result, exc in results:
+        if exc is None:
+            fut.set_result(result)
+        else:
+            fut.set_exception(exc)
+
+def fail_writes(batch, exc):
+    for _, _, fut in batch:
+        if not fut.cancelled():
+            fut.set_exception(exc)
+
+class WriteQueue:
+    """خيط كاتب واحد لكل مدرسة في كل عملية، يبدأ عند أول كتابة (بعد fork عمّال gunicorn).
+    إن مات الخيط (القاعدة لا تُفتح مثلًا) تفشل الكتابات المنتظرة، ويبدأ كاتب جديد مع الكتابة التالية."""
+
+    def __init__(self, tenant):
+        self.tenant = tenant
+        self.pid = None
+        self.queue = None
+        self.lock = threading.Lock()
+
+    def ensure_started(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.queue = queue.SimpleQueue()
+                threading.Thread(target=self.loop, args=(self.queue,), name="db-writer", daemon=True).start()
+                self.pid = os.getpid()
+            return self.queue
+
+    def stop(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                self.queue.put(None)
+            self.pid = None
+
+    def submit(self, fn, args):
+        from concurrent.futures import Future, TimeoutError
+        q = self.queue if self.pid == os.getpid() else self.ensure_started()
+        fut = Future()
+        q.put((fn, args, fut))
+        try:
+            return fut.result(timeout=WRITE_TIMEOUT_SECONDS)
+        except TimeoutError:
+            if fut.cancel():
+                raise  # لم تبدأ ولن تُنفَّذ
+            # بدأت: تنتهي مع دفعتها (أو تفشل إن مات الكاتب أثناءها)
+            return fut.result()
+
+    def loop(self, q):
+        batch = []
+        try:
+            with use_tenant(self.tenant):
+                conn = open_db()
+                lock_fd = None
+                try:
+                    lock_fd = write_lock_fd()
+                    # None من stop(): المدرسة أُغلقت، ينتهي الخيط بعد آخر دفعة
+                    while (item := q.get()) is not None:
+                        batch = [item]
+                        deadline = time.monotonic() + WRITE_BATCH_MS / 1000
+                        while len(batch) < WRITE_BATCH_MAX:
+                            try:
+                                item = q.get(timeout=max(0.0, deadline - time.monotonic()))
+                            except queue.Empty:
+                                break
+                            if item is None:
+                                q.put(None)
+                                break
+                            batch.append(item)
+                        commit_batch(conn, batch, lock_fd)
+                        batch = []
+                finally:
+                    database.close(conn)
+                    if lock_fd is not None:
+                        os.close(lock_fd)
+        except Exception as e:
+            app.logger.exception("db writer")
+            self.crashed(q, batch, e)
+
+    def crashed(self, q, batch, exc):
+        # submit التالي يشغّل كاتبًا جديدًا، وما ينتظر في هذا الطابور يفشل بدل أن يعلق
+        with self.lock:
+            if self.queue is q:
+                self.pid = None
+        fail_writes([item for item in batch if not item[2].done()], exc)
+        while True:
+            try:
+                item = q.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                fail_writes([item], exc)
+
+write_queue = LocalProxy(lambda: current_tenant().write_queue)
+
+def db_write(fn, *args):
+    """ينفّذ fn(conn, *args) في معاملة كتابة ويُرجع نتيجتها أو يرفع استثناءها.
+    كل كتابة في التطبيق تمر من هنا (أو من direct_write)، فيبقى كاتب واحد لكل قاعدة."""
+    if WRITE_QUEUE:
+        return write_queue.submit(fn, args)
+    conn = get_db()
+    with conn:
+        database.begin_write(conn)
+        return fn(conn, *args)
 
 # --------------------- إجراءات الأستاذ ---------------------
 @app.post("/admin/student/add")
@@ -500,15 +2354,25 @@ def admin_add_student():
         flash("الاسم والكود والفوج مطلوبة.")
         return redirect(url_for("admin_dashboard"))
     try:
-        with get_db() as conn:
-            conn.execute("INSERT INTO students (name, code, class_group) VALUES (?, ?, ?)",
-                         (name, code, class_group))
-            conn.commit()
+        db_write(lambda conn: conn.execute("INSERT INTO students (name, code, class_group) VALUES (?, ?, ?)",
+                                           (name, code, class_group)))
         flash("تمت إضافة التلميذ بنجاح.")
-    except sqlite3.IntegrityError:
+    except database.IntegrityError:
         flash("هذا الكود مستخدم بالفعل، اختر كودًا آخر.")
     return redirect(url_for("admin_dashboard"))
 
+# القيم الفارغة (NULL) لا تمسح القيم المحفوظة سابقًا
+UPSERT_ASSESSMENT_SQL = """
+INSERT INTO assessments (student_id, subject, ca, t1, t2, exam, created_at)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(student_id, subject) DO UPDATE SET
+    ca   = COALESCE(excluded.ca,   assessments.ca),
+    t1   = COALESCE(excluded.t1,   assessments.t1),
+    t2   = COALESCE(excluded.t2,   assessments.t2),
+    exam = COALESCE(excluded.exam, assessments.exam),
+    created_at = excluded.created_at
+"""
+
 @app.post("/admin/assessment/add/<int:student_id>")
 def admin_add_assessment(student_id):
     if not session.get("is_admin"):
@@ -531,30 +2395,43 @@ def admin_add_assessment(student_id):
 
     if not subject:
         flash("المادة مطلوبة.")
-        return redirect(url_for("admin_dashboard"))
+        return redirect(url_for("admin_student", student_id=student_id))
 
-    with get_db() as conn:
-        existing = conn.execute(
-            "SELECT id, ca, t1, t2, exam FROM assessments WHERE student_id=? AND subject=?",
-            (student_id, subject)
-        ).fetchone()
-        now = datetime.now().strftime("%Y-%m-%d %H:%M")
-        if existing:
-            new_ca   = ca   if ca   is not None else existing["ca"]
-            new_t1   = t1   if t1   is not None else existing["t1"]
-            new_t2   = t2   if t2   is not None else existing["t2"]
-            new_exam = exam if exam is not None else existing["exam"]
-            conn.execute(
-                "UPDATE assessments SET ca=?, t1=?, t2=?, exam=?, created_at=? WHERE id=?",
-                (new_ca, new_t1, new_t2, new_exam, now, existing["id"])
-            )
-        else:
-            conn.execute(
-                "INSERT INTO assessments (student_id, subject, ca, t1, t2, exam, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (student_id, subject, ca, t1, t2, exam, now)
-            )
-        conn.commit()
+    now = datetime.now().strftime("%Y-%m-%d %H:%M")
+
+    def save(conn):
+        conn.execute(UPSERT_ASSESSMENT_SQL, (student_id, subject, ca, t1, t2, exam, now))
+        student = conn.execute("SELECT class_group FROM students WHERE id=?", (student_id,)).fetchone()
+        publish(conn, f"student:{student_id}", "grades")
+        if student:
+            # الترتيب ومعدل القسم تغيّرا لكل تلاميذ الفوج
+            publish(conn, f"group:{student['class_group']}", "class_grades")
+
+    db_write(save)
     flash("تم حفظ/تحديث القيّمات.")
+    return redirect(url_for("admin_student", student_id=student_id))
+
+def stage_upload(stream):
+    """ينسخ الملف على دفعات إلى ملف مؤقت مع حساب SHA-256 وفرض الحد الأقصى للحجم."""
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp = tempfile.mkstemp(dir=current_tenant().blob_folder, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while chunk := stream.read(UPLOAD_CHUNK):
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise RequestEntityTooLarge()
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return tmp, digest.hexdigest(), size
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    flash(f"الملف أكبر من الحد المسموح ({MAX_UPLOAD_BYTES // (1024 * 1024)} MB).")
     return redirect(url_for("admin_dashboard"))
 
 @app.post("/admin/upload")
@@ -570,46 +2447,1759 @@ def admin_upload():
     if not allowed_file(file.filename):
         flash("صيغة الملف غير مسموحة. المسموح: PDF, DOC, DOCX")
         return redirect(url_for("admin_dashboard"))
+    # الاسم يُستعمل للتنزيل فقط؛ secure_filename يحذف الحروف العربية فقد لا يبقى إلا الامتداد
+    ext = file.filename.rsplit(".", 1)[1].lower()
     fname = secure_filename(file.filename)
-    base, ext = os.path.splitext(fname)
-    fname = f"{base}_{int(datetime.now().timestamp())}{ext}"
-    file.save(os.path.join(UPLOAD_FOLDER, fname))
-    with get_db() as conn:
-        conn.execute(
-            "INSERT INTO files (title, filename, class_group, uploaded_at) VALUES (?, ?, ?, ?)",
-            (title, fname, class_group, datetime.now().strftime("%Y-%m-%d %H:%M"))
-        )
-        conn.commit()
+    if "." not in fname:
+        fname = f"file.{ext}"
+    tmp, sha256, size = stage_upload(file.stream)
+    metric_inc("school_upload_bytes_total", value=size)
+
+    def save(conn):
+        # None: collect_blob يحذف هذه البصمة الآن، ننتظر انتهاءه. True: حُذفت منذ رفعنا، نرفعها من جديد
+        gc = conn.execute("SELECT state, since FROM blob_gc WHERE sha256=?", (sha256,)).fetchone()
+        if gc and gc["state"] == "deleting" and time.time() - gc["since"] < BLOB_DELETE_SECONDS:
+            return None
+        if gc:
+            conn.execute("DELETE FROM blob_gc WHERE sha256=?", (sha256,))
+        file_id = conn.execute(
+            """INSERT INTO files (title, filename, class_group, uploaded_at, size, mtime, etag, sha256)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?) RETURNING id""",
+            (title, fname, class_group, datetime.now().strftime("%Y-%m-%d %H:%M"),
+             size, time.time(), sha256, sha256)
+        ).fetchone()[0]
+        # النص يُستخرج في الخلفية؛ العنوان قابل للبحث فورًا
+        conn.execute("INSERT INTO file_texts (file_id, title) VALUES (?, ?)", (file_id, title))
+        publish(conn, f"group:{class_group}", "files")
+        enqueue_job(conn, "extract_text", file_id=file_id)
+        if storage.local_path(sha256) is None:
+            enqueue_job(conn, "verify_checksum", file_id=file_id)
+        return gc is not None
+
+    try:
+        # المحتوى يُرفع قبل معاملة الكتابة: رفع بطيء إلى المخزن البعيد لا يحجز الكاتب وقفله
+        storage.save(sha256, tmp)
+        deadline = time.monotonic() + BLOB_WAIT_SECONDS
+        while (resave := db_write(save)) is None:
+            if time.monotonic() >= deadline:
+                # حذف بطيء أو عامل مات أثناءه: لا نحجز خيط الطلب حتى تنقضي BLOB_DELETE_SECONDS
+                flash("ملف بنفس المحتوى يُحذف الآن من المخزن، أعد المحاولة بعد قليل.")
+                return redirect(url_for("admin_dashboard"))
+            time.sleep(0.2)
+        if resave:
+            # السطر صار مرجعًا يمنع أي حذف جديد لهذه البصمة
+            storage.save(sha256, tmp)
+    finally:
+        os.remove(tmp)
+    job_runner.notify()
     flash("تم رفع الملف.")
     return redirect(url_for("admin_dashboard"))
 
+DELETE_STUDENT_ASSESSMENTS_SQL = "DELETE FROM assessments WHERE student_id=?"
+
 @app.post("/admin/student/delete/<int:student_id>")
 def admin_delete_student(student_id):
     if not session.get("is_admin"):
         return redirect(url_for("admin_login"))
-    with get_db() as conn:
-        conn.execute("DELETE FROM assessments WHERE student_id=?", (student_id,))
+
+    def delete(conn):
+        conn.execute(DELETE_STUDENT_ASSESSMENTS_SQL, (student_id,))
         conn.execute("DELETE FROM students WHERE id=?", (student_id,))
-        conn.commit()
+
+    db_write(delete)
     flash("تم حذف التلميذ وجميع تقييماته.")
     return redirect(url_for("admin_dashboard"))
 
+BLOB_DELETE_SECONDS = 120   # حذف من المخزن أقدم من هذا يُعتبر منقطعًا (عامل مات أثناءه)
+BLOB_WAIT_SECONDS = 5       # أقصى انتظار للرفع خلف حذف جارٍ لنفس المحتوى
+
+def claim_blob(conn, sha256):
+    # الأرشفة تثبّت السطر في الأرشيف قبل حذفه من files، فالمرجع في أحدهما دائمًا
+    if conn.execute("SELECT 1 FROM files WHERE sha256=? LIMIT 1", (sha256,)).fetchone() or archived_blob(sha256):
+        return False
+    conn.execute(
+        """INSERT INTO blob_gc (sha256, state, since) VALUES (?, 'deleting', ?)
+           ON CONFLICT(sha256) DO UPDATE SET state='deleting', since=excluded.since""",
+        (sha256, time.time()))
+    return True
+
+def collect_blob(sha256):
+    """يحذف محتوى البصمة من المخزن إن لم يبق سطر يشير إليه؛ تُستدعى بعد commit الحذف.
+    الحذف نفسه خارج معاملة الكتابة، وسطر blob_gc يُعلم الرفع المتزامن لنفس المحتوى (admin_upload):
+    أثناء الحذف ينتظر، وبعده يرفع المحتوى من جديد."""
+    if not db_write(claim_blob, sha256):
+        return
+    try:
+        storage.delete(sha256)
+    finally:
+        db_write(lambda conn: conn.execute(
+            "UPDATE blob_gc SET state='deleted', since=? WHERE sha256=? AND state='deleting'",
+            (time.time(), sha256)))
+
 @app.post("/admin/file/delete/<int:file_id>")
 def admin_delete_file(file_id):
     if not session.get("is_admin"):
         return redirect(url_for("admin_login"))
-    with get_db() as conn:
-        f = conn.execute("SELECT filename FROM files WHERE id=?", (file_id,)).fetchone()
+
+    def delete(conn):
+        f = conn.execute("SELECT filename, sha256, class_group FROM files WHERE id=?", (file_id,)).fetchone()
         conn.execute("DELETE FROM files WHERE id=?", (file_id,))
-        conn.commit()
-    if f:
+        if f:
+            publish(conn, f"group:{f['class_group']}", "files")
+        return f
+
+    f = db_write(delete)
+    # المحتوى يُحذف بعد commit فقط: معاملة أو دفعة تراجعت لا تترك سطرًا بلا محتوى
+    if f and not f["sha256"]:
         try:
-            os.remove(os.path.join(UPLOAD_FOLDER, f["filename"]))
+            os.remove(legacy_path(f))
         except FileNotFoundError:
             pass
+    elif f:
+        collect_blob(f["sha256"])
     flash("تم حذف الملف.")
     return redirect(url_for("admin_dashboard"))
 
+# --------------------- البحث في الملفات ---------------------
+# فهرس FTS5 لعناوين الملفات والنص المستخرج منها (الترحيل 8): العنوان عند الرفع، والنص بمهمة
+# extract_text في الخلفية، ويُفرَّغ بحذف الملف (trigger). في PostgreSQL عمود tsvector في file_texts بدل FTS5.
+# الاستخراج: DOCX بمكتبة Python القياسية، PDF بـ pypdf إن كانت مثبتة، و DOC القديم بعنوانه فقط.
+SEARCH_MAX_CHARS = 200_000       # نص كافٍ للبحث دون تضخيم القاعدة بالكتب الكبيرة
+SEARCH_LIMIT = 50
+HL_OPEN, HL_CLOSE = "\x02", "\x03"  # علامات التظليل من قاعدة البيانات؛ تصبح <mark> بعد تهريب النص
+
+def extract_text(path, ext):
+    try:
+        if ext == "docx":
+            with zipfile.ZipFile(path) as z:
+                xml = z.read("word/document.xml").decode("utf-8")
+            xml = re.sub(r"</w:p>|<w:br/>", "\n", xml).replace("<w:tab/>", " ")
+            text = html.unescape(re.sub(r"<[^>]+>", "", xml))
+        elif ext == "pdf":
+            from pypdf import PdfReader  # استيراد متأخر: اختياري
+            parts, size = [], 0
+            for page in PdfReader(path).pages:
+                parts.append(page.extract_text() or "")
+                size += len(parts[-1])
+                if size >= SEARCH_MAX_CHARS:
+                    break
+            text = "\n".join(parts)
+        else:
+            return ""
+    except ImportError:
+        return ""
+    except Exception as e:
+        # ملف تالف أو بصيغة لا نقرؤها: يبقى البحث بالعنوان
+        app.logger.warning("text extraction failed for %s: %s", path, e)
+        return ""
+    return text[:SEARCH_MAX_CHARS]
+
+SEARCH_FTS_SQL = """SELECT files.id, files.class_group, files.uploaded_at,
+                          highlight(files_fts, 0, ?, ?) AS title_hl,
+                          snippet(files_fts, 1, ?, ?, '…', 16) AS body_hl
+                   FROM files_fts JOIN files ON files.id = files_fts.rowid
+                   WHERE files_fts MATCH ? {group_clause}
+                   ORDER BY bm25(files_fts, 5.0, 1.0) LIMIT ?"""
+# الأوزان {D, C, B, A}: العنوان (A) خمسة أضعاف النص (B) كما في bm25 أعلاه.
+# ts_headline يختار مقطع النص فقط، والتظليل بعده بـ highlight_terms
+SEARCH_PG_SQL = """SELECT files.id, files.class_group, files.uploaded_at, file_texts.title AS title_hl,
+                          ts_headline('simple', file_texts.body, query, ?) AS body_hl
+                   FROM to_tsquery('simple', ?) AS query,
+                        file_texts JOIN files ON files.id = file_texts.file_id
+                   WHERE file_texts.tsv @@ query {group_clause}
+                   ORDER BY ts_rank('{{0.1, 0.2, 0.2, 1.0}}', file_texts.tsv, query) DESC LIMIT ?"""
+
+def fts_query(q):
+    """كلمات المستخدم كعبارات بين علامتي تنصيص (فلا أخطاء صياغة FTS5)، وكل كلمة بادئة."""
+    terms = search_normalize(q).split()
+    return " ".join('"{}"*'.format(t.replace('"', '""')) for t in terms) or None
+
+def ts_query(q):
+    """نفس الكلمات لـ to_tsquery في PostgreSQL: كل كلمة lexeme بين علامتي تنصيص وبادئة (:*)."""
+    terms = search_normalize(q).split()
+    return " & ".join("'{}':*".format(t.replace("\\", "\\\\").replace("'", "''")) for t in terms) or None
+
+_HL_WORD_RE = re.compile(f"[\\w{ARABIC_MARKS}]+")
+
+def highlight_terms(text, terms):
+    """PostgreSQL: يظلّل الكلمات التي يبدأ شكلها المُطبَّع بإحدى كلمات البحث، كما يفعل highlight() في FTS5
+    (ts_headline يقارن الكلمات بشكلها الأصلي فلا يظلّل "الإحصاء" عند البحث عن "احصاء")."""
+    def mark(m):
+        word = m.group()
+        return f"{HL_OPEN}{word}{HL_CLOSE}" if search_normalize(word).lower().startswith(terms) else word
+    return _HL_WORD_RE.sub(mark, (text or "").replace(HL_OPEN, "").replace(HL_CLOSE, ""))
+
+def search_markup(text):
+    return Markup(str(escape(text or "")).replace(HL_OPEN, "<mark>").replace(HL_CLOSE, "</mark>"))
+
+TEMPLATES["search.html"] = """{% extends "base.html" %}
+{% block content %}
+    <div class="card">
+      <div class="topbar">
+        <h2>البحث في الملفات</h2>
+        <a class="btn secondary" href="{{ back }}">رجوع</a>
+      </div>
+      <form method="get" class="grid two">
+        <input type="search" name="q" value="{{ q }}" placeholder="كلمة من العنوان أو من محتوى الملف" required />
+        {% if is_admin %}
+          <select name="class_group">
+            <option value="">كل الأفواج</option>
+            {% for c in class_choices %}
+              <option value="{{ c }}" {% if c == class_group %}selected{% endif %}>{{ c }}</option>
+            {% endfor %}
+          </select>
+        {% endif %}
+        <div style="grid-column:1 / -1; text-align:left">
+          <button class="btn" type="submit">بحث</button>
+        </div>
+      </form>
+      {% if q %}
+      <table>
+        <thead><tr><th>العنوان</th>{% if is_admin %}<th>الفوج</th>{% endif %}<th>التاريخ</th><th>تحميل</th></tr></thead>
+        <tbody>
+        {% for r in results %}
+          <tr>
+            <td>
+              {{ r.title }}
+              {% if r.body %}<div class="muted">{{ r.body }}</div>{% endif %}
+            </td>
+            {% if is_admin %}<td>{{ r.class_group }}</td>{% endif %}
+            <td class="muted">{{ r.uploaded_at }}</td>
+            <td><a class="btn secondary" href="{{ url_for('download_file', file_id=r.id) }}">تنزيل</a></td>
+          </tr>
+        {% else %}
+          <tr><td colspan="4" class="muted">لا توجد نتائج.</td></tr>
+        {% endfor %}
+        </tbody>
+      </table>
+      {% endif %}
+    </div>
+{% endblock %}
+"""
+
+@app.get("/search")
+def search_files():
+    is_admin = bool(session.get("is_admin"))
+    if not is_admin and not session.get("student_id"):
+        flash("فضلاً سجّل الدخول أولاً.")
+        return redirect(url_for("index"))
+    q = request.args.get("q", "").strip()
+    # التلميذ لا يرى إلا ملفات فوجه
+    class_group = request.args.get("class_group", "").strip() if is_admin else session.get("class_group")
+    results = []
+    match = fts_query(q) if database.engine == "sqlite" else ts_query(q)
+    if match:
+        group_clause = "AND files.class_group=?" if class_group else ""
+        group_params = [class_group] if class_group else []
+        if database.engine == "sqlite":
+            sql = SEARCH_FTS_SQL.format(group_clause=group_clause)
+            params = (HL_OPEN, HL_CLOSE, HL_OPEN, HL_CLOSE, match, *group_params, SEARCH_LIMIT)
+        else:
+            sql = SEARCH_PG_SQL.format(group_clause=group_clause)
+            params = (f"StartSel={HL_OPEN}, StopSel={HL_CLOSE}, MaxWords=16, MinWords=8",
+                      match, *group_params, SEARCH_LIMIT)
+        with get_db() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        if database.engine != "sqlite":
+            terms = tuple(search_normalize(q).lower().split())
+            rows = [dict(r, title_hl=highlight_terms(r["title_hl"], terms),
+                         body_hl=highlight_terms(r["body_hl"], terms)) for r in rows]
+        results = [{"id": r["id"], "class_group": r["class_group"], "uploaded_at": r["uploaded_at"],
+                    "title": search_markup(r["title_hl"]), "body": search_markup(r["body_hl"])}
+                   for r in rows]
+    back = url_for("admin_dashboard" if is_admin else "student_dashboard")
+    return render_template("search.html", title="البحث", q=q, results=results, is_admin=is_admin,
+                           class_group=class_group, class_choices=class_choices(), back=back)
+
+# --------------------- المهام في الخلفية ---------------------
+# طابور مهام في جدول jobs (الترحيل 9): الطلب يضيف المهمة في نفس معاملة البيانات ويعود فورًا،
+# وخيوط داخل كل عامل لكل مدرسة (JOB_RUNNER=thread) أو عامل مستقل (flask --app app worker) ينفّذها.
+# المهمة الفاشلة تُعاد بعد مهلة متزايدة حتى max_attempts، ثم تبقى "failed" ظاهرة في لوحة الأستاذ.
+JOB_RUNNER = os.environ.get("JOB_RUNNER", "thread").lower()   # thread | external
+JOB_THREADS = int(os.environ.get("JOB_THREADS", "2"))
+JOB_POLL_SECONDS = 2.0           # مهلة الانتظار حين يكون الطابور فارغًا
+JOB_LEASE_SECONDS = 600          # مهمة "running" أقدم من هذا تُعتبر عاملها ميتًا فتُستأنف
+JOB_RETRY_SECONDS = 10           # 10، 20، 40... ثانية بين المحاولات
+JOB_KEEP_DONE = 1000             # عدد المهام المنجزة المحفوظة للعرض
+JOB_HANDLERS = {}
+
+def job_handler(kind):
+    def register(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return register
+
+def enqueue_job(conn, kind, max_attempts=3, **payload):
+    """يضيف مهمة داخل معاملة conn الحالية؛ بعد commit استدعِ job_runner.notify()."""
+    conn.execute(
+        "INSERT INTO jobs (kind, payload, max_attempts, run_after, created_at) VALUES (?, ?, ?, ?, ?)",
+        (kind, json.dumps(payload), max_attempts, time.time(), datetime.now().strftime("%Y-%m-%d %H:%M"))
+    )
+
+def claim_job(conn):
+    now = time.time()
+    # UPDATE ... RETURNING ذرّي: عاملان لا يأخذان نفس المهمة. الشرط يتكرر خارج الاستعلام الفرعي لأن
+    # PostgreSQL يعيد فحصه على السطر بعد انتظار قفله: من يصل ثانيًا لا يجد المهمة متاحة
+    rows = conn.execute(
+        """UPDATE jobs SET status='running', attempts=attempts+1, locked_at=?
+           WHERE id = (SELECT id FROM jobs
+                       WHERE (status='queued' AND run_after<=?) OR (status='running' AND locked_at<?)
+                       ORDER BY run_after LIMIT 1)
+             AND ((status='queued' AND run_after<=?) OR (status='running' AND locked_at<?))
+           RETURNING *""",
+        (now, now, now - JOB_LEASE_SECONDS, now, now - JOB_LEASE_SECONDS)
+    ).fetchall()
+    return rows[0] if rows else None
+
+def run_next_job():
+    """ينفّذ مهمة واحدة جاهزة؛ False إذا كان الطابور فارغًا.
+    المعالج يقرأ من conn ويكتب عبر db_write، وحالة المهمة تُكتب عبر db_write أيضًا."""
+    conn = get_db()
+    job = db_write(claim_job)
+    if job is None:
+        return False
+    labels = (("kind", job["kind"]),)
+    started = time.perf_counter()
+    try:
+        handler = JOB_HANDLERS.get(job["kind"])
+        if handler is None:
+            raise LookupError(f"unknown job kind {job['kind']!r}")
+        handler(conn, **json.loads(job["payload"]))
+    except Exception as e:
+        if conn.in_transaction:
+            conn.rollback()
+        final = job["attempts"] >= job["max_attempts"]
+        db_write(lambda conn: conn.execute(
+            "UPDATE jobs SET status=?, run_after=?, locked_at=NULL, last_error=? WHERE id=?",
+            ("failed" if final else "queued", time.time() + JOB_RETRY_SECONDS * 2 ** (job["attempts"] - 1),
+             f"{type(e).__name__}: {e}", job["id"])
+        ))
+        metric_inc("school_jobs_total", labels + (("result", "failed" if final else "retry"),))
+        app.logger.warning("job %s (%s) attempt %d failed: %s", job["id"], job["kind"], job["attempts"], e)
+    else:
+        if conn.in_transaction:
+            conn.rollback()  # المعالج قرأ فقط من conn: لا تبقى معاملة قراءة مفتوحة (PostgreSQL)
+        db_write(lambda conn: conn.execute(
+            "UPDATE jobs SET status='done', locked_at=NULL, last_error=NULL, finished_at=? WHERE id=?",
+            (datetime.now().strftime("%Y-%m-%d %H:%M"), job["id"])
+        ))
+        metric_inc("school_jobs_total", labels + (("result", "done"),))
+    metric_observe("school_job_duration_seconds", labels, time.perf_counter() - started)
+    return True
+
+def prune_jobs(conn):
+    conn.execute(
+        """DELETE FROM jobs WHERE status='done' AND id < (
+               SELECT id FROM jobs WHERE status='done' ORDER BY id DESC LIMIT 1 OFFSET ?)""",
+        (JOB_KEEP_DONE,)
+    )
+
+class JobRunner:
+    """خيوط تسحب المهام من جدول مدرسة واحدة؛ تبدأ عند أول حاجة في كل عملية (بعد fork عمّال gunicorn)."""
+
+    def __init__(self, tenant, threads):
+        self.tenant = tenant
+        self.threads = threads
+        self.wake = threading.Event()
+        self.stopped = False
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            for i in range(self.threads):
+                threading.Thread(target=self.loop, name=f"job-runner-{i}", daemon=True).start()
+
+    def notify(self):
+        if JOB_RUNNER == "thread":
+            self.ensure_started()
+        self.wake.set()
+
+    def stop(self):
+        # المهمة الجارية تكتمل، ثم ينتهي كل خيط عند استيقاظه
+        self.stopped = True
+        self.wake.set()
+
+    def loop(self):
+        pruned = False
+        with use_tenant(self.tenant):
+            while not self.stopped:
+                try:
+                    if run_next_job():
+                        pruned = False
+                        continue
+                    if not pruned:
+                        # الطابور فرغ: تنظيف المهام المنجزة القديمة مرة واحدة
+                        db_write(prune_jobs)
+                        pruned = True
+                except (database.Error, TimeoutError):
+                    # قاعدة مشغولة أو مقفلة، أو كتابة تجاوزت WRITE_TIMEOUT_SECONDS: نعيد المحاولة في الدورة التالية
+                    app.logger.exception("job runner")
+                self.wake.wait(JOB_POLL_SECONDS)
+                self.wake.clear()
+            close_db()
+
+job_runner = LocalProxy(lambda: current_tenant().job_runner)
+
+@app.before_request
+def start_job_runner():
+    # المهام المتبقية من تشغيل سابق تُستأنف مع أول طلب إلى المدرسة
+    if JOB_RUNNER == "thread" and "tenant" in g:
+        job_runner.ensure_started()
+
+@app.cli.command("worker")
+@click.option("--threads", default=JOB_THREADS, show_default=True, help="عدد الخيوط المنفّذة")
+@click.option("--once", is_flag=True, help="تنفيذ المهام الجاهزة ثم الخروج")
+def jobs_worker(threads, once):
+    """عامل مهام مستقل: flask --app app worker (مع JOB_RUNNER=external في خادم الويب).
+    مع تعدد المدارس يخدم كلها، ويضمّ المدارس الجديدة كل دقيقة."""
+    ensure_app()
+    if once:
+        for name in tenant_names():
+            with cli_tenant(name):
+                while run_next_job():
+                    pass
+        return
+    started = set()
+    while True:
+        for name in set(tenant_names()) - started:
+            # محجوزة طوال عمر العامل، فلا تُغلق
+            tenant = default_tenant if not TENANT_MODE else tenants.acquire(name)
+            if tenant is not None:
+                tenant.job_runner = JobRunner(tenant, threads)
+                tenant.job_runner.ensure_started()
+                started.add(name)
+        time.sleep(60)
+
+@contextmanager
+def blob_file(f):
+    """مسار محلي لمحتوى الملف؛ من المخزن البعيد يُنسخ إلى ملف مؤقت يُحذف بعد الاستعمال."""
+    path = storage.local_path(f["sha256"]) if f["sha256"] else legacy_path(f)
+    if path:
+        yield path
+        return
+    fd, tmp = tempfile.mkstemp(dir=current_tenant().blob_folder, suffix=".job")
+    try:
+        with os.fdopen(fd, "wb") as out, storage.open(f["sha256"]) as src:
+            while chunk := src.read(UPLOAD_CHUNK):
+                out.write(chunk)
+        yield tmp
+    finally:
+        os.remove(tmp)
+
+@job_handler("extract_text")
+def job_extract_text(conn, file_id):
+    f = conn.execute("SELECT id, filename, sha256 FROM files WHERE id=?", (file_id,)).fetchone()
+    if not f:
+        return  # حُذف الملف قبل التنفيذ
+    ext = f["filename"].rsplit(".", 1)[-1].lower()
+    # خطأ قراءة المخزن (OSError) يُعيد المهمة؛ ملف تالف يعطي نصًا فارغًا
+    with blob_file(f) as path:
+        body = extract_text(path, ext)
+    if body:
+        db_write(lambda conn: conn.execute("UPDATE file_texts SET body=? WHERE file_id=?", (body, file_id)))
+
+@job_handler("verify_checksum")
+def job_verify_checksum(conn, file_id):
+    # المخزن البعيد: نتأكد أن المحتوى المحفوظ هناك يطابق البصمة المحسوبة عند الرفع
+    f = conn.execute("SELECT id, filename, sha256 FROM files WHERE id=?", (file_id,)).fetchone()
+    if not f or not f["sha256"]:
+        return
+    digest = hashlib.sha256()
+    with storage.open(f["sha256"]) as src:
+        while chunk := src.read(UPLOAD_CHUNK):
+            digest.update(chunk)
+    if digest.hexdigest() != f["sha256"]:
+        raise ValueError(f"checksum mismatch for file {file_id}")
+
+@app.post("/admin/jobs/retry/<int:job_id>")
+def admin_retry_job(job_id):
+    if not session.get("is_admin"):
+        return redirect(url_for("admin_login"))
+    db_write(lambda conn: conn.execute(
+        "UPDATE jobs SET status='queued', attempts=0, run_after=?, last_error=NULL WHERE id=? AND status='failed'",
+        (time.time(), job_id)
+    ))
+    job_runner.notify()
+    flash("أُعيدت المهمة إلى الطابور.")
+    return redirect(url_for("admin_dashboard"))
+
+# --------------------- الإدخال الجماعي ---------------------
+# شبكة إدخال النقاط لفوج ومادة، واستيراد النقاط/التلاميذ من CSV أو XLSX.
+# الملف يُقرأ ويُفحص كاملًا في خيط الطلب خارج أي معاملة، ثم يُكتب الصالح منه بـ executemany عبر db_write،
+# فلا يبقى قفل الكتابة محجوزًا أثناء قراءة ملف كبير.
+SCORE_FIELDS = ("ca", "t1", "t2", "exam")
+IMPORT_EXTENSIONS = {"csv", "xlsx"}
+# أخطاء قراءة ملف تالف أو بترميز غير UTF-8 (UnicodeDecodeError من ValueError)؛
+# KeyError من openpyxl لملف zip ينقصه جزء ([Content_Types].xml مثلًا)، وInvalidFileException تُحوَّل إلى ValueError
+SHEET_ERRORS = (ValueError, KeyError, csv.Error, zipfile.BadZipFile, ImportError)
+
+def parse_score(value):
+    # يقبل الفاصلة العشرية (12,5) كما في جداول Excel المحلية؛ ValueError إن لم يكن رقمًا
+    if value is None:
+        return None
+    v = str(value).strip().replace(",", ".")
+    if v == "":
+        return None
+    return float(v)
+
+def iter_sheet_rows(file):
+    """يُرجع (رقم السطر، dict) لكل سطر بعد سطر العناوين، دون تحميل الملف كاملًا."""
+    ext = file.filename.rsplit(".", 1)[-1].lower()
+    if ext == "xlsx":
+        from openpyxl import load_workbook  # استيراد متأخر: لا نحتاجه إلا هنا
+        from openpyxl.utils.exceptions import InvalidFileException
+        try:
+            sheet = load_workbook(file.stream, read_only=True, data_only=True).active
+        except InvalidFileException as e:
+            raise ValueError(str(e)) from e
+        rows = sheet.iter_rows(values_only=True)
+    else:
+        text = io.TextIOWrapper(file.stream, encoding="utf-8-sig", newline="")
+        header = text.readline()
+        try:
+            dialect = csv.Sniffer().sniff(header, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        rows = csv.reader(itertools.chain([header], text), dialect)
+    keys = None
+    for line, values in enumerate(rows, start=1):
+        if keys is None:
+            keys = [str(k or "").strip().lower() for k in values]
+            continue
+        if not any(v not in (None, "") for v in values):
+            continue
+        yield line, dict(zip(keys, values))
+
+def assessment_params(records, subject, now, report):
+    """records: (وسم السطر، student_id أو None، dict القيم). يملأ report ويُرجع معاملات الـ upsert."""
+    for label, student_id, rec in records:
+        if student_id is None:
+            report.append({"line": label, "ok": False, "message": "تلميذ غير موجود في هذا الفوج."})
+            continue
+        row_subject = str(rec.get("subject") or subject or "").strip()
+        if not row_subject:
+            report.append({"line": label, "ok": False, "message": "المادة مطلوبة."})
+            continue
+        try:
+            scores = [parse_score(rec.get(k)) for k in SCORE_FIELDS]
+        except ValueError:
+            report.append({"line": label, "ok": False, "message": "قيمة غير رقمية."})
+            continue
+        if all(s is None for s in scores):
+            continue
+        report.append({"line": label, "ok": True, "message": row_subject})
+        yield (student_id, row_subject, *scores, now)
+
+def import_report(title, report):
+    saved = sum(1 for r in report if r["ok"])
+    return render_template("import_report.html", title=title, report=report,
+                           saved=saved, failed=len(report) - saved)
+
+TEMPLATES["admin_grades.html"] = """{% extends "base.html" %}
+{% block content %}
+    <div class="card">
+      <h2>إدخال النقاط جماعيًا</h2>
+      <form method="get" class="grid two">
+        <div>
+          <label>القسم / الفوج</label>
+          <select name="class_group" required>
+            {% for c in class_choices %}
+              <option value="{{ c }}" {% if c == class_group %}selected{% endif %}>{{ c }}</option>
+            {% endfor %}
+          </select>
+        </div>
+        <div>
+          <label>المادة</label>
+          <input type="text" name="subject" value="{{ subject }}" list="subjects" required />
+          <datalist id="subjects">
+            {% for s in subjects %}<option value="{{ s }}">{% endfor %}
+          </datalist>
+        </div>
+        <div style="grid-column:1 / -1; text-align:left">
+          <button class="btn secondary" type="submit">عرض الشبكة</button>
+        </div>
+      </form>
+
+      {% if class_group %}
+        <p class="muted">
+          تصدير كشف النقاط{% if subject %} ({{ subject }}){% endif %}:
+          <a href="{{ url_for('admin_grades_export', fmt='csv', class_group=class_group, subject=subject) }}">CSV</a> —
+          <a href="{{ url_for('admin_grades_export', fmt='xlsx', class_group=class_group, subject=subject) }}">XLSX</a>
+          {% if subject %} — كل المواد:
+            <a href="{{ url_for('admin_grades_export', fmt='csv', class_group=class_group) }}">CSV</a> —
+            <a href="{{ url_for('admin_grades_export', fmt='xlsx', class_group=class_group) }}">XLSX</a>
+          {% endif %}
+        </p>
+      {% endif %}
+
+      {% if class_group and subject %}
+      <form method="post" action="{{ url_for('admin_grades_save') }}">
+        <input type="hidden" name="class_group" value="{{ class_group }}" />
+        <input type="hidden" name="subject" value="{{ subject }}" />
+        {% if stats %}
+          <p class="muted">
+            معدل القسم: <strong>{{ stats['mean'] }}</strong> — أدنى: {{ stats['min'] }} — أعلى: {{ stats['max'] }}
+            — عدد المعدلات المكتملة: {{ stats['n'] }}
+          </p>
+        {% endif %}
+        <table>
+          <thead>
+            <tr><th>الإسم و اللقب</th><th>الكود</th><th>تقويم</th><th>فرض1</th><th>فرض2</th><th>اختبار</th><th>المعدل</th><th>الترتيب</th></tr>
+          </thead>
+          <tbody>
+          {% for s in students %}
+            <tr>
+              <td>{{ s['name'] }}</td>
+              <td><code>{{ s['code'] }}</code></td>
+              {% for k in score_fields %}
+                <td><input type="text" inputmode="decimal" name="{{ k }}-{{ s['id'] }}"
+                           value="{{ s[k] if s[k] is not none else '' }}" /></td>
+              {% endfor %}
+              <td><strong>{{ s['final'] if s['final'] is not none else '—' }}</strong></td>
+              <td>{{ s['rank'] if s['rank'] is not none else '—' }}</td>
+            </tr>
+          {% else %}
+            <tr><td colspan="8" class="muted">لا يوجد تلاميذ في هذا الفوج.</td></tr>
+          {% endfor %}
+          </tbody>
+        </table>
+        <p style="text-align:left"><button class="btn" type="submit">حفظ الكل</button></p>
+      </form>
+      {% endif %}
+    </div>
+
+    <div class="card">
+      <div class="grid two">
+        <div>
+          <h3>استيراد النقاط (CSV / XLSX)</h3>
+          <p class="muted">الأعمدة: code, subject, ca, t1, t2, exam — عمود subject اختياري إذا حُددت المادة هنا.</p>
+          <form method="post" action="{{ url_for('admin_grades_import') }}" enctype="multipart/form-data" class="grid">
+            <select name="class_group" required>
+              {% for c in class_choices %}
+                <option value="{{ c }}" {% if c == class_group %}selected{% endif %}>{{ c }}</option>
+              {% endfor %}
+            </select>
+            <input type="text" name="subject" value="{{ subject }}" placeholder="المادة (اختياري)" />
+            <input type="file" name="file" accept=".csv,.xlsx" required />
+            <button class="btn" type="submit">استيراد النقاط</button>
+          </form>
+        </div>
+        <div>
+          <h3>استيراد التلاميذ (CSV / XLSX)</h3>
+          <p class="muted">الأعمدة: name, code, class_group</p>
+          <form method="post" action="{{ url_for('admin_students_import') }}" enctype="multipart/form-data" class="grid">
+            <input type="file" name="file" accept=".csv,.xlsx" required />
+            <button class="btn" type="submit">استيراد التلاميذ</button>
+          </form>
+        </div>
+      </div>
+    </div>
+{% endblock %}
+"""
+
+TEMPLATES["import_report.html"] = """{% extends "base.html" %}
+{% block content %}
+    <div class="card">
+      <h2>{{ title }}</h2>
+      <p>تم الحفظ: <strong>{{ saved }}</strong> — مرفوض: <strong>{{ failed }}</strong></p>
+      <table>
+        <thead><tr><th>السطر</th><th>الحالة</th><th>ملاحظة</th></tr></thead>
+        <tbody>
+        {% for r in report %}
+          <tr>
+            <td>{{ r.line }}</td>
+            <td>{% if r.ok %}<span class="tag">تم</span>{% else %}<strong>خطأ</strong>{% endif %}</td>
+            <td class="{{ '' if not r.ok else 'muted' }}">{{ r.message }}</td>
+          </tr>
+        {% else %}
+          <tr><td colspan="3" class="muted">لا توجد أسطر.</td></tr>
+        {% endfor %}
+        </tbody>
+      </table>
+      <p><a class="btn secondary" href="{{ url_for('admin_grades') }}">رجوع</a></p>
+    </div>
+{% endblock %}
+"""
+
+@app.get("/admin/grades")
+def admin_grades():
+    if not session.get("is_admin"):
+        return redirect(url_for("admin_login"))
+    class_group = request.args.get("class_group", "").strip()
+    subject = request.args.get("subject", "").strip()
+    with get_db() as conn:
+        subjects = [r[0] for r in conn.execute("SELECT DISTINCT subject FROM assessments ORDER BY subject")]
+        students, stats = [], None
+        if class_group and subject:
+            students = conn.execute(
+                """SELECT students.id, students.name, students.code,
+                          assessments.ca, assessments.t1, assessments.t2, assessments.exam,
+                          assessments.final, class_ranks.rank
+                   FROM students LEFT JOIN assessments
+                        ON assessments.student_id=students.id AND assessments.subject=?
+                   LEFT JOIN class_ranks
+                        ON class_ranks.student_id=students.id AND class_ranks.subject=?
+                   WHERE students.class_group=? ORDER BY students.name""",
+                (subject, subject, class_group)
+            ).fetchall()
+            stats = conn.execute("SELECT * FROM class_stats WHERE class_group=? AND subject=?",
+                                 (class_group, subject)).fetchone()
+    return render_template("admin_grades.html", title="إدخال النقاط", class_choices=class_choices(),
+                           class_group=class_group, subject=subject, subjects=subjects,
+                           students=students, stats=stats, score_fields=SCORE_FIELDS)
+
+@app.post("/admin/grades")
+def admin_grades_save():
+    if not session.get("is_admin"):
+        return redirect(url_for("admin_login"))
+    class_group = request.form.get("class_group", "").strip()
+    subject = request.form.get("subject", "").strip()
+    if not class_group or not subject:
+        flash("الفوج والمادة مطلوبان.")
+        return redirect(url_for("admin_grades"))
+    now = datetime.now().strftime("%Y-%m-%d %H:%M")
+    report = []
+    with get_db() as conn:
+        students = conn.execute("SELECT id, name FROM students WHERE class_group=?",
+                                (class_group,)).fetchall()
+    records = (
+        (s["name"], s["id"], {k: request.form.get(f"{k}-{s['id']}") for k in SCORE_FIELDS})
+        for s in students
+    )
+    # القيم تُقرأ من النموذج هنا (خيط الطلب) ثم تُكتب دفعة واحدة عبر الكاتب
+    params = list(assessment_params(records, subject, now, report))
+
+    def save(conn):
+        conn.executemany(UPSERT_ASSESSMENT_SQL, params)
+        if params:
+            publish(conn, f"group:{class_group}", "class_grades")
+
+    db_write(save)
+    saved = sum(1 for r in report if r["ok"])
+    flash(f"تم حفظ نقاط {saved} تلميذ.")
+    for r in report:
+        if not r["ok"]:
+            flash(f"{r['line']}: {r['message']}")
+    return redirect(url_for("admin_grades", class_group=class_group, subject=subject))
+
+@app.post("/admin/grades/import")
+def admin_grades_import():
+    if not session.get("is_admin"):
+        return redirect(url_for("admin_login"))
+    class_group = request.form.get("class_group", "").strip()
+    subject = request.form.get("subject", "").strip()
+    file = request.files.get("file")
+    if not class_group or not file or not file.filename:
+        flash("الفوج والملف مطلوبان.")
+        return redirect(url_for("admin_grades"))
+    if file.filename.rsplit(".", 1)[-1].lower() not in IMPORT_EXTENSIONS:
+        flash("صيغة الملف غير مسموحة. المسموح: CSV, XLSX")
+        return redirect(url_for("admin_grades"))
+    now = datetime.now().strftime("%Y-%m-%d %H:%M")
+    report = []
+    try:
+        rows = list(iter_sheet_rows(file))
+    except SHEET_ERRORS:
+        flash("تعذرت قراءة الملف. تأكد أنه CSV بترميز UTF-8 أو XLSX صالح.")
+        return redirect(url_for("admin_grades", class_group=class_group, subject=subject))
+    with get_db() as conn:
+        ids = dict(conn.execute("SELECT code, id FROM students WHERE class_group=?", (class_group,)))
+    records = ((line, ids.get(str(rec.get("code") or "").strip()), rec) for line, rec in rows)
+    params = list(assessment_params(records, subject, now, report))
+
+    def save(conn):
+        conn.executemany(UPSERT_ASSESSMENT_SQL, params)
+        if params:
+            publish(conn, f"group:{class_group}", "class_grades")
+
+    db_write(save)
+    return import_report("نتيجة استيراد النقاط", report)
+
+@app.post("/admin/students/import")
+def admin_students_import():
+    if not session.get("is_admin"):
+        return redirect(url_for("admin_login"))
+    file = request.files.get("file")
+    if not file or not file.filename:
+        flash("الملف مطلوب.")
+        return redirect(url_for("admin_grades"))
+    if file.filename.rsplit(".", 1)[-1].lower() not in IMPORT_EXTENSIONS:
+        flash("صيغة الملف غير مسموحة. المسموح: CSV, XLSX")
+        return redirect(url_for("admin_grades"))
+    report = []
+    groups = set(class_choices())
+
+    def student_params(rows, codes):
+        for line, rec in rows:
+            name = str(rec.get("name") or "").strip()
+            code = str(rec.get("code") or "").strip()
+            class_group = str(rec.get("class_group") or "").strip()
+            if not name or not code or not class_group:
+                report.append({"line": line, "ok": False, "message": "الاسم والكود والفوج مطلوبة."})
+            elif class_group not in groups:
+                report.append({"line": line, "ok": False, "message": f"فوج غير معروف: {class_group}"})
+            elif code in codes:
+                report.append({"line": line, "ok": False, "message": f"الكود {code} مستخدم بالفعل."})
+            else:
+                codes.add(code)
+                report.append({"line": line, "ok": True, "message": name})
+                yield (name, code, class_group)
+
+    try:
+        rows = list(iter_sheet_rows(file))
+    except SHEET_ERRORS:
+        flash("تعذرت قراءة الملف. تأكد أنه CSV بترميز UTF-8 أو XLSX صالح.")
+        return redirect(url_for("admin_grades"))
+    with get_db() as conn:
+        codes = {r[0] for r in conn.execute("SELECT code FROM students")}
+    params = list(student_params(rows, codes))
+    try:
+        # كود أُضيف بين القراءة والكتابة يُفشل الاستيراد كله (لا يُحفظ منه شيء)
+        db_write(lambda conn: conn.executemany("INSERT INTO students (name, code, class_group) VALUES (?, ?, ?)",
+                                               params))
+    except database.IntegrityError:
+        flash("أحد الأكواد أُضيف في نفس الوقت من مكان آخر، أعد المحاولة.")
+        return redirect(url_for("admin_grades"))
+    return import_report("نتيجة استيراد التلاميذ", report)
+
+# --------------------- التصدير ---------------------
+# كشف نقاط فوج كامل (أو مادة واحدة) بصيغة CSV أو XLSX.
+# الأسطر تُقرأ من المؤشر على دفعات وتُرسل فورًا (generator)، فالذاكرة ثابتة مهما كبر الفوج.
+# الأعمدة تبدأ بأعمدة ملف الاستيراد (code, subject, ca, t1, t2, exam) فيمكن تعديل الملف وإعادة رفعه.
+EXPORT_COLUMNS = ("code", "name", "class_group", "subject", *SCORE_FIELDS, "final", "rank")
+EXPORT_MIMETYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+EXPORT_BATCH = 500
+
+def export_batches(conn, class_group, subject=None):
+    """دفعات من أسطر الكشف؛ التلميذ الذي لا نقاط له يظهر بسطر فارغ حتى لا يسقط من القائمة.
+
+    الترتيب بترتيب التسجيل (id) لا بالاسم: يتبع الفهرسين ix_students_group_id و ux_assessments_student_subject
+    فلا تحتاج SQLite إلى فرز مؤقت، ويصل أول سطر قبل قراءة الفوج كاملًا.
+    """
+    params = (subject, class_group) if subject else (class_group,)
+    return conn.batches(export_sql(subject), params, EXPORT_BATCH)
+
+def export_sql(subject=None):
+    subject_clause = "AND assessments.subject=?" if subject else ""
+    return f"""SELECT students.code, students.name, students.class_group, assessments.subject,
+                      assessments.ca, assessments.t1, assessments.t2, assessments.exam,
+                      assessments.final, class_ranks.rank
+               FROM students LEFT JOIN assessments
+                    ON assessments.student_id=students.id {subject_clause}
+               LEFT JOIN class_ranks
+                    ON class_ranks.student_id=students.id AND class_ranks.subject=assessments.subject
+               WHERE students.class_group=?
+               ORDER BY students.id, assessments.subject"""
+
+def iter_csv(batches):
+    sink = ChunkSink()
+    # BOM حتى يفتح Excel الملف بترميز UTF-8 (الأسماء بالعربية)
+    text = io.TextIOWrapper(sink, encoding="utf-8-sig", newline="", write_through=True)
+    writer = csv.writer(text)
+    writer.writerow(EXPORT_COLUMNS)
+    yield sink.drain()
+    for batch in batches:
+        writer.writerows(["" if v is None else v for v in r] for r in batch)
+        yield sink.drain()
+
+XLSX_PARTS = {
+    "[Content_Types].xml": """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+</Types>""",
+    "_rels/.rels": """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>""",
+    "xl/workbook.xml": """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets><sheet name="grades" sheetId="1" r:id="rId1"/></sheets>
+</workbook>""",
+    "xl/_rels/workbook.xml.rels": """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>
+</Relationships>""",
+}
+
+def xlsx_row(n, values):
+    cells = []
+    for col, v in zip("ABCDEFGHIJKLMNOPQRSTUVWXYZ", values):
+        if v is None:
+            continue
+        if isinstance(v, (int, float)):
+            cells.append(f'<c r="{col}{n}"><v>{v}</v></c>')
+        else:
+            cells.append(f'<c r="{col}{n}" t="inlineStr"><is><t>{html.escape(str(v), quote=False)}</t></is></c>')
+    return f'<row r="{n}">{"".join(cells)}</row>'.encode()
+
+def iter_xlsx(batches):
+    # openpyxl يكتب الملف كاملًا عند save()؛ هنا نكتب أجزاء XLSX مباشرة داخل zip متدفق
+    # (نصوص inlineStr بلا sharedStrings) فيخرج كل سطر فور قراءته من القاعدة
+    sink = ChunkSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, body in XLSX_PARTS.items():
+            zf.writestr(name, body)
+        with zf.open("xl/worksheets/sheet1.xml", "w") as sheet:
+            sheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                        b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                        b'<sheetViews><sheetView rightToLeft="1" workbookViewId="0"/></sheetViews><sheetData>')
+            sheet.write(xlsx_row(1, EXPORT_COLUMNS))
+            yield sink.drain()
+            n = 1
+            for batch in batches:
+                for r in batch:
+                    n += 1
+                    sheet.write(xlsx_row(n, r))
+                yield sink.drain()
+            sheet.write(b"</sheetData></worksheet>")
+    yield sink.drain()
+
+@app.get("/admin/grades/export.<fmt>")
+def admin_grades_export(fmt):
+    if not session.get("is_admin"):
+        return redirect(url_for("admin_login"))
+    if fmt not in EXPORT_MIMETYPES:
+        abort(404)
+    class_group = request.args.get("class_group", "").strip()
+    subject = request.args.get("subject", "").strip()
+    if not class_group:
+        flash("اختر الفوج أولاً.")
+        return redirect(url_for("admin_grades"))
+
+    def generate():
+        batches = export_batches(get_db(), class_group, subject or None)
+        chunks = iter_csv(batches) if fmt == "csv" else iter_xlsx(batches)
+        for chunk in chunks:
+            if chunk:
+                yield chunk
+
+    filename = " ".join(filter(None, ["نقاط", class_group, subject])) + f".{fmt}"
+    resp = Response(stream_with_context(generate()), mimetype=EXPORT_MIMETYPES[fmt])
+    resp.headers["Content-Disposition"] = (
+        f"attachment; filename=grades.{fmt}; filename*=UTF-8''{urllib.parse.quote(filename)}")
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+# --------------------- أرشيف السنوات الدراسية ---------------------
+# في نهاية السنة: flask --app app rollover 2024-2025
+# ينقل تلاميذ السنة ونقاطهم وبيانات ملفاتها إلى ملف SQLite مستقل (archive/2024-2025.db)، فتبقى
+# الجداول الساخنة للسنة الحالية وحدها. حدود السنة (أكبر id للتلاميذ والملفات) تُثبَّت في rollovers
+# عند البدء: ما يُضاف بعدها لا يُنقل، وإعادة تشغيل الأمر بعد انقطاع تكمل من حيث توقف.
+# النقل على دفعات، كل دفعة معاملة كتابة قصيرة يليها توقف قصير، فيبقى الموقع يخدم أثناءه.
+# الترتيب وإحصاءات القسم تُنسخ عند البدء، قبل أن يغيّرها حذف أول دفعة (triggers).
+# محتوى الملفات يبقى في المخزن المشترك؛ الأرشيف يحفظ بياناتها، و collect_blob لا يحذف بصمة يشير إليها
+# أرشيف. لكل مدرسة مجلد أرشيفها (Tenant.archive_folder).
+ROLLOVER_BATCH = 200   # عدد التلاميذ (أو الملفات) في كل دفعة
+ROLLOVER_PAUSE_MS = 50
+SCHOOL_YEAR_RE = re.compile(r"\d{4}-\d{4}")
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS students (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    code TEXT NOT NULL,
+    class_group TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_students_group_name ON students(class_group, name);
+CREATE TABLE IF NOT EXISTS assessments (
+    id INTEGER PRIMARY KEY,
+    student_id INTEGER NOT NULL,
+    subject TEXT NOT NULL,
+    ca REAL,
+    t1 REAL,
+    t2 REAL,
+    exam REAL,
+    final REAL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_assessments_student ON assessments(student_id);
+CREATE TABLE IF NOT EXISTS class_stats (
+    class_group TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    n INTEGER NOT NULL,
+    mean REAL,
+    min REAL,
+    max REAL,
+    PRIMARY KEY (class_group, subject)
+);
+CREATE TABLE IF NOT EXISTS class_ranks (
+    student_id INTEGER NOT NULL,
+    class_group TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    rank INTEGER NOT NULL,
+    PRIMARY KEY (student_id, subject)
+);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    class_group TEXT NOT NULL,
+    uploaded_at TEXT NOT NULL,
+    size INTEGER,
+    sha256 TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_files_group_id ON files(class_group, id);
+CREATE INDEX IF NOT EXISTS ix_files_sha256 ON files(sha256);
+"""
+
+# الأعمدة المنسوخة من الجداول الساخنة إلى جداول الأرشيف بنفس الأسماء
+ARCHIVE_COLUMNS = {
+    "students": ("id", "name", "code", "class_group"),
+    "assessments": ("id", "student_id", "subject", *SCORE_FIELDS, "final", "created_at"),
+    "class_stats": ("class_group", "subject", "n", "mean", "min", "max"),
+    "class_ranks": ("student_id", "class_group", "subject", "rank"),
+    "files": ("id", "title", "filename", "class_group", "uploaded_at", "size", "sha256"),
+}
+
+def archive_path(year):
+    return os.path.join(current_tenant().archive_folder, f"{year}.db")
+
+def open_archive(year, readonly=True):
+    path = archive_path(year)
+    if readonly:
+        conn = sqlite3.connect(f"file:{urllib.parse.quote(path)}?mode=ro", uri=True)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = sqlite3.connect(path)
+        # WAL: صفحات الأرشيف تبقى قابلة للقراءة أثناء النقل
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(ARCHIVE_SCHEMA)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def archive_years():
+    folder = current_tenant().archive_folder
+    if not os.path.isdir(folder):
+        return []
+    return sorted(name[:-3] for name in os.listdir(folder)
+                  if name.endswith(".db") and SCHOOL_YEAR_RE.fullmatch(name[:-3]))
+
+def archived_blob(sha256):
+    """هل يشير ملف في أرشيف إحدى السنوات إلى هذه البصمة؟"""
+    for year in archive_years():
+        conn = open_archive(year)
+        try:
+            if conn.execute("SELECT 1 FROM files WHERE sha256=? LIMIT 1", (sha256,)).fetchone():
+                return True
+        finally:
+            conn.close()
+    return False
+
+def copy_to_archive(conn, archive, table, where, params):
+    """ينسخ أسطر table المطابقة لـ where كما هي؛ INSERT OR REPLACE يجعل إعادة الدفعة آمنة."""
+    columns = ARCHIVE_COLUMNS[table]
+    rows = conn.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE {where}", params)
+    archive.executemany(
+        f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+        (tuple(r) for r in rows))
+
+def rollover_batches(conn, archive, table, max_id, batch, move, pause):
+    """ينقل أسطر table حتى max_id دفعة بعد دفعة؛ move(conn, ids) تنسخ وتحذف. يُرجع عدد المنقول."""
+    moved = 0
+    while True:
+        with direct_write(conn):
+            ids = [r[0] for r in conn.execute(
+                f"SELECT id FROM {table} WHERE id <= ? ORDER BY id LIMIT ?", (max_id, batch))]
+            if ids:
+                move(conn, ids)
+        if not ids:
+            return moved
+        moved += len(ids)
+        yield moved
+        time.sleep(pause)
+
+def move_students(archive):
+    def move(conn, ids):
+        marks = ", ".join("?" * len(ids))
+        copy_to_archive(conn, archive, "students", f"id IN ({marks})", ids)
+        copy_to_archive(conn, archive, "assessments", f"student_id IN ({marks})", ids)
+        # الأرشيف يُثبَّت قبل الحذف: انقطاع بينهما يُعيد الدفعة نفسها فقط
+        archive.commit()
+        pairs = conn.execute(
+            f"""SELECT DISTINCT s.class_group, a.subject FROM students s JOIN assessments a ON a.student_id=s.id
+                WHERE s.id IN ({marks})""", ids).fetchall()
+        # triggers النقاط تعيد حساب فوج التلميذ مع كل سطر محذوف (آلاف المرات في الدفعة)؛ بفوج مؤقت
+        # خاص بكل تلميذ لا تجد ما تحسبه، ونعيد حساب كل فوج/مادة متأثرة مرة واحدة بعد الحذف
+        conn.execute(f"DELETE FROM class_ranks WHERE student_id IN ({marks})", ids)
+        conn.execute(f"UPDATE students SET class_group='~' || id WHERE id IN ({marks})", ids)
+        conn.execute(f"DELETE FROM assessments WHERE student_id IN ({marks})", ids)
+        conn.execute(f"DELETE FROM students WHERE id IN ({marks})", ids)
+        refresh = [stmt for stmt in class_stats_refresh_sql("?", "?").split(";") if stmt.strip()]
+        for group, subject in pairs:
+            for stmt in refresh:
+                conn.execute(stmt, (group, subject))
+        for group in {group for group, _ in pairs}:
+            conn.execute("UPDATE group_versions SET grades_version = grades_version + 1 WHERE class_group=?",
+                         (group,))
+            publish(conn, f"group:{group}", "class_grades")
+    return move
+
+def move_files(archive):
+    def move(conn, ids):
+        marks = ", ".join("?" * len(ids))
+        copy_to_archive(conn, archive, "files", f"id IN ({marks})", ids)
+        archive.commit()
+        groups = [r[0] for r in conn.execute(
+            f"SELECT DISTINCT class_group FROM files WHERE id IN ({marks})", ids)]
+        conn.execute(f"DELETE FROM files WHERE id IN ({marks})", ids)
+        for group in groups:
+            publish(conn, f"group:{group}", "files")
+    return move
+
+def rollover_year(year, batch=ROLLOVER_BATCH, pause=ROLLOVER_PAUSE_MS / 1000, echo=print):
+    if not SCHOOL_YEAR_RE.fullmatch(year):
+        raise ValueError("السنة الدراسية بصيغة 2024-2025")
+    conn = get_db()
+    pending = conn.execute("SELECT school_year FROM rollovers WHERE finished_at IS NULL AND school_year<>?",
+                           (year,)).fetchone()
+    if pending:
+        raise ValueError(f"أرشفة {pending[0]} لم تكتمل؛ أعد تشغيلها أولًا")
+    state = conn.execute("SELECT * FROM rollovers WHERE school_year=?", (year,)).fetchone()
+    if state and state["finished_at"]:
+        echo(f"{year}: مؤرشفة منذ {state['finished_at']}")
+        return
+    archive = open_archive(year, readonly=False)
+    try:
+        if state is None:
+            # الحدود ونسخة الترتيب والإحصاءات تُؤخذ معًا تحت قفل الكتابة
+            with direct_write(conn):
+                max_student = conn.execute("SELECT COALESCE(MAX(id), 0) FROM students").fetchone()[0]
+                max_file = conn.execute("SELECT COALESCE(MAX(id), 0) FROM files").fetchone()[0]
+                copy_to_archive(conn, archive, "class_stats", "1=1", ())
+                copy_to_archive(conn, archive, "class_ranks", "student_id <= ?", (max_student,))
+                archive.commit()
+                conn.execute(
+                    "INSERT INTO rollovers (school_year, max_student_id, max_file_id, started_at) VALUES (?, ?, ?, ?)",
+                    (year, max_student, max_file, datetime.now().strftime("%Y-%m-%d %H:%M")))
+            state = conn.execute("SELECT * FROM rollovers WHERE school_year=?", (year,)).fetchone()
+        for n in rollover_batches(conn, archive, "students", state["max_student_id"], batch,
+                                  move_students(archive), pause):
+            echo(f"{year}: {n} تلميذ")
+        for n in rollover_batches(conn, archive, "files", state["max_file_id"], batch,
+                                  move_files(archive), pause):
+            echo(f"{year}: {n} ملف")
+        with direct_write(conn):
+            conn.execute("UPDATE rollovers SET finished_at=? WHERE school_year=?",
+                         (datetime.now().strftime("%Y-%m-%d %H:%M"), year))
+        echo(f"{year}: اكتملت الأرشفة في {archive_path(year)}")
+    finally:
+        archive.close()
+
+@app.cli.command("rollover")
+@click.argument("year")
+@click.option("--batch", default=ROLLOVER_BATCH, show_default=True, help="عدد الأسطر في كل معاملة")
+@click.option("--pause-ms", default=ROLLOVER_PAUSE_MS, show_default=True, help="توقف بين الدفعات")
+@click.option("--tenant", "tenant_name", default="", help="المدرسة (مع TENANT_MODE)")
+def rollover_command(year, batch, pause_ms, tenant_name):
+    """أرشفة سنة دراسية منتهية: flask --app app rollover 2024-2025 (يُستأنف إن انقطع)."""
+    ensure_app()
+    with cli_tenant(tenant_name):
+        try:
+            rollover_year(year, batch, pause_ms / 1000, echo=click.echo)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+
+@contextmanager
+def archive_db(year):
+    """اتصال قراءة فقط بأرشيف السنة، يُفتح عند الطلب ويُغلق بعده."""
+    if not SCHOOL_YEAR_RE.fullmatch(year) or not os.path.exists(archive_path(year)):
+        abort(404)
+    conn = open_archive(year)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+TEMPLATES["admin_archive.html"] = """{% extends "base.html" %}
+{% block content %}
+    <div class="card">
+      <div class="topbar">
+        <h2>أرشيف السنوات الدراسية</h2>
+        <a class="btn secondary" href="{{ url_for('admin_dashboard') }}">رجوع</a>
+      </div>
+      <table>
+        <thead><tr><th>السنة</th><th>بدأت الأرشفة</th><th>اكتملت</th><th></th></tr></thead>
+        <tbody>
+        {% for y in years %}
+          <tr>
+            <td>{{ y['school_year'] }}</td>
+            <td class="muted">{{ y['started_at'] }}</td>
+            <td class="muted">{{ y['finished_at'] or 'جارية…' }}</td>
+            <td><a class="btn secondary" href="{{ url_for('admin_archive_year', year=y['school_year']) }}">عرض</a></td>
+          </tr>
+        {% else %}
+          <tr><td colspan="4" class="muted">لا توجد سنوات مؤرشفة. في نهاية السنة: <code>flask --app app rollover 2024-2025</code></td></tr>
+        {% endfor %}
+        </tbody>
+      </table>
+    </div>
+{% endblock %}
+"""
+
+TEMPLATES["admin_archive_year.html"] = """{% extends "base.html" %}
+{% block content %}
+    <div class="card">
+      <div class="topbar">
+        <h2>أرشيف {{ year }}</h2>
+        <a class="btn secondary" href="{{ url_for('admin_archive') }}">رجوع</a>
+      </div>
+      <form method="get" class="grid two">
+        <select name="class_group">
+          {% for g in groups %}
+            <option value="{{ g }}" {% if g == class_group %}selected{% endif %}>{{ g }}</option>
+          {% endfor %}
+        </select>
+        <div><button class="btn secondary" type="submit">عرض الفوج</button></div>
+      </form>
+    </div>
+
+    <div class="card">
+      <h3>التلاميذ ({{ class_group or '—' }})</h3>
+      <table>
+        <thead><tr><th>الإسم و اللقب</th><th>الكود</th><th></th></tr></thead>
+        <tbody>
+        {% for s in students %}
+          <tr>
+            <td>{{ s['name'] }}</td>
+            <td><code>{{ s['code'] }}</code></td>
+            <td><a class="btn secondary" href="{{ url_for('admin_archive_student', year=year, student_id=s['id']) }}">كشف النقاط</a></td>
+          </tr>
+        {% else %}
+          <tr><td colspan="3" class="muted">لا شيء.</td></tr>
+        {% endfor %}
+        </tbody>
+      </table>
+    </div>
+
+    <div class="card">
+      <h3>الملفات</h3>
+      <table>
+        <thead><tr><th>العنوان</th><th>الملف</th><th>التاريخ</th><th></th></tr></thead>
+        <tbody>
+        {% for f in files %}
+          <tr>
+            <td>{{ f['title'] }}</td>
+            <td class="muted">{{ f['filename'] }}</td>
+            <td class="muted">{{ f['uploaded_at'] }}</td>
+            <td><a class="btn secondary" href="{{ url_for('admin_archive_file', year=year, file_id=f['id']) }}">تنزيل</a></td>
+          </tr>
+        {% else %}
+          <tr><td colspan="4" class="muted">لا شيء.</td></tr>
+        {% endfor %}
+        </tbody>
+      </table>
+    </div>
+{% endblock %}
+"""
+
+TEMPLATES["admin_archive_student.html"] = """{% extends "base.html" %}
+{% block content %}
+    <div class="card">
+      <div class="topbar">
+        <h2>{{ student['name'] }} <span class="tag">{{ student['class_group'] }} — {{ year }}</span></h2>
+        <a class="btn secondary" href="{{ url_for('admin_archive_year', year=year, class_group=student['class_group']) }}">رجوع</a>
+      </div>
+      <p class="muted">الكود: <code>{{ student['code'] }}</code></p>
+      <table>
+        <thead>
+          <tr><th>المادة</th><th>تقويم</th><th>فرض1</th><th>فرض2</th><th>اختبار</th><th>المعدل</th><th>الترتيب</th><th>معدل القسم</th></tr>
+        </thead>
+        <tbody>
+        {% for r in rows %}
+          <tr>
+            <td>{{ r['subject'] }}</td>
+            <td>{{ r['ca'] if r['ca'] is not none else '—' }}</td>
+            <td>{{ r['t1'] if r['t1'] is not none else '—' }}</td>
+            <td>{{ r['t2'] if r['t2'] is not none else '—' }}</td>
+            <td>{{ r['exam'] if r['exam'] is not none else '—' }}</td>
+            <td><strong>{{ r['final'] if r['final'] is not none else '—' }}</strong></td>
+            <td>{{ '%d / %d'|format(r['rank'], r['n']) if r['rank'] is not none else '—' }}</td>
+            <td>{{ r['mean'] if r['mean'] is not none else '—' }}</td>
+          </tr>
+        {% else %}
+          <tr><td colspan="8" class="muted">لا توجد نقاط.</td></tr>
+        {% endfor %}
+        </tbody>
+      </table>
+    </div>
+{% endblock %}
+"""
+
+@app.get("/admin/archive")
+def admin_archive():
+    if not session.get("is_admin"):
+        return redirect(url_for("admin_login"))
+    with get_db() as conn:
+        years = conn.execute("SELECT * FROM rollovers ORDER BY school_year DESC").fetchall()
+    return render_template("admin_archive.html", title="الأرشيف", years=years)
+
+@app.get("/admin/archive/<year>")
+def admin_archive_year(year):
+    if not session.get("is_admin"):
+        return redirect(url_for("admin_login"))
+    with archive_db(year) as conn:
+        groups = [r[0] for r in conn.execute("SELECT DISTINCT class_group FROM students ORDER BY class_group")]
+        class_group = request.args.get("class_group") or (groups[0] if groups else "")
+        students = conn.execute("SELECT id, name, code FROM students WHERE class_group=? ORDER BY name",
+                                (class_group,)).fetchall()
+        files = conn.execute("SELECT id, title, filename, uploaded_at FROM files WHERE class_group=? ORDER BY id DESC",
+                             (class_group,)).fetchall()
+    return render_template("admin_archive_year.html", title=f"أرشيف {year}", year=year, groups=groups,
+                           class_group=class_group, students=students, files=files)
+
+@app.get("/admin/archive/<year>/student/<int:student_id>")
+def admin_archive_student(year, student_id):
+    if not session.get("is_admin"):
+        return redirect(url_for("admin_login"))
+    with archive_db(year) as conn:
+        student = conn.execute("SELECT * FROM students WHERE id=?", (student_id,)).fetchone()
+        if student is None:
+            abort(404)
+        rows = conn.execute(
+            """SELECT a.subject, a.ca, a.t1, a.t2, a.exam, a.final, r.rank, cs.n, cs.mean
+               FROM assessments a
+               LEFT JOIN class_ranks r ON r.student_id=a.student_id AND r.subject=a.subject
+               LEFT JOIN class_stats cs ON cs.class_group=? AND cs.subject=a.subject
+               WHERE a.student_id=? ORDER BY a.subject""",
+            (student["class_group"], student_id)
+        ).fetchall()
+    return render_template("admin_archive_student.html", title=student["name"], year=year,
+                           student=student, rows=rows)
+
+@app.get("/admin/archive/<year>/file/<int:file_id>")
+def admin_archive_file(year, file_id):
+    if not session.get("is_admin"):
+        return redirect(url_for("admin_login"))
+    with archive_db(year) as conn:
+        f = conn.execute("SELECT * FROM files WHERE id=?", (file_id,)).fetchone()
+    if f is None:
+        abort(404)
+    if not f["sha256"]:
+        try:
+            size, mtime, etag = file_metadata(legacy_path(f))
+        except FileNotFoundError:
+            abort(404)
+        return send_stored_file(f, size, mtime, etag)
+    # الأرشيف لا يحفظ mtime و etag: المحتوى ثابت لبصمته، وتاريخ الرفع يكفي لـ Last-Modified
+    try:
+        mtime = datetime.strptime(f["uploaded_at"], "%Y-%m-%d %H:%M").timestamp()
+    except ValueError:
+        mtime = 0
+    return send_stored_file(f, f["size"], mtime, f["sha256"])
+
+# --------------------- المدارس (tenants) ---------------------
+# نشر واحد يخدم عدة أساتذة/مدارس. TENANT_MODE يحدد مدرسة الطلب:
+#   "" (الافتراضي): مدرسة واحدة في DATA_DIR كما كانت؛
+#   host: من اسم النطاق (<المدرسة>.TENANT_DOMAIN، أو أول جزء منه إن لم يُحدَّد TENANT_DOMAIN)؛
+#   path: من أول جزء في المسار (/<المدرسة>/...)، ويصير بادئة كل الروابط (SCRIPT_NAME).
+# لكل مدرسة قاعدتها (DATA_DIR/tenants/<المدرسة>/school.db، أو مخطط t_<المدرسة> في PostgreSQL)
+# وملفاتها وأرشيفها وكاتبها ومنفّذ مهامها وذاكرة أفواجها: لا تنتظر مدرسة قفل كتابة أخرى،
+# ولا تُخرج بيانات أخرى من الذاكرة. المدرسة تُنشأ بـ flask --app app tenant create <الاسم>.
+# المدارس المفتوحة في كل عامل محدودة (LRU): الأقدم استعمالًا تُغلق حين يزيد عددها عن
+# TENANT_CACHE_SIZE، وكذلك كل مدرسة بلا طلبات منذ TENANT_IDLE_SECONDS؛ مدرسة فيها طلب جارٍ لا تُغلق.
+TENANT_MODE = os.environ.get("TENANT_MODE", "").lower()
+TENANT_DOMAIN = os.environ.get("TENANT_DOMAIN", "").lower()
+TENANT_CACHE_SIZE = int(os.environ.get("TENANT_CACHE_SIZE", "32"))
+TENANT_IDLE_SECONDS = int(os.environ.get("TENANT_IDLE_SECONDS", "600"))
+TENANT_SWEEP_SECONDS = 60        # أقصى مدة بين بحثين عن المدارس الخاملة
+TENANT_SETTINGS_SECONDS = 5      # العمّال الآخرون يرون تعديل الإعدادات بعد هذه المدة على الأكثر
+TENANT_NAME_RE = re.compile(r"[a-z0-9](?:[a-z0-9-]{0,30}[a-z0-9])?")
+TENANT_RESERVED = {"assets", "metrics"}                           # مسارات الموقع كله في وضع path
+TENANT_FREE_ENDPOINTS = {"metrics", "site_css", "live_js", "static"}  # لا تخص مدرسة
+TENANTS_DIR = None      # DATA_DIR/tenants
+default_tenant = None   # المدرسة الوحيدة (بلا TENANT_MODE)
+tenants = None          # TenantRegistry (مع TENANT_MODE)
+
+_tenant_local = threading.local()
+
+class Tenant:
+    """مدرسة واحدة: قاعدتها ومخزنها ومجلداتها، وكاتبها ومنفّذ مهامها وموزّع أحداثها في هذه العملية."""
+
+    def __init__(self, name, data_dir, upload_folder, archive_folder, database):
+        self.name = name
+        self.data_dir = data_dir
+        self.upload_folder = upload_folder
+        self.blob_folder = os.path.join(upload_folder, "blobs")
+        self.bundle_folder = os.path.join(upload_folder, "bundles")
+        self.archive_folder = archive_folder
+        self.database = database
+        self.storage = make_storage(STORAGE_BACKEND, self)
+        self.local = threading.local()          # اتصال كل خيط (get_db)
+        self.write_queue = WriteQueue(self)
+        self.job_runner = JobRunner(self, JOB_THREADS)
+        self.change_hub = ChangeHub(self)
+        self.group_cache = OrderedDict()
+        self.group_cache_lock = threading.Lock()
+        self.settings = None                    # (وقت القراءة، القيم)، انظر school_settings
+        self.active = 0                         # طلبات جارية (TenantRegistry)
+        self.last_used = time.monotonic()
+
+    def open(self, migrate=True):
+        os.makedirs(self.data_dir, exist_ok=True)
+        os.makedirs(self.blob_folder, exist_ok=True)
+        if migrate:
+            with use_tenant(self):
+                database.migrate(get_db())
+                close_db()
+        return self
+
+    def close(self):
+        """يوقف خيوط المدرسة ويغلق مجمع اتصالاتها؛ تُستدعى وهي بلا طلبات جارية."""
+        self.write_queue.stop()
+        self.job_runner.stop()
+        self.change_hub.stop()
+        self.database.dispose()
+
+def tenant_dir(name):
+    return os.path.join(TENANTS_DIR, name)
+
+def open_tenant(name):
+    root = tenant_dir(name)
+    # PostgreSQL: قاعدة واحدة ومخطط لكل مدرسة؛ وإلا ملف SQLite في مجلدها
+    url = DATABASE_URL if DATABASE_URL.startswith(("postgres://", "postgresql://")) else ""
+    return Tenant(name, root, os.path.join(root, "uploads"), os.path.join(root, "archive"),
+                  make_database(url, root, schema="t_" + name.replace("-", "_")))
+
+def tenant_names():
+    """المدارس الموجودة (مجلداتها في DATA_DIR/tenants)، أو [""] للمدرسة الوحيدة."""
+    if not TENANT_MODE:
+        return [""]
+    if not os.path.isdir(TENANTS_DIR):
+        return []
+    return sorted(name for name in os.listdir(TENANTS_DIR)
+                  if TENANT_NAME_RE.fullmatch(name) and os.path.isdir(tenant_dir(name)))
+
+class TenantRegistry:
+    """المدارس المفتوحة في هذه العملية، الأحدث استعمالًا في آخر الترتيب (LRU)."""
+
+    def __init__(self, size, idle, migrate):
+        self.size = size
+        self.idle = idle
+        self.migrate = migrate
+        self.lock = threading.Lock()
+        self.open = OrderedDict()     # name -> Tenant
+        # قفل لكل مدرسة تُفتح الآن: فتحها (وترحيل قاعدتها) لا يوقف طلبات المدارس الأخرى
+        self.opening = {}
+        self.swept = time.monotonic()
+
+    def hold(self, name):
+        tenant = self.open.get(name)
+        if tenant is not None:
+            self.open.move_to_end(name)
+            tenant.active += 1
+        return tenant
+
+    def acquire(self, name):
+        """المدرسة مفتوحة ومحجوزة حتى release، أو None إن لم تكن موجودة."""
+        with self.lock:
+            tenant = self.hold(name)
+        if tenant is not None:
+            metric_inc("school_tenants_total", (("result", "hit"),))
+            return tenant
+        # قبل أي قفل أو ذاكرة: أسماء عشوائية في النطاق لا تترك أثرًا
+        if not os.path.isdir(tenant_dir(name)):
+            return None
+        with self.lock:
+            opening = self.opening.setdefault(name, threading.Lock())
+        with opening:
+            with self.lock:
+                tenant = self.hold(name)
+            if tenant is not None:
+                # فتحها طلب سبقنا على نفس القفل
+                return tenant
+            try:
+                tenant = open_tenant(name).open(self.migrate)
+            except BaseException:
+                with self.lock:
+                    self.opening.pop(name, None)
+                raise
+            # النشر وإزالة قفل الفتح معًا: طلب جديد يجد المدرسة في open أو ينتظر على قفلها، فلا يفتح نسخة ثانية
+            with self.lock:
+                tenant.active = 1
+                self.open[name] = tenant
+                self.opening.pop(name, None)
+                evicted = self.evict()
+        metric_inc("school_tenants_total", (("result", "open"),))
+        self.discard(evicted)
+        return tenant
+
+    def release(self, tenant):
+        now = time.monotonic()
+        with self.lock:
+            tenant.active -= 1
+            tenant.last_used = now
+            evicted = self.evict() if now - self.swept >= TENANT_SWEEP_SECONDS else []
+        self.discard(evicted)
+
+    def evict(self):
+        """(تحت self.lock) يُخرج الزائد عن الحد من الأقدم استعمالًا، والخامل، ما لم يكن فيه طلب جارٍ."""
+        now = self.swept = time.monotonic()
+        extra = len(self.open) - self.size
+        evicted = []
+        for name, tenant in list(self.open.items()):
+            if tenant.active:
+                continue
+            if extra > 0 or now - tenant.last_used > self.idle:
+                del self.open[name]
+                evicted.append(tenant)
+                extra -= 1
+        return evicted
+
+    def discard(self, evicted):
+        for tenant in evicted:
+            metric_inc("school_tenants_total", (("result", "evict"),))
+            tenant.close()
+
+    def close_all(self):
+        with self.lock:
+            evicted = list(self.open.values())
+            self.open.clear()
+        self.discard(evicted)
+
+def current_tenant():
+    """المدرسة التي يعمل عليها الكود الآن: use_tenant (خيوط الخلفية وأوامر flask)، ثم مدرسة الطلب،
+    ثم المدرسة الوحيدة."""
+    tenant = getattr(_tenant_local, "tenant", None)
+    if tenant is None and has_request_context():
+        tenant = g.get("tenant")
+    if tenant is None:
+        tenant = default_tenant
+    if tenant is None:
+        raise RuntimeError("no school selected: call create_app(), or use_tenant() with TENANT_MODE")
+    return tenant
+
+@contextmanager
+def use_tenant(tenant):
+    previous = getattr(_tenant_local, "tenant", None)
+    _tenant_local.tenant = tenant
+    try:
+        yield tenant
+    finally:
+        _tenant_local.tenant = previous
+
+def tenant_stream(chunks):
+    """رد متدفق يُرسل بعد نهاية الطلب (بلا سياق طلب): يعمل على مدرسة الطلب الذي أنشأه."""
+    tenant = current_tenant()
+
+    def stream():
+        with use_tenant(tenant):
+            yield from chunks
+    return stream()
+
+def request_tenant_name():
+    if TENANT_MODE == "path":
+        return request.environ.get("school.tenant", "")
+    name, _, domain = request.host.lower().rsplit(":", 1)[0].partition(".")
+    if TENANT_DOMAIN and domain != TENANT_DOMAIN:
+        return ""
+    return name
+
+def load_tenant():
+    """مدرسة الطلب في g.tenant، محجوزة حتى release_db؛ 404 لمدرسة غير موجودة."""
+    if not TENANT_MODE:
+        g.tenant = default_tenant
+        return
+    if request.endpoint in TENANT_FREE_ENDPOINTS:
+        return
+    name = request_tenant_name()
+    tenant = tenants.acquire(name) if TENANT_NAME_RE.fullmatch(name) and name not in TENANT_RESERVED else None
+    if tenant is None:
+        abort(404)
+    g.tenant = tenant
+    # جلسة مدرسة أخرى (ملف تعريف مشترك بين النطاقات أو المسارات) لا تصلح هنا
+    if (session.get("student_id") or session.get("is_admin")) and session.get("tenant") != name:
+        session.clear()
+
+def release_tenant(tenant):
+    if TENANT_MODE:
+        tenants.release(tenant)
+
+class TenantPathMiddleware:
+    """وضع path: /<المدرسة>/... ← SCRIPT_NAME=/<المدرسة> و PATH_INFO=/...، فتبقى المسارات كما هي
+    ويضيف url_for البادئة إلى كل رابط."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if TENANT_MODE == "path":
+            name, _, rest = environ.get("PATH_INFO", "").lstrip("/").partition("/")
+            if TENANT_NAME_RE.fullmatch(name) and name not in TENANT_RESERVED:
+                environ["SCRIPT_NAME"] = environ.get("SCRIPT_NAME", "") + "/" + name
+                environ["PATH_INFO"] = "/" + rest
+                environ["school.tenant"] = name
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = TenantPathMiddleware(app.wsgi_app)
+
+class TenantSessionInterface(SecureCookieSessionInterface):
+    """وضع path: ملف تعريف الجلسة على مسار المدرسة، فيبقى الدخول إلى مدرستين معًا في نفس المتصفح."""
+
+    def get_cookie_path(self, app):
+        if TENANT_MODE == "path" and has_request_context() and request.script_root:
+            return request.script_root + "/"
+        return super().get_cookie_path(app)
+
+app.session_interface = TenantSessionInterface()
+
+@contextmanager
+def cli_tenant(name):
+    """المدرسة التي يعمل عليها أمر flask: الوحيدة، أو --tenant مع TENANT_MODE."""
+    if not TENANT_MODE:
+        yield default_tenant
+        return
+    tenant = tenants.acquire(name) if TENANT_NAME_RE.fullmatch(name or "") else None
+    if tenant is None:
+        raise click.ClickException(f"مدرسة غير موجودة: {name!r} (--tenant)")
+    try:
+        with use_tenant(tenant):
+            yield tenant
+    finally:
+        tenants.release(tenant)
+
+def school_settings():
+    """إعدادات المدرسة الحالية: اسم الموقع والمؤسسة، بصمة كود الأستاذ، والأفواج.
+    تُقرأ من قاعدتها مرة كل TENANT_SETTINGS_SECONDS على الأكثر في كل عامل."""
+    tenant = current_tenant()
+    cached = tenant.settings
+    if cached and time.monotonic() - cached[0] < TENANT_SETTINGS_SECONDS:
+        return cached[1]
+    conn = get_db()
+    values = dict(conn.execute("SELECT key, value FROM settings").fetchall())
+    settings = {
+        "app_title": values.get("app_title") or APP_TITLE,
+        "school_name": values.get("school_name") or SCHOOL_NAME,
+        "admin_code_hash": values.get("admin_code_hash"),
+        "class_groups": [r[0] for r in conn.execute("SELECT name FROM class_groups ORDER BY position, name")],
+    }
+    # الاسمان في رأس كل صفحة، فيدخلان في ETag لوحة التلميذ
+    settings["fingerprint"] = hashlib.sha256(
+        f"{settings['app_title']}\n{settings['school_name']}".encode()).hexdigest()[:8]
+    tenant.settings = (time.monotonic(), settings)
+    return settings
+
+def class_choices():
+    return school_settings()["class_groups"]
+
+def save_school_settings(conn, values, groups=None):
+    conn.executemany(
+        "INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+        list(values.items()))
+    if groups is not None:
+        conn.execute("DELETE FROM class_groups")
+        conn.executemany("INSERT INTO class_groups (name, position) VALUES (?, ?)",
+                         [(name, i) for i, name in enumerate(groups)])
+
+def check_admin_code(code):
+    code_hash = school_settings()["admin_code_hash"]
+    if code_hash:
+        return check_password_hash(code_hash, code)
+    # كود البيئة للمدرسة الوحيدة فقط: مدرسة جديدة بلا كود لا تُفتح بكود مشترك
+    return not TENANT_MODE and code == ADMIN_CODE
+
+def parse_class_groups(text, sep):
+    return list(dict.fromkeys(name.strip() for name in text.split(sep) if name.strip()))
+
+TEMPLATES["admin_settings.html"] = """{% extends "base.html" %}
+{% block content %}
+    <div class="card">
+      <div class="topbar">
+        <h2>الإعدادات</h2>
+        <a class="btn secondary" href="{{ url_for('admin_dashboard') }}">رجوع</a>
+      </div>
+      <form method="post" class="grid two">
+        <div>
+          <label>اسم الموقع</label>
+          <input type="text" name="app_title" value="{{ settings['app_title'] }}" required />
+        </div>
+        <div>
+          <label>المؤسسة</label>
+          <input type="text" name="school_name" value="{{ settings['school_name'] }}" required />
+        </div>
+        <div>
+          <label>الأفواج (فوج في كل سطر)</label>
+          <textarea name="class_groups" rows="6" required>{{ settings['class_groups']|join('\\n') }}</textarea>
+        </div>
+        <div>
+          <label>كود أستاذ جديد (اتركه فارغًا للإبقاء على الحالي)</label>
+          <input type="password" name="admin_code" autocomplete="new-password" />
+        </div>
+        <div style="grid-column:1 / -1; text-align:left">
+          <button class="btn" type="submit">حفظ</button>
+        </div>
+      </form>
+    </div>
+{% endblock %}
+"""
+
+@app.route("/admin/settings", methods=["GET", "POST"])
+def admin_settings():
+    if not session.get("is_admin"):
+        return redirect(url_for("admin_login"))
+    if request.method == "POST":
+        app_title = request.form.get("app_title", "").strip()
+        school_name = request.form.get("school_name", "").strip()
+        groups = parse_class_groups(request.form.get("class_groups", ""), "\n")
+        code = request.form.get("admin_code", "").strip()
+        if not app_title or not school_name or not groups:
+            flash("اسم الموقع والمؤسسة وفوج واحد على الأقل مطلوبة.")
+            return redirect(url_for("admin_settings"))
+        values = {"app_title": app_title, "school_name": school_name}
+        if code:
+            values["admin_code_hash"] = generate_password_hash(code)
+        db_write(save_school_settings, values, groups)
+        current_tenant().settings = None
+        flash("تم حفظ الإعدادات.")
+        return redirect(url_for("admin_settings"))
+    return render_template("admin_settings.html", title="الإعدادات", settings=school_settings())
+
+@app.cli.group("tenant")
+def tenant_cli():
+    """المدارس في وضع تعدد المدارس (TENANT_MODE)."""
+
+@tenant_cli.command("create")
+@click.argument("name")
+@click.option("--title", default=APP_TITLE, show_default=True, help="اسم الموقع")
+@click.option("--school", default=SCHOOL_NAME, show_default=True, help="اسم المؤسسة")
+@click.option("--groups", default=",".join(DEFAULT_CLASS_GROUPS), show_default=True, help="الأفواج مفصولة بفاصلة")
+@click.option("--admin-code", prompt="كود الأستاذ", hide_input=True, confirmation_prompt=True)
+def tenant_create(name, title, school, groups, admin_code):
+    """مدرسة جديدة: flask --app app tenant create <الاسم> (النطاق الفرعي أو بادئة المسار)."""
+    ensure_app()
+    if not TENANT_MODE:
+        raise click.ClickException("TENANT_MODE غير مفعّل (host أو path)")
+    if not TENANT_NAME_RE.fullmatch(name) or name in TENANT_RESERVED:
+        raise click.ClickException("الاسم: حروف لاتينية صغيرة وأرقام و - (حتى 32 حرفًا)")
+    if os.path.isdir(tenant_dir(name)):
+        raise click.ClickException(f"المدرسة {name} موجودة")
+    group_list = parse_class_groups(groups, ",")
+    if not group_list or not admin_code.strip():
+        raise click.ClickException("الأفواج وكود الأستاذ مطلوبة")
+    os.makedirs(tenant_dir(name))
+    with cli_tenant(name):
+        db_write(save_school_settings, {"app_title": title, "school_name": school,
+                                        "admin_code_hash": generate_password_hash(admin_code.strip())}, group_list)
+    click.echo(f"{name}: {tenant_dir(name)}")
+
+@tenant_cli.command("list")
+def tenant_list():
+    """أسماء المدارس الموجودة."""
+    ensure_app()
+    for name in tenant_names():
+        click.echo(name)
+
 # --------------------- أمان الرؤوس ---------------------
 @app.after_request
 def add_security_headers(resp):
@@ -619,6 +4209,96 @@ def add_security_headers(resp):
     resp.headers["Content-Security-Policy"] = "default-src 'self'; style-src 'self' 'unsafe-inline';"
     return resp
 
+# --------------------- الضغط ---------------------
+# ضغط HTML/JSON/CSS فوق حد أدنى من الحجم: brotli إن كانت الحزمة مثبتة، وإلا gzip.
+# لا نضغط الملفات المرسلة من القرص (direct_passthrough) ولا الاستجابات المتدفقة.
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_MIMETYPES = {"text/html", "text/css", "text/javascript", "text/plain", "text/csv", "application/json"}
+
+@app.after_request
+def compress_response(resp):
+    if (resp.status_code != 200 or resp.direct_passthrough or resp.is_streamed
+            or "Content-Encoding" in resp.headers or resp.mimetype not in COMPRESS_MIMETYPES):
+        return resp
+    resp.vary.add("Accept-Encoding")
+    if (resp.content_length or 0) < COMPRESS_MIN_BYTES:
+        return resp
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        encoding, body = "br", brotli.compress(resp.get_data(), quality=5)
+    elif accepted["gzip"]:
+        encoding, body = "gzip", gzip.compress(resp.get_data(), compresslevel=6)
+    else:
+        return resp
+    resp.set_data(body)
+    resp.headers["Content-Encoding"] = encoding
+    # تمثيل مضغوط مختلف بايتًا ببايت: ETag يصبح ضعيفًا (W/) والمقارنة في 304 ضعيفة
+    etag, weak = resp.get_etag()
+    if etag and not weak:
+        resp.set_etag(etag, weak=True)
+    return resp
+
+# --------------------- تجهيز التطبيق ---------------------
+# استيراد هذا الملف لا يلمس القرص ولا القاعدة: create_app تحدّد المسارات وتنشئ المجلدات
+# وتطبّق الترحيلات وتترجم القوالب. gunicorn.conf.py يستدعيها مرة واحدة في العملية الأم
+# (preload_app) قبل fork، فيبدأ كل عامل بقاعدة مُرحَّلة وقوالب جاهزة. أي تشغيل آخر
+# (gunicorn app:app، flask run، عميل الاختبار) يُجهَّز تلقائيًا مع أول طلب عبر ensure_app.
+_app_lock = threading.RLock()
+_app_ready = False
+
+def create_app(config=None):
+    """يجهّز التطبيق ويُرجعه. مفاتيح config (تتقدّم على متغيرات البيئة بنفس الاسم):
+    DATA_DIR، UPLOAD_FOLDER، ARCHIVE_FOLDER، DATABASE_URL، TENANT_MODE، و MIGRATE=False لترك الترحيلات لأداة أخرى.
+    مع TENANT_MODE تُفتح كل مدرسة (وتُرحَّل قاعدتها) مع أول طلب إليها، وملفاتها وأرشيفها في مجلدها."""
+    global DATABASE_URL, TENANT_MODE, TENANTS_DIR, default_tenant, tenants, _app_ready
+    config = config or {}
+    setting = lambda key, default=None: config.get(key, os.environ.get(key, default))
+    with _app_lock:
+        data_dir = os.path.abspath(setting("DATA_DIR") or os.getcwd())
+        DATABASE_URL = setting("DATABASE_URL", "")
+        TENANT_MODE = str(setting("TENANT_MODE", "")).lower()
+        if TENANT_MODE not in ("", "host", "path"):
+            raise ValueError(f"TENANT_MODE must be host or path, not {TENANT_MODE!r}")
+        if TENANT_MODE and DATABASE_URL.startswith("sqlite:"):
+            raise ValueError("TENANT_MODE keeps each school in DATA_DIR/tenants/<name>/school.db: "
+                             "leave DATABASE_URL empty or use PostgreSQL")
+        TENANTS_DIR = os.path.join(data_dir, "tenants")
+        migrate = str(setting("MIGRATE", "1")).lower() not in ("0", "false", "no")
+        app.config.update(config)
+        os.makedirs(data_dir, exist_ok=True)
+
+        # create_app من جديد (الاختبارات، أداة أخرى): خيوط المدارس السابقة تتوقف
+        if default_tenant is not None:
+            close_db()
+            default_tenant.close()
+        if tenants is not None:
+            tenants.close_all()
+        default_tenant = tenants = None
+        if TENANT_MODE:
+            os.makedirs(TENANTS_DIR, exist_ok=True)
+            tenants = TenantRegistry(TENANT_CACHE_SIZE, TENANT_IDLE_SECONDS, migrate)
+        else:
+            upload_folder = os.path.abspath(setting("UPLOAD_FOLDER") or os.path.join(data_dir, "uploads"))
+            archive_folder = os.path.abspath(setting("ARCHIVE_FOLDER") or os.path.join(data_dir, "archive"))
+            app.config["UPLOAD_FOLDER"] = upload_folder
+            default_tenant = Tenant("", data_dir, upload_folder, archive_folder,
+                                    make_database(DATABASE_URL, data_dir)).open(migrate)
+
+        # jinja_env يُنشأ عند أول استعمال، فخيارات الـ bytecode cache تُضبط قبله
+        if TEMPLATE_CACHE_DIR and "bytecode_cache" not in app.jinja_options:
+            os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+            app.jinja_options = {**app.jinja_options,
+                                 "bytecode_cache": FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)}
+        precompile_templates()
+        _app_ready = True
+    return app
+
+def ensure_app():
+    if not _app_ready:
+        with _app_lock:
+            if not _app_ready:
+                create_app()
+
 # تشغيل محليًا: python app.py
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    create_app().run(host="0.0.0.0", port=5000, debug=True)
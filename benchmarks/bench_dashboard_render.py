@@ -0,0 +1,65 @@
+# قياس زمن عرض لوحة التلميذ: الطريقة القديمة (render_template_string مرتين في كل طلب)
+# مقابل القوالب المترجمة مرة واحدة عند الإقلاع.
+# التشغيل: python benchmarks/bench_dashboard_render.py [عدد التكرارات]
+
+import os
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import app as school  # noqa: E402
+from flask import render_template, render_template_string  # noqa: E402
+from markupsafe import Markup  # noqa: E402
+
+# create_app ينشئ school.db و uploads/، لذا نعمل داخل مجلد مؤقت
+school.create_app({"DATA_DIR": tempfile.mkdtemp(prefix="bench-")})
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+ROWS = [
+    {"subject": f"مادة {i}", "ca": 14.5, "t1": 12.0, "t2": 15.0, "exam": 13.25,
+     "final": 13.69, "created_at": "2024-06-01 10:00", "rank": 3, "n": 31,
+     "mean": 11.2, "min": 4.5, "max": 17.75}
+    for i in range(8)
+]
+FILES = [
+    {"id": i, "title": f"واجب رقم {i}", "uploaded_at": "2024-06-01 10:00"}
+    for i in range(20)
+]
+CTX = dict(rows=ROWS, class_group="3 ع", student_name="أحمد بن علي")
+
+# نعيد بناء القالبين كما كانا قبل التعديل: صفحة مستقلة + BASE_HTML مع content|safe
+LEGACY_BASE = school.TEMPLATES["base.html"].replace(
+    "{% block content %}{% endblock %}", "{{ content|safe }}")
+LEGACY_PAGE = (school.TEMPLATES["student_dashboard.html"]
+               .replace('{% extends "base.html" %}', "")
+               .replace("{% block content %}", "")
+               .replace("{% endblock %}", ""))
+LEGACY_FILES = school.TEMPLATES["student_files.html"]
+
+
+def legacy():
+    return render_template_string(
+        LEGACY_BASE, app_title=school.APP_TITLE, school_name=school.SCHOOL_NAME, title="لوحتي",
+        content=render_template_string(
+            LEGACY_PAGE, files_html=Markup(render_template_string(LEGACY_FILES, files=FILES, **CTX)), **CTX))
+
+
+def compiled():
+    files_html = Markup(render_template("student_files.html", files=FILES, **CTX))
+    return render_template("student_dashboard.html", title="لوحتي", files_html=files_html, **CTX)
+
+
+def main():
+    with school.app.test_request_context("/dashboard"):
+        for name, fn in (("render_template_string", legacy), ("compiled registry", compiled)):
+            fn()
+            total = timeit.timeit(fn, number=N)
+            print(f"{name:24s} {total / N * 1e6:9.1f} µs/req  ({N} req)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# قياس زمن الإقلاع: استيراد app.py ثم create_app (قاعدة جديدة / قاعدة موجودة)،
+# وزمن gunicorn من التشغيل حتى أول طلب يُخدم، مع preload_app وبدونه.
+# التشغيل: python benchmarks/bench_startup.py [--runs 5] [--workers 4] [--port 8765]
+
+import argparse
+import http.client
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# يُنفَّذ في عملية جديدة: كل تشغيل يبدأ بمفسّر بارد كما يبدأ عامل gunicorn بلا preload
+PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, %r)
+import app
+t1 = time.perf_counter()
+app.create_app()
+t2 = time.perf_counter()
+print(json.dumps({"import_ms": (t1 - t0) * 1000, "create_app_ms": (t2 - t1) * 1000}))
+"""
+
+
+def probe(data_dir):
+    started = time.perf_counter()
+    out = subprocess.run([sys.executable, "-c", PROBE % ROOT], cwd=data_dir, check=True,
+                         capture_output=True, text=True).stdout
+    r = json.loads(out.splitlines()[-1])
+    r["process_ms"] = (time.perf_counter() - started) * 1000
+    return r
+
+
+def get(port, path="/"):
+    c = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    c.request("GET", path)
+    resp = c.getresponse()
+    resp.read()
+    return resp.status
+
+
+def gunicorn_first_request(data_dir, port, workers, preload):
+    """(زمن أول رد 200 منذ التشغيل، أبطأ رد بين workers×4 طلبات متزامنة بعده) بالملّي ثانية."""
+    env = {**os.environ, "GUNICORN_PRELOAD": "1" if preload else "0"}
+    cmd = [sys.executable, "-m", "gunicorn", "-c", os.path.join(ROOT, "gunicorn.conf.py"),
+           "--chdir", data_dir, "--pythonpath", ROOT, "-b", f"127.0.0.1:{port}",
+           "-w", str(workers), "--log-level", "warning"]
+    started = time.perf_counter()
+    proc = subprocess.Popen(cmd, env=env)
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                if get(port) == 200:
+                    break
+            except OSError:
+                if time.time() > deadline:
+                    sys.exit("gunicorn لم يبدأ خلال 30 ثانية")
+                time.sleep(0.005)
+        first = (time.perf_counter() - started) * 1000
+
+        # العمّال الآخرون: بلا preload يدفع كل واحد ثمن create_app مع أول طلب يصله
+        latencies = []
+
+        def hit():
+            t0 = time.perf_counter()
+            get(port)
+            latencies.append((time.perf_counter() - t0) * 1000)
+
+        threads = [threading.Thread(target=hit) for _ in range(workers * 4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return first, max(latencies)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def median(xs):
+    return statistics.median(xs) if xs else 0.0
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser()
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--port", type=int, default=8765)
+    args = p.parse_args(argv)
+
+    fresh, warm = [], []
+    existing = tempfile.mkdtemp(prefix="startup-")
+    probe(existing)  # قاعدة مُرحَّلة وملفات .pyc جاهزة
+    for _ in range(args.runs):
+        d = tempfile.mkdtemp(prefix="startup-")
+        fresh.append(probe(d))
+        shutil.rmtree(d)
+        warm.append(probe(existing))
+    print(f"{'cold start':24s} {'import':>9s} {'create_app':>11s} {'process':>9s}   (median of {args.runs}, ms)")
+    for name, rs in (("fresh database", fresh), ("existing database", warm)):
+        print(f"{name:24s} {median([r['import_ms'] for r in rs]):9.1f} "
+              f"{median([r['create_app_ms'] for r in rs]):11.1f} {median([r['process_ms'] for r in rs]):9.1f}")
+
+    print(f"\n{'gunicorn -w ' + str(args.workers):24s} {'first 200':>9s} {'slowest of ' + str(args.workers * 4):>16s}")
+    for preload in (True, False):
+        firsts, slowest = [], []
+        for _ in range(args.runs):
+            d = tempfile.mkdtemp(prefix="startup-")
+            a, b = gunicorn_first_request(d, args.port, args.workers, preload)
+            shutil.rmtree(d)
+            firsts.append(a)
+            slowest.append(b)
+        name = "preload_app" if preload else "GUNICORN_PRELOAD=0"
+        print(f"{name:24s} {median(firsts):9.1f} {median(slowest):16.1f}")
+    shutil.rmtree(existing)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# قياس عزل المدارس: زمن كتابة أستاذ المدرسة B بينما أستاذ آخر يحجز قفل الكتابة طويلًا
+# (استيراد كبير مثلًا)، حين يكون ذلك الأستاذ في نفس القاعدة (مدرسة واحدة) أو في مدرسة أخرى A.
+# التشغيل: python benchmarks/bench_tenants.py [--ops 100] [--hold-ms 50]
+# مع DATABASE_URL=postgresql://... تكون المدارس مخططات في نفس القاعدة.
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import app as school  # noqa: E402
+
+
+def hog(tenant, hold, stop):
+    """يحجز قفل كتابة المدرسة hold ثانية، ثم يتركه مثلها، حتى stop."""
+    with school.use_tenant(tenant):
+        conn = school.get_db()
+        while not stop.is_set():
+            school.database.begin_write(conn)
+            conn.execute("UPDATE settings SET value=value WHERE key='school_name'")
+            time.sleep(hold)
+            conn.commit()
+            stop.wait(hold)
+        school.close_db()
+
+
+def measure(writer, hogged, ops, hold):
+    stop = threading.Event()
+    t = threading.Thread(target=hog, args=(hogged, hold, stop))
+    t.start()
+    time.sleep(hold / 2)
+    latencies = []
+    with school.use_tenant(writer):
+        conn = school.get_db()
+        for i in range(ops):
+            # كتابات متفرقة تقع في أي لحظة من دورة القفل، لا دفعة واحدة في فجوة واحدة
+            time.sleep(random.uniform(0, 2 * hold))
+            t0 = time.perf_counter()
+            school.database.begin_write(conn)
+            conn.execute("INSERT INTO students (name, code, class_group) VALUES (?, ?, 'A1')",
+                         (f"t{i}", f"B{time.monotonic_ns()}"))
+            conn.commit()
+            latencies.append((time.perf_counter() - t0) * 1000)
+        school.close_db()
+    stop.set()
+    t.join()
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.99) - 1]
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser()
+    p.add_argument("--ops", type=int, default=100)
+    p.add_argument("--hold-ms", type=float, default=50)
+    args = p.parse_args(argv)
+    hold = args.hold_ms / 1000
+    data_dir = tempfile.mkdtemp(prefix="tenants-")
+    school.create_app({"DATA_DIR": data_dir, "TENANT_MODE": "path"})
+    cli = school.app.test_cli_runner()
+    for name in ("a", "b"):
+        cli.invoke(args=["tenant", "create", name, "--groups", "A1", "--admin-code", "x"])
+    a, b = school.tenants.acquire("a"), school.tenants.acquire("b")
+
+    print(f"{'teacher B write':24s} {'p50 ms':>8s} {'p99 ms':>8s}   (other teacher holds the lock {args.hold_ms:g} ms)")
+    for name, hogged in (("same school", b), ("other school", a)):
+        p50, p99 = measure(b, hogged, args.ops, hold)
+        print(f"{name:24s} {p50:8.2f} {p99:8.2f}")
+    school.tenants.release(a)
+    school.tenants.release(b)
+    school.tenants.close_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# قياس إنتاجية الكتابة مع عدة كُتّاب متزامنين: كتابة مباشرة (كل خيط يأخذ قفل SQLite بنفسه)
+# مقابل الكاتب الواحد مع group commit (WRITE_QUEUE=1).
+#
+#   python benchmarks/seed.py /tmp/bench-data
+#   python benchmarks/bench_writes.py /tmp/bench-data --writers 8 --ops 300
+#   python benchmarks/bench_writes.py /tmp/bench-data --writers 8 --processes 4   # 4 عمّال × خيطان
+#
+# كل كتابة هي upsert نقطة واحدة كما في admin_add_assessment (مع triggers الإحصاءات والترتيب).
+
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def worker(job):
+    data_dir, write_queue, threads, ops, seed = job
+    os.environ["WRITE_QUEUE"] = write_queue
+    sys.path.insert(0, ROOT)
+    import app as school
+
+    school.create_app({"DATA_DIR": data_dir})
+    students = [r[0] for r in school.get_db().execute("SELECT id FROM students")]
+    subjects = [r[0] for r in school.get_db().execute("SELECT DISTINCT subject FROM assessments")] or ["رياضيات"]
+    latencies, errors = [], []
+    lock = threading.Lock()
+    barrier = threading.Barrier(threads)
+
+    def run(i):
+        rng = random.Random(seed * 100 + i)
+        barrier.wait()
+        for _ in range(ops):
+            params = (rng.choice(students), rng.choice(subjects), None, None, None,
+                      round(rng.uniform(0, 20) * 4) / 4, "2024-06-01 10:00")
+            t0 = time.perf_counter()
+            try:
+                school.db_write(lambda conn: conn.execute(school.UPSERT_ASSESSMENT_SQL, params))
+                ok = True
+            except sqlite3.OperationalError as e:
+                ok, err = False, str(e)
+            dt = time.perf_counter() - t0
+            with lock:
+                latencies.append(dt)
+                if not ok:
+                    errors.append(err)
+
+    pool = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+    started = time.time()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return started, time.time(), latencies, errors
+
+
+def measure(data_dir, write_queue, writers, processes, ops):
+    threads = writers // processes
+    jobs = [(data_dir, write_queue, threads, ops, p) for p in range(processes)]
+    # spawn: كل عملية تستورد app من جديد بمتغير WRITE_QUEUE الخاص بها
+    with multiprocessing.get_context("spawn").Pool(processes) as pool:
+        parts = pool.map(worker, jobs)
+    elapsed = max(p[1] for p in parts) - min(p[0] for p in parts)
+    latencies = sorted(x for p in parts for x in p[2])
+    errors = [e for p in parts for e in p[3]]
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    return {"ops": len(latencies), "errors": len(errors), "ops_per_s": len(latencies) / elapsed,
+            "p50_ms": pick(0.50), "p99_ms": pick(0.99), "max_ms": latencies[-1] * 1000}
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser()
+    p.add_argument("data_dir", help="مجلد فيه school.db (من benchmarks/seed.py)")
+    p.add_argument("--writers", type=int, default=8, help="عدد الكُتّاب المتزامنين (خيوط × عمليات)")
+    p.add_argument("--processes", type=int, default=1, help="عدد العمليات (عمّال gunicorn)")
+    p.add_argument("--ops", type=int, default=300, help="عدد الكتابات لكل كاتب")
+    args = p.parse_args(argv)
+    if not os.path.exists(os.path.join(args.data_dir, "school.db")):
+        sys.exit("القاعدة غير موجودة: شغّل benchmarks/seed.py أولاً")
+
+    print(f"{args.writers} writers in {args.processes} process(es), {args.ops} upserts each")
+    for name, flag in (("direct", "0"), ("group commit", "1")):
+        r = measure(os.path.abspath(args.data_dir), flag, args.writers, args.processes, args.ops)
+        print(f"{name:14s} {r['ops_per_s']:8.1f} writes/s  p50 {r['p50_ms']:7.2f}ms  "
+              f"p99 {r['p99_ms']:8.2f}ms  max {r['max_ms']:8.2f}ms  errors {r['errors']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# يتحقق بـ EXPLAIN QUERY PLAN من أن الاستعلامات الساخنة تستعمل فهرسًا ولا تمسح الجداول كاملة.
+# التشغيل: python benchmarks/check_query_plans.py   (يخرج برمز 1 عند أي تراجع)
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import app as school  # noqa: E402
+
+school.create_app({"DATA_DIR": tempfile.mkdtemp(prefix="plans-")})
+
+G = "3 ع"
+SEARCH_GROUP = "AND files.class_group=?"
+HL = (school.HL_OPEN, school.HL_CLOSE) * 2
+
+# الاستعلامات مأخوذة من ثوابت app.py نفسها حتى لا تنحرف النسخة المفحوصة عن التي يُنفّذها التطبيق.
+# (الاستعلام، المعاملات، فهرس متوقَّع في الخطة أو None، هل يُقبل فرز مؤقت TEMP B-TREE)
+HOT_QUERIES = [
+    (school.STUDENT_LOGIN_SQL, ("1", G), None, False),
+    # الفرز المؤقت هنا على مواد تلميذ واحد فقط (بضعة أسطر) بعد البحث بالفهرس
+    (school.STUDENT_ROWS_SQL, (G, 1), "ux_assessments_student_subject", True),
+    (school.STUDENT_NAME_SQL, (1,), None, False),
+    (school.STUDENT_ETAG_SQL, (G, 1), None, False),
+    (school.GROUP_FILES_SQL, (G,), "ix_files_group_id", False),
+    (school.FILE_SQL, (1,), None, False),
+    (school.keyset_sql("SELECT * FROM students", ["class_group=?"], 100), (G, 100, school.PAGE_SIZE + 1),
+     "ix_students_group_id", False),
+    (school.keyset_sql("SELECT * FROM files", ["class_group=?"], 100), (G, 100, school.PAGE_SIZE + 1),
+     "ix_files_group_id", False),
+    (school.keyset_prev_sql("students", ["class_group=?"]), (G, 100, school.PAGE_SIZE),
+     "ix_students_group_id", False),
+    (school.keyset_prev_sql("files", ["class_group=?"]), (G, 100, school.PAGE_SIZE), "ix_files_group_id", False),
+    (school.export_sql(), (G,), "ix_students_group_id", False),
+    (school.export_sql("math"), ("math", G), "ix_students_group_id", False),
+    (school.DELETE_STUDENT_ASSESSMENTS_SQL, (1,), "ux_assessments_student_subject", False),
+    # ترتيب bm25 لا فهرس له أصلًا؛ الحد SEARCH_LIMIT يُبقي الفرز صغيرًا
+    (school.SEARCH_FTS_SQL.format(group_clause=SEARCH_GROUP),
+     (*HL, '"دوال"*', G, school.SEARCH_LIMIT), None, True),
+    (school.UPSERT_ASSESSMENT_SQL, (1, "x", None, None, None, None, ""), None, False),
+]
+
+
+def plan(conn, sql, params):
+    return [row["detail"] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+
+def main():
+    conn = school.get_db()
+    failures = 0
+    for sql, params, index, temp_sort in HOT_QUERIES:
+        details = plan(conn, sql, params)
+        # "SCAN t" بدون فهرس = مسح كامل للجدول
+        scans = [d for d in details if d.startswith("SCAN") and "INDEX" not in d]
+        missing = index is not None and not any(index in d for d in details)
+        # ORDER BY لا يتبع أي فهرس: فرز في الذاكرة على كل الأسطر المطابقة
+        sorts = not temp_sort and any("TEMP B-TREE" in d for d in details)
+        ok = not scans and not missing and not sorts
+        failures += not ok
+        print(("ok   " if ok else "FAIL ") + " ".join(sql.split())[:90])
+        for d in details:
+            print("       " + d)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
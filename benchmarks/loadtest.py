@@ -0,0 +1,255 @@
+# قياس زمن الاستجابة (p50/p95/p99) وعدد الطلبات في الثانية للمسارات الساخنة.
+#
+#   python benchmarks/seed.py /tmp/bench-data
+#   python benchmarks/loadtest.py /tmp/bench-data --mode client --save benchmarks/baselines/client.json
+#   python benchmarks/loadtest.py /tmp/bench-data --mode http --gunicorn --workers 4 --concurrency 16
+#   python benchmarks/loadtest.py /tmp/bench-data --mode client --compare benchmarks/baselines/client.json
+#
+# mode=client: عميل الاختبار الخاص بـ Flask داخل نفس العملية (بدون شبكة).
+# mode=http: عدة عمليات ترسل طلبات HTTP حقيقية إلى --url أو إلى gunicorn (gunicorn.conf.py) يُشغَّل تلقائيًا.
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ["student_login", "student_dashboard", "admin_dashboard", "admin_add_assessment", "download_file"]
+ADMIN_CODE = os.environ.get("ADMIN_CODE", "ostad123")
+
+
+def load_fixtures(data_dir, seed):
+    """عيّنة من التلاميذ والملفات الموجودة في القاعدة لبناء الطلبات."""
+    conn = sqlite3.connect(os.path.join(data_dir, "school.db"))
+    students = conn.execute("SELECT id, code, class_group FROM students ORDER BY RANDOM() LIMIT 500").fetchall()
+    files = {}
+    for fid, group in conn.execute("SELECT id, class_group FROM files"):
+        files.setdefault(group, []).append(fid)
+    subjects = [r[0] for r in conn.execute("SELECT DISTINCT subject FROM assessments LIMIT 20")] or ["رياضيات"]
+    conn.close()
+    if not students:
+        sys.exit("القاعدة فارغة: شغّل benchmarks/seed.py أولاً")
+    return {"students": students, "files": files, "subjects": subjects, "seed": seed}
+
+
+def build_request(scenario, fx, rng, student):
+    """يُرجع (الدور، الطريقة، المسار، بيانات النموذج)."""
+    sid, code, group = student
+    if scenario == "student_login":
+        return None, "POST", "/login", {"code": code, "class_group": group}
+    if scenario == "student_dashboard":
+        return "student", "GET", "/dashboard", None
+    if scenario == "admin_dashboard":
+        return "admin", "GET", "/admin/dashboard", None
+    if scenario == "admin_add_assessment":
+        target = rng.choice(fx["students"])[0]
+        form = {"subject": rng.choice(fx["subjects"]), "exam": f"{rng.uniform(0, 20):.2f}"}
+        return "admin", "POST", f"/admin/assessment/add/{target}", form
+    if scenario == "download_file":
+        ids = fx["files"].get(group)
+        return "student", "GET", f"/download/{rng.choice(ids)}" if ids else "/dashboard", None
+    raise ValueError(scenario)
+
+
+def percentiles(latencies):
+    xs = sorted(latencies)
+    pick = lambda q: xs[min(len(xs) - 1, int(q * len(xs)))] * 1000 if xs else 0.0
+    return {"p50_ms": round(pick(0.50), 3), "p95_ms": round(pick(0.95), 3), "p99_ms": round(pick(0.99), 3)}
+
+
+# --------------------- عميل Flask داخل العملية ---------------------
+def run_client(data_dir, fx, scenario, requests_per_scenario):
+    sys.path.insert(0, ROOT)
+    import app as school
+
+    school.create_app({"DATA_DIR": data_dir})
+    rng = random.Random(fx["seed"])
+    student = rng.choice(fx["students"])
+    client = school.app.test_client()
+    role, *_ = build_request(scenario, fx, rng, student)
+    if role == "admin":
+        client.post("/admin", data={"code": ADMIN_CODE})
+    elif role == "student":
+        client.post("/login", data={"code": student[1], "class_group": student[2]})
+
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    for _ in range(requests_per_scenario):
+        _, method, path, form = build_request(scenario, fx, rng, student)
+        t0 = time.perf_counter()
+        resp = client.open(path, method=method, data=form)
+        resp.get_data()
+        latencies.append(time.perf_counter() - t0)
+        errors += resp.status_code >= 400
+        if scenario == "student_login":
+            client.get("/logout")
+    elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+# --------------------- مولّد حمل HTTP متعدد العمليات ---------------------
+class HttpSession:
+    def __init__(self, url):
+        u = urllib.parse.urlsplit(url)
+        self.conn = http.client.HTTPConnection(u.hostname, u.port or 80, timeout=30)
+        self.cookie = None
+
+    def request(self, method, path, form=None):
+        headers = {}
+        body = None
+        if form is not None:
+            body = urllib.parse.urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        self.conn.request(method, path, body=body, headers=headers)
+        resp = self.conn.getresponse()
+        resp.read()
+        set_cookie = resp.getheader("Set-Cookie")
+        if set_cookie:
+            self.cookie = set_cookie.split(";", 1)[0]
+        return resp.status
+
+
+def http_worker(job):
+    url, fx, scenario, duration, worker_id = job
+    rng = random.Random(fx["seed"] * 1000 + worker_id)
+    student = rng.choice(fx["students"])
+    session = HttpSession(url)
+    role, *_ = build_request(scenario, fx, rng, student)
+    if role == "admin":
+        session.request("POST", "/admin", {"code": ADMIN_CODE})
+    elif role == "student":
+        session.request("POST", "/login", {"code": student[1], "class_group": student[2]})
+
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        _, method, path, form = build_request(scenario, fx, rng, student)
+        t0 = time.perf_counter()
+        try:
+            status = session.request(method, path, form)
+            errors += status >= 400
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            session = HttpSession(url)
+        latencies.append(time.perf_counter() - t0)
+        if scenario == "student_login":
+            session.cookie = None
+    return latencies, errors
+
+
+def run_http(url, fx, scenario, duration, concurrency):
+    jobs = [(url, fx, scenario, duration, i) for i in range(concurrency)]
+    started = time.perf_counter()
+    with multiprocessing.Pool(concurrency) as pool:
+        parts = pool.map(http_worker, jobs)
+    elapsed = time.perf_counter() - started
+    latencies = [x for lat, _ in parts for x in lat]
+    return latencies, sum(e for _, e in parts), elapsed
+
+
+def start_gunicorn(data_dir, port, workers, threads):
+    cmd = [sys.executable, "-m", "gunicorn", "-c", os.path.join(ROOT, "gunicorn.conf.py"),
+           "--chdir", os.path.abspath(data_dir),
+           "--pythonpath", ROOT, "-b", f"127.0.0.1:{port}", "-w", str(workers),
+           "--threads", str(threads), "--log-level", "warning"]
+    proc = subprocess.Popen(cmd)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            c = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            c.request("GET", "/")
+            c.getresponse().read()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    sys.exit("gunicorn لم يبدأ خلال 30 ثانية")
+
+
+# --------------------- التقرير ---------------------
+def compare(results, baseline_path):
+    with open(baseline_path, encoding="utf-8") as fh:
+        base = json.load(fh)["results"]
+    print(f"\nمقارنة مع {baseline_path}:")
+    print(f"{'scenario':22s} {'metric':8s} {'baseline':>10s} {'now':>10s} {'delta':>8s}")
+    for name, r in results.items():
+        if name not in base:
+            continue
+        for metric in ("rps", "p50_ms", "p95_ms", "p99_ms"):
+            old, new = base[name][metric], r[metric]
+            delta = (new - old) / old * 100 if old else 0.0
+            print(f"{name:22s} {metric:8s} {old:10.2f} {new:10.2f} {delta:+7.1f}%")
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser()
+    p.add_argument("data_dir", help="مجلد فيه school.db و uploads/ (من benchmarks/seed.py)")
+    p.add_argument("--mode", choices=["client", "http"], default="client")
+    p.add_argument("--scenarios", default=",".join(SCENARIOS))
+    p.add_argument("--requests", type=int, default=500, help="mode=client: عدد الطلبات لكل سيناريو")
+    p.add_argument("--duration", type=float, default=10, help="mode=http: مدة كل سيناريو بالثواني")
+    p.add_argument("--concurrency", type=int, default=8)
+    p.add_argument("--url", default="http://127.0.0.1:8000")
+    p.add_argument("--gunicorn", action="store_true", help="تشغيل gunicorn على data_dir تلقائيًا")
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--threads", type=int, default=1)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--save", help="حفظ النتائج JSON (خط أساس)")
+    p.add_argument("--compare", help="ملف JSON سابق للمقارنة")
+    args = p.parse_args(argv)
+
+    fx = load_fixtures(args.data_dir, args.seed)
+    proc = None
+    if args.mode == "http" and args.gunicorn:
+        port = urllib.parse.urlsplit(args.url).port or 8000
+        proc = start_gunicorn(args.data_dir, port, args.workers, args.threads)
+
+    results = {}
+    try:
+        for scenario in args.scenarios.split(","):
+            if args.mode == "client":
+                # كل سيناريو في عملية مستقلة حتى لا يؤثر أحدها على الآخر (ذاكرة، اتصالات)
+                with multiprocessing.Pool(1) as pool:
+                    latencies, errors, elapsed = pool.apply(
+                        run_client, (args.data_dir, fx, scenario, args.requests))
+            else:
+                latencies, errors, elapsed = run_http(args.url, fx, scenario, args.duration, args.concurrency)
+            r = {"requests": len(latencies), "errors": errors,
+                 "rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0, **percentiles(latencies)}
+            results[scenario] = r
+            print(f"{scenario:22s} {r['requests']:7d} req  {r['rps']:9.1f} req/s  "
+                  f"p50 {r['p50_ms']:7.2f}ms  p95 {r['p95_ms']:7.2f}ms  p99 {r['p99_ms']:7.2f}ms  "
+                  f"errors {errors}")
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+
+    report = {
+        "meta": {"mode": args.mode, "concurrency": args.concurrency if args.mode == "http" else 1,
+                 "workers": args.workers if args.gunicorn else None, "threads": args.threads,
+                 "python": platform.python_version(), "machine": platform.machine(),
+                 "created": time.strftime("%Y-%m-%d %H:%M:%S")},
+        "results": results,
+    }
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, ensure_ascii=False, indent=2, sort_keys=True)
+            fh.write("\n")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# مولّد بيانات مدرسة اصطناعية (قابل للتكرار بنفس البذرة) لاختبارات الأداء.
+# التشغيل: python benchmarks/seed.py DATA_DIR --groups 20 --students 5000 --subjects 10 --files 10
+# ينشئ DATA_DIR/school.db و DATA_DIR/uploads/ كما يفعل create_app(DATA_DIR=...).
+
+import argparse
+import io
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+FIRST = ["أحمد", "محمد", "فاطمة", "خديجة", "يوسف", "مريم", "علي", "سارة", "عمر", "ليلى", "كريم", "هاجر"]
+LAST = ["بن علي", "بوزيد", "حمدي", "سعيدي", "بلقاسم", "مناعي", "زروقي", "عمراني", "شريف", "بن يحيى"]
+SUBJECTS = ["رياضيات", "فيزياء", "علوم", "عربية", "فرنسية", "إنجليزية", "تاريخ", "جغرافيا",
+            "فلسفة", "إسلامية", "إعلام آلي", "رياضة"]
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument("data_dir")
+    p.add_argument("--groups", type=int, default=20)
+    p.add_argument("--students", type=int, default=5000)
+    p.add_argument("--subjects", type=int, default=10, help="عدد المواد لكل تلميذ (assessments = students × subjects)")
+    p.add_argument("--files", type=int, default=10, help="عدد الملفات لكل فوج")
+    p.add_argument("--file-kb", type=int, default=64)
+    p.add_argument("--seed", type=int, default=42)
+    return p.parse_args(argv)
+
+
+def group_name(i):
+    return f"G{i + 1:02d}"
+
+
+def score(rng):
+    # بعض الخانات فارغة كما في الواقع (نقاط لم تُدخل بعد)
+    return None if rng.random() < 0.05 else round(rng.uniform(2, 20) * 4) / 4
+
+
+def seed(args):
+    import app as school
+
+    school.create_app({"DATA_DIR": args.data_dir})  # يُنشئ القاعدة ويطبّق الترحيلات
+
+    rng = random.Random(args.seed)
+    conn = school.get_db()
+    started = time.perf_counter()
+    groups = [group_name(i) for i in range(args.groups)]
+    subjects = SUBJECTS[:args.subjects]
+    now = "2024-06-01 10:00"
+
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        # الـ triggers تعيد حساب الفوج عند كل سطر؛ للتعبئة الكبيرة نوقفها ونحسب الإحصاءات مرة واحدة
+        triggers = conn.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type='trigger' AND tbl_name='assessments'").fetchall()
+        for t in triggers:
+            conn.execute(f"DROP TRIGGER {t['name']}")
+
+        conn.executemany(
+            "INSERT INTO students (name, code, class_group) VALUES (?, ?, ?)",
+            ((f"{rng.choice(FIRST)} {rng.choice(LAST)}", f"S{i + 1:06d}", groups[i % len(groups)])
+             for i in range(args.students))
+        )
+        ids = [r[0] for r in conn.execute("SELECT id FROM students ORDER BY id")]
+        conn.executemany(
+            "INSERT INTO assessments (student_id, subject, ca, t1, t2, exam, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((sid, subj, score(rng), score(rng), score(rng), score(rng), now) for sid in ids for subj in subjects)
+        )
+        for stmt in school.class_stats_refresh_sql().split(";"):
+            if stmt.strip():
+                conn.execute(stmt)
+        for t in triggers:
+            conn.execute(t["sql"])
+
+        for g_name in groups:
+            for j in range(args.files):
+                body = b"%PDF-1.4\n" + rng.randbytes(args.file_kb * 1024)
+                tmp, sha256, size = school.stage_upload(io.BytesIO(body))
+                school.storage.save(sha256, tmp)
+                os.remove(tmp)
+                title = f"واجب {j + 1} — {g_name}"
+                cur = conn.execute(
+                    """INSERT INTO files (title, filename, class_group, uploaded_at, size, mtime, etag, sha256)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (title, f"hw{j + 1}.pdf", g_name, now, size, time.time(), sha256, sha256)
+                )
+                conn.execute("INSERT INTO file_texts (file_id, title) VALUES (?, ?)", (cur.lastrowid, title))
+        conn.commit()
+
+    counts = {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0]
+              for t in ("students", "assessments", "files", "class_stats")}
+    print(f"seeded {os.path.abspath(args.data_dir)} in {time.perf_counter() - started:.1f}s: {counts}")
+
+
+if __name__ == "__main__":
+    seed(parse_args())
@@ -0,0 +1,28 @@
+# إعداد gunicorn للموقع: gunicorn -c gunicorn.conf.py
+# كل القيم قابلة للتغيير بمتغيرات البيئة؛ خيارات سطر الأوامر (-w، --threads...) تتقدّم عليها.
+
+import os
+
+# create_app تُستدعى مرة واحدة في العملية الأم (preload_app): الترحيلات وترجمة القوالب تتم قبل fork،
+# فيبدأ كل عامل جاهزًا بدل أن يكرّرها. GUNICORN_PRELOAD=0 يعيد تحميل app.py في كل عامل
+# (مفيد أثناء التطوير مع --reload)، وعندها يُجهَّز كل عامل مع أول طلب.
+wsgi_app = "app:create_app()"
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+# gthread: الطلبات تنتظر القرص وقاعدة البيانات وبطء شبكة التلاميذ (تنزيل الملفات وأرشيف ZIP)
+# أكثر مما تستهلك المعالج، فعدة خيوط في كل عامل تخدم طلبات متزامنة بذاكرة عملية واحدة.
+# اتصالات SQLite لكل خيط، وكاتب الأستاذ (WriteQueue) ومنفّذ المهام مشتركان داخل العامل.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.environ.get("WEB_CONCURRENCY", min(2 * (os.cpu_count() or 1) + 1, 4)))
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+
+# gevent: كل اتصال SSE (تحديث لوحات التلاميذ مباشرة) مجرد greenlet بدل خيط محجوز.
+# الترقيع هنا قبل أن تستورد preload_app ملف app.py، وإلا بقيت أقفاله و threading.local
+# (اتصال SQLite لكل خيط) نسخًا حقيقية يتشاركها كل greenlets العامل.
+if worker_class == "gevent":
+    from gevent import monkey
+
+    monkey.patch_all()
+    worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", "1000"))